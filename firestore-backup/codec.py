@@ -0,0 +1,148 @@
+"""NDJSON format of the document backups
+
+Every line holds one document as `{"path": "collection/document", "data": {...}}`, documents
+deleted since the previous incremental backup are recorded as tombstones
+`{"path": "collection/document", "deleted": true}`. Firestore values without a JSON counterpart
+are stored as single key objects (`{"$timestamp": "..."}`, `{"$bytes": "..."}`,
+`{"$geopoint": [latitude, longitude]}`, `{"$reference": "path"}`).
+Chunk files are gzip compressed and sorted by the document path, so chunks can be merged
+and compared without loading them into memory.
+"""
+import base64
+import datetime
+import gzip
+import heapq
+import io
+import json
+import typing
+
+if typing.TYPE_CHECKING:
+    from google.cloud.firestore import Client
+
+CHUNK_CONTENT_TYPE = 'application/gzip'
+
+
+def encode_value(value):
+    """Converts firestore value to a JSON value"""
+    from google.cloud.firestore import (
+        DocumentReference,
+        GeoPoint,
+    )
+
+    if isinstance(value, dict):
+        return {key: encode_value(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [encode_value(item) for item in value]
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        return {'$timestamp': value.isoformat()}
+    if isinstance(value, bytes):
+        return {'$bytes': base64.b64encode(value).decode('ascii')}
+    if isinstance(value, GeoPoint):
+        return {'$geopoint': [value.latitude, value.longitude]}
+    if isinstance(value, DocumentReference):
+        return {'$reference': value.path}
+    return value
+
+
+def decode_value(value, client: 'Client' = None):
+    """Converts JSON value back to a firestore value
+
+    :param value: JSON value
+    :param client: firestore client for document references, references are returned as paths if not set
+    :return: firestore value
+    """
+    if isinstance(value, list):
+        return [decode_value(item, client) for item in value]
+    if not isinstance(value, dict):
+        return value
+    if len(value) == 1:
+        key, item = next(iter(value.items()))
+        if key == '$timestamp':
+            return datetime.datetime.fromisoformat(item)
+        if key == '$bytes':
+            return base64.b64decode(item)
+        if key == '$geopoint':
+            from google.cloud.firestore import GeoPoint
+
+            return GeoPoint(*item)
+        if key == '$reference':
+            return client.document(item) if client else item
+    return {key: decode_value(item, client) for key, item in value.items()}
+
+
+def dumps_document(path: str, data: dict) -> str:
+    """Serializes document to one NDJSON line (without the line end)
+
+    Fields are sorted, so the same document data always produce the same line.
+    """
+    return '{{"path":{path},"data":{data}}}'.format(
+        path=json.dumps(path),
+        data=json.dumps(encode_value(data), sort_keys=True, separators=(',', ':'))
+    )
+
+
+def dumps_tombstone(path: str) -> str:
+    """Serializes deletion of the document to one NDJSON line (without the line end)"""
+    return '{{"path":{path},"deleted":true}}'.format(path=json.dumps(path))
+
+
+def loads_document(line: typing.Union[str, bytes]) -> typing.Tuple[str, typing.Optional[dict]]:
+    """Parses NDJSON line of a document
+
+    :return: document path and JSON data (see `decode_value`), data is None for tombstones
+    """
+    document = json.loads(line)
+    return document['path'], document.get('data')
+
+
+def encode_chunk(documents: typing.List[typing.Tuple[str, str]]) -> bytes:
+    """Sorts document lines by their path and compresses them to a chunk
+
+    :param documents: document paths and their lines created by `dumps_document`
+    :return: gzip compressed NDJSON
+    """
+    body = ''.join(line + '\n' for _, line in sorted(documents))
+    return gzip.compress(body.encode('utf-8'))
+
+
+def iter_chunk(stream: typing.BinaryIO) -> typing.Iterator[str]:
+    """Iterates over lines of a gzip compressed chunk without decompressing it at once
+
+    :param stream: compressed chunk stream (file or GCS blob reader)
+    :return: NDJSON lines
+    """
+    with gzip.open(stream, 'rt', encoding='utf-8') as lines:
+        for line in lines:
+            if line.strip():
+                yield line.rstrip('\n')
+
+
+def open_chunk(data: bytes) -> typing.Iterator[str]:
+    """Iterates over lines of a compressed chunk loaded in memory"""
+    return iter_chunk(io.BytesIO(data))
+
+
+def merge_chunks(
+        chunks: typing.List[typing.Iterator[str]]
+) -> typing.Iterator[typing.Tuple[str, str]]:
+    """Merges sorted chunks, the last chunk containing a document wins
+
+    Documents whose last line is a tombstone are left out.
+
+    :param chunks: document lines of chunks sorted by path, oldest chunks first
+    :return: document paths and lines in path order
+    """
+    def keyed(order: int, lines: typing.Iterator[str]) -> typing.Iterator[typing.Tuple[str, int, str, bool]]:
+        for line in lines:
+            path, data = loads_document(line)
+            yield path, -order, line, data is None
+
+    last_path = None
+    for path, _, line, deleted in heapq.merge(*(keyed(order, lines) for order, lines in enumerate(chunks))):
+        # newest version of the document comes first
+        if path != last_path:
+            last_path = path
+            if not deleted:
+                yield path, line
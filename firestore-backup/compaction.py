@@ -0,0 +1,201 @@
+import io
+import logging
+import typing
+
+from calendar_common.instrumentation import span
+from codec import (
+    CHUNK_CONTENT_TYPE,
+    iter_chunk,
+    merge_chunks,
+)
+from incremental import (
+    KEYS_BLOB,
+    MANIFEST_BLOB,
+    WATERMARK_BLOB,
+    load_json,
+    load_watermark,
+    save_json,
+)
+
+if typing.TYPE_CHECKING:
+    from google.cloud.storage import (
+        Blob,
+        Bucket,
+    )
+
+READ_BUFFER_SIZE = 256 * 1024
+
+
+class BlobReader(io.RawIOBase):
+    """Reads blob sequentially with ranged downloads, so only the buffer is kept in memory"""
+
+    def __init__(self, blob: 'Blob', buffer_size: int = READ_BUFFER_SIZE):
+        self.blob = blob
+        self.buffer_size = buffer_size
+        self._position = 0
+        if blob.size is None:
+            with span('storage.reload'):
+                blob.reload()
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        if self._position >= self.blob.size:
+            return 0
+        end = min(self._position + len(buffer), self.blob.size) - 1
+        with span('storage.download'):
+            data = self.blob.download_as_string(start=self._position, end=end)
+        buffer[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+
+def read_chunk(bucket: 'Bucket', name: str) -> typing.Iterator[str]:
+    stream = io.BufferedReader(BlobReader(bucket.blob(name)), buffer_size=READ_BUFFER_SIZE)
+    yield from iter_chunk(stream)
+
+
+def backup_chain(bucket: 'Bucket', watermark: dict = None) -> typing.List[dict]:
+    """Returns manifests of the backups needed to restore the latest incremental backup
+
+    The chain starts with the last compacted snapshot (or the first incremental backup) and
+    continues with the following incremental backups, oldest first.
+
+    :param bucket: backup bucket
+    :param watermark: state of the incremental backups, downloaded if not set
+    :return: backup manifests
+    """
+    if watermark is None:
+        watermark, _ = load_watermark(bucket)
+    chain = []
+    prefix = watermark.get('prefix')
+    while prefix:
+        manifest = load_json(bucket, '{}/{}'.format(prefix, MANIFEST_BLOB))
+        if manifest is None:
+            raise RuntimeError('Manifest of the backup {} is missing'.format(prefix))
+        chain.append(manifest)
+        if manifest['mode'] == 'compacted':
+            break
+        prefix = manifest.get('base')
+    return chain[::-1]
+
+
+def chunk_names(manifest: dict) -> typing.List[str]:
+    if manifest['mode'] == 'compacted':
+        return manifest['chunks']
+    return [name for collection in manifest['collections'].values() for name in collection['chunks']]
+
+
+def is_partial(chain: typing.List[dict]) -> bool:
+    """Checks if the snapshot compacted from the chain may keep deleted documents
+
+    :param chain: backup manifests returned by `backup_chain`
+    :return: True if the chain starts with a partial snapshot or some of its backups did not track deletes
+    """
+    base = chain[0]
+    if base['mode'] == 'compacted':
+        # snapshots compacted before deletes were tracked keep deleted documents
+        partial = base.get('partial', True)
+    else:
+        partial = base.get('base') is not None
+    return partial or not all(backup.get('deletes_tracked') for backup in chain[1:])
+
+
+def compact_chain(bucket: 'Bucket', prefix: str, chunk_size: int = 10000, delete_merged: bool = False) -> dict:
+    """Merges the last snapshot and following incremental backups to a new snapshot
+
+    Chunks of all backups in the chain are streamed through a k-way merge by document path,
+    so memory use depends on the number of chunks and not on their size. The compacted
+    snapshot becomes the base of the next incremental backup, so restore needs at most the
+    snapshot and the incremental backups since the last compaction. Tombstones remove deleted
+    documents from the snapshot, it is marked `partial` if deletes were not tracked by the whole
+    chain. The watermark is replaced only if no incremental backup changed it since the chain
+    was read, merged backups are deleted only then.
+
+    :param bucket: backup bucket
+    :param prefix: folder of the compacted snapshot in the bucket
+    :param chunk_size: maximal number of documents in one chunk of the snapshot
+    :param delete_merged: delete chunks of the merged backups
+    :return: manifest of the snapshot (`skipped` is True if there was nothing to compact)
+    """
+    import gzip
+
+    from google.api_core.exceptions import PreconditionFailed
+
+    watermark, generation = load_watermark(bucket)
+    chain = backup_chain(bucket, watermark)
+    if len(chain) < 2:
+        return {'mode': 'compacted', 'prefix': prefix, 'skipped': True}
+
+    manifest = {
+        'mode': 'compacted',
+        'prefix': prefix,
+        'merged': [backup['prefix'] for backup in chain],
+        'until': chain[-1].get('until'),
+        'partial': is_partial(chain),
+        'chunks': [],
+        'documents': 0,
+        'bytes': 0,
+    }
+    chunks = [read_chunk(bucket, name) for backup in chain for name in chunk_names(backup)]
+
+    buffer = io.BytesIO()
+    writer = None
+    count = 0
+
+    def flush():
+        writer.close()
+        name = '{prefix}/{index:05d}.ndjson.gz'.format(prefix=prefix, index=len(manifest['chunks']))
+        data = buffer.getvalue()
+        with span('storage.upload'):
+            bucket.blob(name).upload_from_string(data, content_type=CHUNK_CONTENT_TYPE)
+        manifest['chunks'].append(name)
+        manifest['bytes'] += len(data)
+        buffer.seek(0)
+        buffer.truncate()
+
+    for _, line in merge_chunks(chunks):
+        if writer is None:
+            writer = gzip.GzipFile(fileobj=buffer, mode='wb')
+        writer.write(line.encode('utf-8') + b'\n')
+        count += 1
+        manifest['documents'] += 1
+        if count == chunk_size:
+            flush()
+            writer = None
+            count = 0
+    if writer is not None:
+        flush()
+
+    save_json(bucket, '{}/{}'.format(prefix, MANIFEST_BLOB), manifest)
+    # document ID indexes of the last merged backup would be deleted with it
+    keys = {}
+    for collection_id, name in watermark.get('keys', {}).items():
+        keys[collection_id] = KEYS_BLOB.format(prefix=prefix, collection=collection_id)
+        with span('storage.copy'):
+            bucket.copy_blob(bucket.blob(name), bucket, keys[collection_id])
+    try:
+        save_json(bucket, WATERMARK_BLOB, {**watermark, 'prefix': prefix, 'keys': keys}, if_generation_match=generation)
+    except PreconditionFailed:
+        # incremental backup finished meanwhile and its base is the last merged backup,
+        # the chain stays valid without the snapshot and merged backups must be kept
+        logging.warning({
+            "message": "Incremental backup written during compaction, snapshot is not used as the base",
+            "prefix": prefix
+        })
+        return manifest
+    logging.info({
+        "message": "Backups compacted",
+        "prefix": prefix,
+        "merged": manifest['merged'],
+        "documents": manifest['documents'],
+        "bytes": manifest['bytes']
+    })
+
+    if delete_merged:
+        for backup in chain:
+            for blob in bucket.list_blobs(prefix=backup['prefix'] + '/'):
+                with span('storage.delete'):
+                    blob.delete()
+    return manifest
@@ -0,0 +1,115 @@
+import datetime
+import re
+import typing
+
+from calendar_common.instrumentation import span
+
+if typing.TYPE_CHECKING:
+    from google.auth.transport.requests import AuthorizedSession
+
+FIRESTORE_API = 'https://firestore.googleapis.com/v1beta1'
+RFC3339_PATTERN = re.compile(r'^(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})(?:\.(\d+))?Z$')
+
+
+def parse_timestamp(value: typing.Optional[str]) -> typing.Optional[datetime.datetime]:
+    """Parses RFC 3339 UTC timestamp of the firestore API (nanoseconds are truncated)
+
+    :param value: timestamp string, e.g. `2020-05-01T00:00:01.123456789Z`
+    :return: naive UTC datetime or None if the value is not set
+    """
+    if not value:
+        return None
+    match = RFC3339_PATTERN.match(value)
+    if not match:
+        raise ValueError('Invalid timestamp {}'.format(value))
+    timestamp = datetime.datetime.strptime(match.group(1), '%Y-%m-%dT%H:%M:%S')
+    return timestamp.replace(microsecond=int((match.group(2) or '0')[:6].ljust(6, '0')))
+
+
+def start_export(
+        session: 'AuthorizedSession',
+        project: str,
+        output_uri_prefix: str,
+        collection_ids: typing.List[str] = None
+) -> dict:
+    """Starts managed export of the database
+
+    :param session: authorized http session
+    :param project: GCP project ID
+    :param output_uri_prefix: GCS folder of the export (`gs://bucket/prefix`)
+    :param collection_ids: IDs of the exported collections, all collections are exported if not set
+    :return: long-running export operation
+    :raises requests.HTTPError: if the export was not accepted
+    """
+    body = {"outputUriPrefix": output_uri_prefix}
+    if collection_ids:
+        body["collectionIds"] = collection_ids
+    with span('firestore.export'):
+        response = session.post(
+            '{api}/projects/{project}/databases/(default):exportDocuments'.format(api=FIRESTORE_API, project=project),
+            json=body
+        )
+        response.raise_for_status()
+    return response.json()
+
+
+def get_operation(session: 'AuthorizedSession', name: str) -> dict:
+    """Reads the current state of the long-running operation
+
+    :param session: authorized http session
+    :param name: operation name (`projects/{project}/databases/(default)/operations/{id}`)
+    :return: long-running operation
+    """
+    with span('firestore.get_operation'):
+        response = session.get('{api}/{name}'.format(api=FIRESTORE_API, name=name))
+        response.raise_for_status()
+    return response.json()
+
+
+def operation_metrics(operation: dict) -> dict:
+    """Extracts progress of the export operation
+
+    :param operation: long-running export operation
+    :return: state, processed documents and bytes, duration (seconds) and rates of the export
+    """
+    metadata = operation.get('metadata', {})
+    started = parse_timestamp(metadata.get('startTime'))
+    finished = parse_timestamp(metadata.get('endTime'))
+    documents = int(metadata.get('progressDocuments', {}).get('completedWork', 0))
+    processed_bytes = int(metadata.get('progressBytes', {}).get('completedWork', 0))
+    duration = (finished - started).total_seconds() if started and finished else None
+    return {
+        'state': metadata.get('operationState'),
+        'done': operation.get('done', False),
+        'error': operation.get('error', {}).get('message'),
+        'start_time': metadata.get('startTime'),
+        'end_time': metadata.get('endTime'),
+        'documents': documents,
+        'bytes': processed_bytes,
+        'duration': duration,
+        'documents_per_second': documents / duration if duration else None,
+        'bytes_per_second': processed_bytes / duration if duration else None,
+    }
+
+
+def group_collections(weights: typing.Dict[str, float], groups: int) -> typing.List[typing.List[str]]:
+    """Splits collections to groups of similar total weight
+
+    Collections are assigned from the heaviest one to the currently lightest group (longest
+    processing time first), so the largest collections end up in groups of their own.
+
+    :param weights: collection IDs and their weights (e.g. number of documents)
+    :param groups: maximal number of groups
+    :return: non-empty groups of collection IDs, the heaviest group first
+    :raises ValueError: if the number of groups is less than 1
+    """
+    import heapq
+
+    if groups < 1:
+        raise ValueError('Number of export groups must be at least 1, got {}'.format(groups))
+    heap = [(0.0, index, []) for index in range(min(groups, len(weights)))]
+    for collection_id in sorted(weights, key=lambda collection: (-weights[collection], collection)):
+        load, index, group = heapq.heappop(heap)
+        group.append(collection_id)
+        heapq.heappush(heap, (load + weights[collection_id], index, group))
+    return [group for _, _, group in sorted(heap, key=lambda item: (-item[0], item[1]))]
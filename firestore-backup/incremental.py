@@ -0,0 +1,282 @@
+import datetime
+import gzip
+import heapq
+import io
+import json
+import logging
+import typing
+
+from calendar_common.instrumentation import span
+from codec import (
+    CHUNK_CONTENT_TYPE,
+    decode_value,
+    dumps_document,
+    dumps_tombstone,
+    encode_chunk,
+    encode_value,
+    open_chunk,
+)
+
+if typing.TYPE_CHECKING:
+    from google.cloud.firestore import Client
+    from google.cloud.storage import Bucket
+
+WATERMARK_BLOB = 'incremental/watermark.json'
+MANIFEST_BLOB = 'manifest.json'
+KEYS_BLOB = '{prefix}/keys/{collection}.txt.gz'
+
+
+def load_json(bucket: 'Bucket', name: str) -> typing.Optional[dict]:
+    """Downloads JSON object from the bucket
+
+    :return: JSON object or None if the object does not exist
+    """
+    with span('storage.download'):
+        blob = bucket.get_blob(name)
+        return json.loads(blob.download_as_string()) if blob else None
+
+
+def save_json(bucket: 'Bucket', name: str, value: dict, if_generation_match: int = None):
+    """Uploads JSON object to the bucket
+
+    :param if_generation_match: upload only if the object has this generation (0 if it must not exist)
+    :raises google.api_core.exceptions.PreconditionFailed: if the generation does not match
+    """
+    with span('storage.upload'):
+        bucket.blob(name).upload_from_string(
+            json.dumps(value, indent=2),
+            content_type='application/json',
+            if_generation_match=if_generation_match
+        )
+
+
+def load_watermark(bucket: 'Bucket') -> typing.Tuple[dict, int]:
+    """Downloads state of the incremental backups
+
+    The generation is passed to `save_json`, so the state is not overwritten if an incremental
+    backup or compaction replaced it meanwhile.
+
+    :return: state (empty before the first incremental backup) and generation of its object (0 if it does not exist)
+    """
+    with span('storage.download'):
+        blob = bucket.get_blob(WATERMARK_BLOB)
+        if blob is None:
+            return {}, 0
+        return json.loads(blob.download_as_string()), blob.generation
+
+
+def deleted_ids(previous: typing.Iterable[str], current: typing.Iterable[str]) -> typing.Iterator[str]:
+    """Yields IDs of the previous document index missing in the current one
+
+    Both indexes are sorted, so they are compared in one pass. The current index is always
+    consumed whole.
+
+    :param previous: sorted document IDs of the previous backup
+    :param current: sorted document IDs of the collection
+    :return: IDs of the deleted documents
+    """
+    current = iter(current)
+    live = next(current, None)
+    for document_id in previous:
+        while live is not None and live < document_id:
+            live = next(current, None)
+        if live != document_id:
+            yield document_id
+    for _ in current:
+        pass
+
+
+def merge_ids(*indexes: typing.Iterable[str]) -> typing.Iterator[str]:
+    """Merges sorted document ID indexes, dropping duplicates
+
+    :param indexes: sorted document IDs
+    :return: sorted unique document IDs
+    """
+    last = None
+    for document_id in heapq.merge(*indexes):
+        if document_id != last:
+            last = document_id
+            yield document_id
+
+
+def incremental_backup(
+        db: 'Client',
+        bucket: 'Bucket',
+        prefix: str,
+        collections: typing.List[str],
+        field: str = 'updated_at',
+        chunk_size: int = 10000,
+        lag: float = 0,
+        track_deletes: bool = False
+) -> dict:
+    """Backs up documents changed since the last incremental backup
+
+    Documents of each collection with `field` not less than the collection watermark are
+    streamed in the field order and written to gzip compressed NDJSON chunks under the prefix
+    (see `codec`). Documents with the watermark value which the previous run already exported
+    are skipped, the others with the same value may have been committed after the previous
+    run. Timestamps newer than `lag` seconds are left for the next run, so documents whose
+    field is set by the client before a late commit are not passed by the watermark. The last
+    exported value becomes the new watermark, which is saved only after all chunks and the run
+    manifest are written. Documents without the field are not backed up.
+
+    With `track_deletes`, IDs of all documents are listed (one read per document, projected
+    to the name) and compared with the ID index of the previous run and the IDs exported by
+    this run, deleted documents are written as tombstones after the changed documents and the
+    listed IDs become the new index. Runs without `track_deletes` only add the exported IDs to
+    the index (or start it with the first backup of the collection), so the next listing finds
+    deletes of documents created meanwhile. The index is written under the prefix and
+    referenced by the watermark. Deletes are tracked from the first run with the index, so the
+    first listing writes the index even if nothing changed.
+
+    :param db: firestore client
+    :param bucket: backup bucket
+    :param prefix: folder of the backup in the bucket
+    :param collections: IDs of the backed up root collections
+    :param field: document field holding the document update time
+    :param chunk_size: maximal number of documents in one chunk
+    :param lag: seconds for which timestamps are considered uncommitted
+    :param track_deletes: write tombstones of deleted documents
+    :return: backup manifest (`skipped` is True if there were no changes)
+    """
+    state, generation = load_watermark(bucket)
+    watermarks = dict(state.get('collections', {}))
+    boundaries = dict(state.get('boundary', {}))
+    keys = dict(state.get('keys', {}))
+    indexes = {}
+    manifest = {
+        'mode': 'incremental',
+        'prefix': prefix,
+        'field': field,
+        'base': state.get('prefix'),
+        'since': dict(watermarks),
+        # only the first run holds whole collections, the others hold changes since their base
+        'partial': state.get('prefix') is not None,
+        # deletes since the base are recorded as tombstones by this or a later listing, collections
+        # backed up for the first time have no deletes
+        'deletes_tracked': all(
+            collection_id in keys or collection_id not in watermarks for collection_id in collections
+        ),
+        'deletes_listed': track_deletes,
+        'collections': {},
+        'documents': 0,
+        'deleted': 0,
+        'bytes': 0,
+    }
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=lag)
+
+    for collection_id in collections:
+        # the first backup of a collection holds all its documents, so its IDs start the index
+        indexed = collection_id in keys or collection_id not in watermarks
+        query = db.collection(collection_id).order_by(field)
+        watermark = watermarks.get(collection_id)
+        exported = set(boundaries.get(collection_id, ()))
+        if watermark is not None:
+            query = query.where(field, '>=', decode_value(watermark, db))
+
+        chunks = []
+        documents = []
+        changed_ids = []
+        count = 0
+        deleted = 0
+
+        def flush():
+            name = '{prefix}/{collection}/{index:05d}.ndjson.gz'.format(
+                prefix=prefix,
+                collection=collection_id,
+                index=len(chunks)
+            )
+            data = encode_chunk(documents)
+            with span('storage.upload'):
+                bucket.blob(name).upload_from_string(data, content_type=CHUNK_CONTENT_TYPE)
+            chunks.append(name)
+            manifest['bytes'] += len(data)
+            documents.clear()
+
+        for doc in query.stream():
+            data = doc.to_dict()
+            value = data[field]
+            if isinstance(value, datetime.datetime):
+                if value.tzinfo is None:
+                    value = value.replace(tzinfo=datetime.timezone.utc)
+                if value > cutoff:
+                    break
+            encoded = encode_value(value)
+            if encoded == watermark and doc.reference.path in exported:
+                continue
+            if encoded != watermark:
+                watermark = encoded
+                exported = set()
+            exported.add(doc.reference.path)
+            changed_ids.append(doc.id)
+            documents.append((doc.reference.path, dumps_document(doc.reference.path, data)))
+            count += 1
+            if len(documents) >= chunk_size:
+                flush()
+        # tombstones go to their own chunks, so they follow documents deleted after the export
+        if documents:
+            flush()
+
+        if track_deletes or (indexed and changed_ids):
+            previous = ()
+            if collection_id in keys:
+                with span('storage.download'):
+                    previous = open_chunk(bucket.blob(keys[collection_id]).download_as_string())
+            # documents exported and deleted before the listing are in the index of no run
+            known_ids = merge_ids(previous, sorted(changed_ids))
+            buffer = io.BytesIO()
+            with gzip.GzipFile(fileobj=buffer, mode='wb') as writer:
+                def current_ids() -> typing.Iterator[str]:
+                    for snapshot in db.collection(collection_id).select([]).order_by('__name__').stream():
+                        writer.write(snapshot.id.encode('utf-8') + b'\n')
+                        yield snapshot.id
+
+                if track_deletes:
+                    for document_id in deleted_ids(known_ids, current_ids()):
+                        path = '{}/{}'.format(collection_id, document_id)
+                        documents.append((path, dumps_tombstone(path)))
+                        deleted += 1
+                        if len(documents) >= chunk_size:
+                            flush()
+                else:
+                    for document_id in known_ids:
+                        writer.write(document_id.encode('utf-8') + b'\n')
+            if documents:
+                flush()
+            indexes[collection_id] = buffer.getvalue()
+
+        if count:
+            watermarks[collection_id] = watermark
+            boundaries[collection_id] = sorted(exported)
+        if count or deleted:
+            manifest['collections'][collection_id] = {'documents': count, 'deleted': deleted, 'chunks': chunks}
+            manifest['documents'] += count
+            manifest['deleted'] += deleted
+
+    if not manifest['documents'] and not manifest['deleted'] and all(
+            collection_id in keys for collection_id in indexes):
+        manifest['skipped'] = True
+        return manifest
+
+    for collection_id, data in indexes.items():
+        name = KEYS_BLOB.format(prefix=prefix, collection=collection_id)
+        with span('storage.upload'):
+            bucket.blob(name).upload_from_string(data, content_type=CHUNK_CONTENT_TYPE)
+        keys[collection_id] = name
+    manifest['until'] = watermarks
+    save_json(bucket, '{}/{}'.format(prefix, MANIFEST_BLOB), manifest)
+    # fails if compaction replaced the base meanwhile, the next run exports the changes again
+    save_json(bucket, WATERMARK_BLOB, {
+        'prefix': prefix,
+        'collections': watermarks,
+        'boundary': boundaries,
+        'keys': keys
+    }, if_generation_match=generation)
+    logging.info({
+        "message": "Incremental backup written",
+        "prefix": prefix,
+        "documents": manifest['documents'],
+        "deleted": manifest['deleted'],
+        "bytes": manifest['bytes']
+    })
+    return manifest
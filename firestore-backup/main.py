@@ -1,44 +1,141 @@
 import datetime
+import json
 import logging
 import os
+import re
+import typing
 import uuid
+from functools import lru_cache
 
-import google.auth
-import requests
 from flask import Request
-from google.auth.transport.requests import AuthorizedSession
-from google.cloud import logging as cloud_logging
-from slack import WebClient
-
-# set up logging for nice logs
-log_client = cloud_logging.Client()
-log_handler = log_client.get_default_handler()
-cloud_logger = logging.getLogger("cloudLogger")
-cloud_logger.setLevel(logging.INFO)
-cloud_logger.addHandler(log_handler)
-
-# prepare slack client
+
+from calendar_common.clients import (
+    get_db,
+    setup_logging,
+)
+from calendar_common.instrumentation import (
+    span,
+    traced,
+)
+from calendar_common.notifications import SlackNotifier
+from compaction import compact_chain
+from exports import (
+    get_operation,
+    group_collections,
+    operation_metrics,
+    parse_timestamp,
+    start_export,
+)
+from incremental import (
+    incremental_backup,
+    load_json,
+    save_json,
+)
+
+if typing.TYPE_CHECKING:
+    from google.auth.transport.requests import AuthorizedSession
+    from google.cloud.firestore import Client
+    from google.cloud.storage import Bucket
+    from google.cloud.tasks import CloudTasksClient
+
+# Slack setup
 slack_api_token = os.getenv('SLACK_API_TOKEN')
 slack_channel = os.getenv("SLACK_CHANNEL")
-if not (slack_api_token and slack_channel):
-    slack_client = None
-else:
-    slack_client = WebClient(token=slack_api_token)
-
-# get credentials from the environment
-credentials, project = google.auth.default(
-    scopes=[
-        'https://www.googleapis.com/auth/datastore',
-        'https://www.googleapis.com/auth/cloud-platform'
-    ]
-)
+slack_flush_timeout = float(os.getenv('SLACK_FLUSH_TIMEOUT', 10))
+
+# Backup setup
+BACKUP_MODES = ('full', 'incremental', 'sharded')
+backup_mode = os.getenv('BACKUP_MODE', 'full')
+backup_collections = [collection for collection in os.getenv('BACKUP_COLLECTIONS', '').split(',') if collection]
+incremental_field = os.getenv('INCREMENTAL_FIELD', 'updated_at')
+incremental_chunk_size = int(os.getenv('INCREMENTAL_CHUNK_SIZE', 10000))
+incremental_lag = float(os.getenv('INCREMENTAL_LAG', 60))
+# listing document IDs reads the whole database, the `deletes=1` scheduler job lists them once a day
+incremental_track_deletes = os.getenv('INCREMENTAL_TRACK_DELETES', '0').lower() in ('1', 'true')
+# values below 1 would leave no group for the collections
+export_groups = max(1, int(os.getenv('EXPORT_GROUPS', 4)))
+collection_weights = json.loads(os.getenv('COLLECTION_WEIGHTS', '{}'))
+WEIGHTS_BLOB = 'sharded/weights.json'
+MANIFEST_BLOB = 'manifest.json'
+compaction_delete_merged = os.getenv('COMPACTION_DELETE_MERGED', '1').lower() in ('1', 'true')
+
+# Export tracking setup
+project_name = os.getenv('GCP_PROJECT')
+location = os.getenv('FUNCTION_REGION')
+check_queue = os.getenv('CHECK_QUEUE_NAME')
+check_url = os.getenv('CHECK_URL', 'https://{}-{}.cloudfunctions.net/check_backup'.format(location, project_name))
+service_account_email = os.getenv('SERVICE_ACCOUNT_EMAIL')
+CHECK_INTERVAL = int(os.getenv('CHECK_INTERVAL', 60))
+MAX_CHECK_INTERVAL = 10 * 60
+MAX_EXPORT_DURATION = datetime.timedelta(hours=24)
+RUN_BLOB = 'run.json'
+
+
+@lru_cache(maxsize=None)
+def get_notifier() -> typing.Optional[SlackNotifier]:
+    """Creates slack notifier on the first use
+
+    :return: slack notifier or None if slack is not configured
+    """
+    if not (slack_api_token and slack_channel):
+        return None
+    return SlackNotifier(slack_api_token, slack_channel)
+
+
+@lru_cache(maxsize=None)
+def get_authorized_session() -> 'AuthorizedSession':
+    """Loads credentials from the environment and creates authorized session on the first use
+
+    :return: authorized http session
+    """
+    import google.auth
+    from google.auth.transport.requests import AuthorizedSession
+
+    credentials, _ = google.auth.default(
+        scopes=[
+            'https://www.googleapis.com/auth/datastore',
+            'https://www.googleapis.com/auth/cloud-platform'
+        ]
+    )
+    return AuthorizedSession(credentials)
+
+
+@lru_cache(maxsize=None)
+def get_bucket(bucket_name: str) -> 'Bucket':
+    """Creates storage client on the first use
+
+    :param bucket_name: bucket name
+    :return: bucket
+    """
+    from google.cloud import storage
+
+    return storage.Client().bucket(bucket_name)
+
+
+@lru_cache(maxsize=None)
+def get_tasks_client() -> 'CloudTasksClient':
+    """Creates cloud tasks client on the first use
+
+    :return: cloud tasks client
+    """
+    from google.cloud import tasks
+
+    return tasks.CloudTasksClient()
 
 
+@traced('backup_firestore')
 def backup_firestore(request: Request):
     """Backs up firestore DB
 
+    Backup mode is given by the `mode` query parameter or the `BACKUP_MODE` variable:
+    - full: managed export of the whole database
+    - incremental: NDJSON export of documents changed since the last incremental backup, deleted
+      documents are listed if the `deletes` query parameter (or `INCREMENTAL_TRACK_DELETES`) is set
+    - sharded: parallel managed exports of collection groups of similar size
+
     :param request: flask Request
     """
+    setup_logging()
     bucket_name = os.getenv('BACKUP_BUCKET')
     if not bucket_name:
         logging.error({
@@ -51,35 +148,419 @@ def backup_firestore(request: Request):
         id=str(uuid.uuid4())[:8]
     )
 
-    # create backup
-    authorized_session = AuthorizedSession(credentials)
-    response: requests.Response = authorized_session.post(
-        'https://firestore.googleapis.com/v1beta1/projects/{project}/databases/(default):exportDocuments'.format(
-            project=os.getenv('GCP_PROJECT')
-        ),
-        json={
-            "outputUriPrefix": "gs://{bucket}/{prefix}".format(prefix=prefix, bucket=bucket_name),
-            # "collectionIds": ["breweries"]
+    mode = request.args.get('mode', backup_mode)
+    if mode not in BACKUP_MODES:
+        logging.error({
+            "message": "Failed to perform backup",
+            "reason": "Unknown backup mode {}".format(mode)
+        })
+        return
+    if mode == 'incremental':
+        deletes = request.args.get('deletes')
+        track_deletes = incremental_track_deletes if deletes is None else deletes.lower() in ('1', 'true')
+        backup_incremental(bucket_name, prefix, track_deletes)
+    elif mode == 'sharded':
+        backup_sharded(bucket_name, prefix)
+    else:
+        start_backup_run(bucket_name, prefix, 'full', [{}])
+
+
+def start_backup_run(bucket_name: str, prefix: str, mode: str, exports: typing.List[dict]):
+    """Starts export operations of the backup run
+
+    Operations are followed by `check_backup` until they finish.
+
+    :param bucket_name: backup bucket name
+    :param prefix: folder of the backup in the bucket
+    :param mode: backup mode
+    :param exports: exports with `collections` (all collections if not set) and `folder` inside the backup folder
+    """
+    session = get_authorized_session()
+    operations = []
+    for export in exports:
+        output_uri_prefix = "gs://{bucket}/{prefix}".format(
+            bucket=bucket_name,
+            prefix='/'.join(filter(None, [prefix, export.get('folder')]))
+        )
+        operation = {'output_uri_prefix': output_uri_prefix, 'collections': export.get('collections')}
+        if export.get('weights'):
+            operation['weights'] = export['weights']
+        try:
+            operation['name'] = start_export(session, project_name, output_uri_prefix, operation['collections'])['name']
+        except Exception as ex:
+            logging.error({
+                "message": "Firestore export failed to start",
+                "error": str(ex),
+                "output_uri_prefix": output_uri_prefix
+            })
+            operation.update(done=True, error=str(ex))
+        operations.append(operation)
+
+    if all(operation.get('error') for operation in operations):
+        notify("Backup of Firestore DB for *{project}* has failed. :sadparrot:".format(project=project_name))
+        return
+
+    logging.info({
+        "message": "Firestore export started",
+        "operations": [operation.get('name') for operation in operations],
+        "prefix": prefix
+    })
+    if not check_queue:
+        # export is not followed without the queue, the notification only confirms its start
+        notify("Backup of Firestore DB for *{project}* has started. :partyparrot:".format(project=project_name))
+        return
+
+    run = {
+        'mode': mode,
+        'prefix': prefix,
+        'started': datetime.datetime.utcnow().isoformat() + 'Z',
+        'operations': operations,
+    }
+    save_json(get_bucket(bucket_name), '{}/{}'.format(prefix, RUN_BLOB), run)
+    schedule_backup_check(prefix, 1)
+
+
+def backup_sharded(bucket_name: str, prefix: str):
+    """Exports groups of collections in parallel
+
+    The collection group IDs (including subcollections) are taken from `BACKUP_COLLECTIONS`, the
+    backup fails if a root collection or a sampled subcollection is not listed there. Collections
+    are grouped by their weights, which are taken from `COLLECTION_WEIGHTS` or
+    from document counts of the previous sharded backup (collections without a known weight
+    count as average ones). Each group is exported to its own `group-N` folder and the
+    manifest of the backup folder lists the groups.
+
+    :param bucket_name: backup bucket name
+    :param prefix: folder of the backup in the bucket
+    """
+    if not backup_collections:
+        # root collections listed by the client would leave subcollection groups out of the backup
+        logging.error({
+            "message": "Failed to perform backup",
+            "reason": "Sharded backup needs the collection groups in BACKUP_COLLECTIONS"
+        })
+        notify("Backup of Firestore DB for *{project}* has failed (no collection groups). :sadparrot:".format(
+            project=project_name
+        ))
+        return
+
+    with span('firestore.list_collections'):
+        uncovered = sorted(sample_collection_groups(get_db()) - set(backup_collections))
+    if uncovered:
+        logging.error({
+            "message": "Failed to perform backup",
+            "reason": "Collection groups missing in BACKUP_COLLECTIONS",
+            "collections": uncovered
+        })
+        notify("Backup of Firestore DB for *{project}* has failed, collection groups {collections} "
+               "are not backed up. :sadparrot:".format(project=project_name, collections=', '.join(uncovered)))
+        return
+
+    bucket = get_bucket(bucket_name)
+    collections = backup_collections
+    known_weights = {**(load_json(bucket, WEIGHTS_BLOB) or {}), **collection_weights}
+    default_weight = sum(known_weights.values()) / len(known_weights) if known_weights else 1
+    weights = {collection: known_weights.get(collection, default_weight) or 1 for collection in collections}
+
+    groups = group_collections(weights, export_groups)
+    exports = [
+        {
+            'folder': 'group-{}'.format(index),
+            'collections': group,
+            'weights': {collection: weights[collection] for collection in group},
         }
+        for index, group in enumerate(groups)
+    ]
+    save_json(bucket, '{}/{}'.format(prefix, MANIFEST_BLOB), {
+        'mode': 'sharded',
+        'prefix': prefix,
+        'groups': [
+            {
+                'collections': export['collections'],
+                'folder': '{}/{}'.format(prefix, export['folder']),
+                'weight': sum(export['weights'].values()),
+            }
+            for export in exports
+        ],
+    })
+    start_backup_run(bucket_name, prefix, 'sharded', exports)
+
+
+def sample_collection_groups(db: 'Client') -> typing.Set[str]:
+    """Lists IDs of root collections and of subcollections found under the first document of each collection
+
+    Listing subcollections of every document would read the whole database, so collection groups
+    whose collections are nested only under other documents are not found.
+
+    :param db: firestore client
+    :return: collection group IDs
+    """
+    groups = set()
+    pending = list(db.collections())
+    while pending:
+        collection = pending.pop()
+        if collection.id in groups:
+            continue
+        groups.add(collection.id)
+        # listed documents include the missing ones, which exist only as parents of subcollections
+        document = next(iter(collection.list_documents(page_size=1)), None)
+        if document is not None:
+            pending.extend(document.collections())
+    return groups
+
+
+def notify(message: str):
+    """Posts slack message and waits until it is delivered
+
+    :param message: message text
+    """
+    notifier = get_notifier()
+    if notifier:
+        notifier.notify(message)
+        # backup functions do not wait for the response, make sure the message is delivered
+        with span('slack.flush'):
+            notifier.flush(slack_flush_timeout)
+
+
+def schedule_backup_check(prefix: str, attempt: int):
+    """Creates cloud task calling `check_backup` after the check interval
+
+    Checks of a long export are postponed gradually up to `MAX_CHECK_INTERVAL`.
+
+    :param prefix: folder of the backup in the bucket
+    :param attempt: sequence number of the check
+    """
+    from google.api_core.exceptions import AlreadyExists
+    from google.protobuf.timestamp_pb2 import Timestamp
+
+    schedule_time = Timestamp()
+    schedule_time.FromDatetime(datetime.datetime.utcnow() + datetime.timedelta(
+        seconds=min(CHECK_INTERVAL * attempt, MAX_CHECK_INTERVAL)
+    ))
+    parent = 'projects/{project}/locations/{location}/queues/{queue}'.format(
+        project=project_name,
+        location=location,
+        queue=check_queue
     )
+    task = {
+        # named after the check, so retried checks do not schedule the next check twice
+        'name': '{parent}/tasks/{id}-{attempt}'.format(
+            parent=parent,
+            id=re.sub(r'[^A-Za-z0-9_-]', '_', prefix),
+            attempt=attempt
+        ),
+        'http_request': {
+            'http_method': 'POST',
+            'url': check_url,
+            'headers': {
+                "Content-Type": "application/json"
+            },
+            'oidc_token': {
+                'service_account_email': service_account_email
+            },
+            'body': json.dumps({'prefix': prefix, 'attempt': attempt}).encode()
+        },
+        'schedule_time': schedule_time
+    }
+    try:
+        with span('tasks.create_task'):
+            get_tasks_client().create_task(parent, task)
+    except AlreadyExists:
+        pass
+
+
+@traced('check_backup')
+def check_backup(request: Request):
+    """Checks export operations of the backup run
+
+    Called by cloud tasks scheduled by `backup_firestore`. Progress of unfinished operations
+    is stored in the run state (`run.json` in the backup folder) and the next check is
+    scheduled. Once all operations are done (or the export takes too long), the run state
+    is completed with duration, documents, bytes and rates and the result is notified.
+
+    :param request: flask Request
+    :returns: empty response + status code
+    """
+    setup_logging()
+    request_json = request.get_json(silent=True) or {}
+    prefix = request_json.get('prefix')
+    attempt = request_json.get('attempt', 1)
+    bucket = get_bucket(os.getenv('BACKUP_BUCKET'))
+    run_blob = '{}/{}'.format(prefix, RUN_BLOB)
+    run = load_json(bucket, run_blob) if prefix else None
+    if not run or run.get('finished'):
+        logging.warning({
+            "message": "Backup run not found or already finished",
+            "prefix": prefix
+        })
+        return '', 204
+
+    session = get_authorized_session()
+    for operation in run['operations']:
+        if not operation.get('done'):
+            operation.update(operation_metrics(get_operation(session, operation['name'])))
+
+    pending = [operation['name'] for operation in run['operations'] if not operation['done']]
+    started = datetime.datetime.fromisoformat(run['started'].rstrip('Z'))
+    timed_out = datetime.datetime.utcnow() - started > MAX_EXPORT_DURATION
+    if pending and not timed_out:
+        save_json(bucket, run_blob, run)
+        schedule_backup_check(prefix, attempt + 1)
+        return '', 204
+
+    run.update(run_metrics(run['operations']))
+    run['finished'] = datetime.datetime.utcnow().isoformat() + 'Z'
+    failed = pending or any(operation['error'] for operation in run['operations'])
+    run['status'] = 'failed' if failed else 'succeeded'
+    save_json(bucket, run_blob, run)
+    if run['mode'] == 'sharded' and not failed:
+        save_json(bucket, WEIGHTS_BLOB, measured_weights(run['operations']))
     logging.info({
         "message": "Firestore backup process finished",
-        "result": "success" if response.status_code == 200 else "failure",
-        "payload": response.text
+        "result": run['status'],
+        "prefix": prefix,
+        "pending_operations": pending,
+        "documents": run['documents'],
+        "bytes": run['bytes'],
+        "duration": run['duration'],
+        "documents_per_second": run['documents_per_second'],
+        "bytes_per_second": run['bytes_per_second']
     })
 
-    if slack_client:
-        if response.status_code == 200:
-            slack_client.chat_postMessage(
-                channel=slack_channel,
-                text="Firestore DB for *{project}* has been backed up. :partyparrot:".format(
-                    project=os.getenv('GCP_PROJECT')
-                )
-            )
-        else:
-            slack_client.chat_postMessage(
-                channel=slack_channel,
-                text="Backup of Firestore DB for *{project}* has failed. :sadparrot:".format(
-                    project=os.getenv('GCP_PROJECT')
-                )
-            )
+    if run['status'] == 'succeeded':
+        notify("Firestore DB for *{project}* has been backed up: {documents} documents, {size:.1f} MiB "
+               "in {duration:.0f}s ({rate:.0f} documents/s). :partyparrot:".format(
+                   project=project_name,
+                   documents=run['documents'],
+                   size=run['bytes'] / 2 ** 20,
+                   duration=run['duration'] or 0,
+                   rate=run['documents_per_second'] or 0
+               ))
+    else:
+        notify("Backup of Firestore DB for *{project}* has failed{reason}. :sadparrot:".format(
+            project=project_name,
+            reason=' (timed out)' if pending else ''
+        ))
+    return '', 204
+
+
+def measured_weights(operations: typing.List[dict]) -> typing.Dict[str, float]:
+    """Estimates numbers of documents of collections from the exported documents of their groups
+
+    Documents of a group are divided among its collections in the ratio of their previous weights.
+
+    :param operations: finished export operations of collection groups
+    :return: collection IDs and their weights
+    """
+    weights = {}
+    for operation in operations:
+        group_weights = operation.get('weights') or {collection: 1 for collection in operation['collections']}
+        total = sum(group_weights.values()) or 1
+        for collection, weight in group_weights.items():
+            weights[collection] = operation['documents'] * weight / total
+    return weights
+
+
+def run_metrics(operations: typing.List[dict]) -> dict:
+    """Sums up metrics of the run export operations
+
+    :param operations: export operations with their metrics (see `operation_metrics`)
+    :return: documents, bytes, duration (seconds, from the first start to the last end) and rates
+    """
+    documents = sum(operation.get('documents', 0) for operation in operations)
+    processed_bytes = sum(operation.get('bytes', 0) for operation in operations)
+    start_times = [parse_timestamp(operation.get('start_time')) for operation in operations]
+    end_times = [parse_timestamp(operation.get('end_time')) for operation in operations]
+    start_times = [timestamp for timestamp in start_times if timestamp]
+    end_times = [timestamp for timestamp in end_times if timestamp]
+    duration = (max(end_times) - min(start_times)).total_seconds() if start_times and end_times else None
+    return {
+        'documents': documents,
+        'bytes': processed_bytes,
+        'duration': duration,
+        'documents_per_second': documents / duration if duration else None,
+        'bytes_per_second': processed_bytes / duration if duration else None,
+    }
+
+
+@traced('compact_backups')
+def compact_backups(request: Request):
+    """Merges the last snapshot and following incremental backups to a new snapshot
+
+    :param request: flask Request
+    """
+    setup_logging()
+    prefix = "{timestamp}C{id}".format(
+        timestamp=datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
+        id=str(uuid.uuid4())[:8]
+    )
+    try:
+        manifest = compact_chain(
+            get_bucket(os.getenv('BACKUP_BUCKET')),
+            prefix,
+            chunk_size=incremental_chunk_size,
+            delete_merged=compaction_delete_merged
+        )
+    except Exception as ex:
+        logging.exception({
+            "message": "Backup compaction failed",
+            "error": str(ex)
+        })
+        notify("Compaction of Firestore backups for *{project}* has failed. :sadparrot:".format(
+            project=project_name
+        ))
+        return '', 500
+
+    if manifest.get('skipped'):
+        logging.info({
+            "message": "Backup compaction skipped, no incremental backups since the last snapshot"
+        })
+    return '', 204
+
+
+def backup_incremental(bucket_name: str, prefix: str, track_deletes: bool):
+    """Backs up documents changed since the last incremental backup
+
+    :param bucket_name: backup bucket name
+    :param prefix: folder of the backup in the bucket
+    :param track_deletes: list document IDs and write tombstones of deleted documents
+    """
+    db = get_db()
+    with span('firestore.list_collections'):
+        collections = backup_collections or [collection.id for collection in db.collections()]
+    try:
+        manifest = incremental_backup(
+            db,
+            get_bucket(bucket_name),
+            prefix,
+            collections,
+            field=incremental_field,
+            chunk_size=incremental_chunk_size,
+            lag=incremental_lag,
+            track_deletes=track_deletes
+        )
+    except Exception as ex:
+        logging.exception({
+            "message": "Incremental backup failed",
+            "error": str(ex)
+        })
+        manifest = None
+
+    if manifest and manifest.get('skipped'):
+        logging.info({
+            "message": "Incremental backup skipped, no documents changed",
+            "collections": collections
+        })
+        return
+
+    if manifest:
+        notify("Incremental backup of *{project}*: {documents} changed and {deleted} deleted documents. "
+               ":partyparrot:".format(
+            project=project_name,
+            documents=manifest['documents'],
+            deleted=manifest['deleted']
+        ))
+    else:
+        notify("Incremental backup of Firestore DB for *{project}* has failed. :sadparrot:".format(
+            project=project_name
+        ))
@@ -0,0 +1,188 @@
+"""Helpers of the bulk firestore scripts"""
+import logging
+import threading
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+if typing.TYPE_CHECKING:
+    from google.cloud.firestore import (
+        Client,
+        DocumentReference,
+    )
+
+# maximal number of writes in one firestore commit
+MAX_BATCH_SIZE = 500
+
+Write = typing.Tuple[str, 'DocumentReference', typing.Optional[dict]]
+
+
+def get_client() -> 'Client':
+    """Initializes firebase app and firestore client
+
+    :return: firestore client
+    """
+    from firebase_admin import (
+        firestore,
+        initialize_app,
+    )
+
+    return firestore.client(initialize_app())
+
+
+class BatchWriter:
+    """Commits write batches from a pool of worker threads
+
+    At most `max_in_flight` batches are queued or being committed, `submit` blocks until
+    one of them is committed, so a fast producer is slowed down to the commit rate instead
+    of buffering the whole input in memory. Batches failing with a transient error are
+    retried with exponential backoff. The first permanent failure stops the writer and is
+    raised from the next `submit` or `close`.
+    """
+
+    def __init__(
+            self,
+            client: 'Client',
+            workers: int = 8,
+            max_in_flight: int = None,
+            max_attempts: int = 5,
+            on_commit: typing.Callable[[typing.Any, int], typing.Any] = None
+    ):
+        """
+        :param client: firestore client
+        :param workers: number of concurrently committed batches
+        :param max_in_flight: maximal number of submitted and not yet committed batches (twice the workers by default)
+        :param max_attempts: maximal number of attempts to commit one batch
+        :param on_commit: function called with the batch token and number of writes after each commit
+        """
+        self.client = client
+        self.max_attempts = max_attempts
+        self.on_commit = on_commit
+        self._slots = threading.BoundedSemaphore(max_in_flight or workers * 2)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='batch-writer')
+        self._error: typing.Optional[Exception] = None
+
+    def submit(self, writes: typing.List[Write], token: typing.Any = None):
+        """Queues batch of writes for commit, blocks while too many batches are in flight
+
+        :param writes: (operation, document reference, data) tuples, operation is one of set, update or delete
+        :param token: value passed to the `on_commit` function (e.g. position in the input)
+        :raises Exception: first error of a failed commit
+        """
+        if len(writes) > MAX_BATCH_SIZE:
+            raise ValueError('Batch can contain at most {} writes'.format(MAX_BATCH_SIZE))
+        self._slots.acquire()
+        if self._error:
+            self._slots.release()
+            raise self._error
+        self._executor.submit(self._commit, writes, token)
+
+    def close(self):
+        """Waits for all submitted batches
+
+        :raises Exception: first error of a failed commit
+        """
+        self._executor.shutdown(wait=True)
+        if self._error:
+            raise self._error
+
+    def _commit(self, writes: typing.List[Write], token: typing.Any):
+        from google.api_core.exceptions import (
+            Aborted,
+            DeadlineExceeded,
+            InternalServerError,
+            ResourceExhausted,
+            ServiceUnavailable,
+        )
+
+        try:
+            for attempt in range(1, self.max_attempts + 1):
+                batch = self.client.batch()
+                for operation, reference, data in writes:
+                    if operation == 'delete':
+                        batch.delete(reference)
+                    else:
+                        getattr(batch, operation)(reference, data)
+                try:
+                    batch.commit()
+                    break
+                except (Aborted, DeadlineExceeded, InternalServerError, ResourceExhausted, ServiceUnavailable) as ex:
+                    if attempt == self.max_attempts:
+                        raise
+                    logging.warning('Batch commit failed ({}), retrying'.format(ex))
+                    time.sleep(min(2 ** attempt * 0.5, 30))
+            if self.on_commit:
+                self.on_commit(token, len(writes))
+        except Exception as ex:
+            self._error = self._error or ex
+        finally:
+            self._slots.release()
+
+
+class Progress:
+    """Prints number of processed documents and throughput at most once per interval"""
+
+    def __init__(self, interval: float = 5.0, total: int = None):
+        """
+        :param interval: minimal number of seconds between two reports
+        :param total: expected number of documents, if known
+        """
+        self.interval = interval
+        self.total = total
+        self.count = 0
+        self.started = time.monotonic()
+        self._reported = self.started
+        self._lock = threading.Lock()
+
+    def add(self, count: int):
+        with self._lock:
+            self.count += count
+            now = time.monotonic()
+            if now - self._reported >= self.interval:
+                self._reported = now
+                self.report()
+
+    @property
+    def rate(self) -> float:
+        elapsed = time.monotonic() - self.started
+        return self.count / elapsed if elapsed else 0.0
+
+    def report(self, prefix: str = ''):
+        print('{}{}{} documents, {:.0f} documents/s, {:.0f}s elapsed'.format(
+            prefix,
+            self.count,
+            '/{}'.format(self.total) if self.total else '',
+            self.rate,
+            time.monotonic() - self.started
+        ))
+
+
+class RateLimiter:
+    """Token bucket limiting the number of operations per second"""
+
+    def __init__(self, rate: typing.Optional[float], burst: float = None):
+        """
+        :param rate: operations per second, no limit if not set
+        :param burst: maximal number of operations taken at once (one second worth of operations by default)
+        """
+        self.rate = rate
+        self.burst = burst or rate
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, count: int = 1):
+        """Blocks until count operations are allowed
+
+        :param count: number of operations
+        """
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= count
+            wait = -self._tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
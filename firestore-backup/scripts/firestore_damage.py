@@ -1,12 +1,34 @@
-from firebase_admin import (
-    firestore,
-    initialize_app,
+"""Damages all breweries by renaming them to `flowup`
+
+    python firestore_damage.py [--dry-run] [--rate 500]
+"""
+import argparse
+
+from bulk import get_client
+from firestore_update import (
+    UUID_ALPHABET,
+    update_collection,
 )
 
-app = initialize_app()
-fs_client = firestore.client(app=app)
 
-for doc in fs_client.collection('breweries').stream():
-    doc.reference.update({
-        'name': 'flowup'
-    })
+def damage(data: dict) -> dict:
+    return {'name': 'flowup'}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rate', type=float, help='maximal number of updated documents per second')
+    parser.add_argument('--dry-run', action='store_true', help='report updates without writing them')
+    args = parser.parse_args()
+    update_collection(
+        get_client(),
+        'breweries',
+        damage,
+        alphabet=UUID_ALPHABET,
+        rate=args.rate,
+        dry_run=args.dry_run
+    )
+
+
+if __name__ == '__main__':
+    main()
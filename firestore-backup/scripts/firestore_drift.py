@@ -0,0 +1,234 @@
+"""Finds documents of a collection which differ from a backup snapshot and restores them
+
+    python firestore_drift.py diff COLLECTION SNAPSHOT
+    python firestore_drift.py restore COLLECTION SNAPSHOT [--workers 8] [--delete-extra] [--dry-run]
+
+SNAPSHOT is a folder (local or `gs://bucket/folder`) with NDJSON chunks written by incremental
+backups or compaction. It must be a full snapshot of the collection, documents missing in it are
+reported as extra documents. `--delete-extra` is refused for snapshots whose `manifest.json` marks
+them partial (incremental backups and snapshots which may keep deleted documents).
+
+The live collection is streamed in the document ID order and joined with the snapshot chunks,
+which are sorted by the document path and merged on the fly, so both sides are read once and
+memory use does not depend on the collection size. Every live document is still read, the tool
+saves the import of the whole backup, not the reads. Restore writes back only changed and missing
+documents in parallel batches while the collection is compared.
+"""
+import argparse
+import json
+import os
+import sys
+import typing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bulk import (  # noqa: E402
+    MAX_BATCH_SIZE,
+    BatchWriter,
+    Progress,
+    get_client,
+)
+from codec import (  # noqa: E402
+    decode_value,
+    dumps_document,
+    iter_chunk,
+    loads_document,
+    merge_chunks,
+)
+
+if typing.TYPE_CHECKING:
+    from google.cloud.firestore import Client
+
+def snapshot_chunks(snapshot: str) -> typing.Iterator[typing.Iterator[str]]:
+    """Iterates over chunks of the snapshot folder in the order they were written
+
+    :param snapshot: local folder or `gs://bucket/folder`
+    :return: NDJSON lines of every chunk
+    """
+    def read(open_stream: typing.Callable[[], typing.BinaryIO]) -> typing.Iterator[str]:
+        with open_stream() as stream:
+            yield from iter_chunk(stream)
+
+    if snapshot.startswith('gs://'):
+        from google.cloud import storage
+
+        bucket_name, _, prefix = snapshot[len('gs://'):].partition('/')
+        bucket = storage.Client().bucket(bucket_name)
+        for blob in bucket.list_blobs(prefix=prefix.rstrip('/') + '/'):
+            if blob.name.endswith('.ndjson.gz'):
+                yield read(lambda blob=blob: download(blob))
+        return
+
+    for directory, _, files in sorted(os.walk(snapshot)):
+        for name in sorted(files):
+            if name.endswith('.ndjson.gz'):
+                yield read(lambda path=os.path.join(directory, name): open(path, 'rb'))
+
+
+def load_manifest(snapshot: str) -> typing.Optional[dict]:
+    """Reads manifest of the snapshot folder
+
+    :param snapshot: local folder or `gs://bucket/folder`
+    :return: manifest or None if the folder has none
+    """
+    if snapshot.startswith('gs://'):
+        from google.cloud import storage
+
+        bucket_name, _, prefix = snapshot[len('gs://'):].partition('/')
+        blob = storage.Client().bucket(bucket_name).get_blob(prefix.rstrip('/') + '/manifest.json')
+        return json.loads(blob.download_as_string()) if blob else None
+
+    path = os.path.join(snapshot, 'manifest.json')
+    if not os.path.exists(path):
+        return None
+    with open(path) as stream:
+        return json.load(stream)
+
+
+def download(blob) -> typing.BinaryIO:
+    """Downloads chunk blob to a temporary file"""
+    import tempfile
+
+    stream = tempfile.TemporaryFile()
+    blob.download_to_file(stream)
+    stream.seek(0)
+    return stream
+
+
+def snapshot_documents(snapshot: str, collection: str) -> typing.Iterator[typing.Tuple[str, str]]:
+    """Iterates over documents of the collection in the snapshot
+
+    Chunks are merged by the document path, so the newest version of every document is returned
+    once and deleted documents are left out.
+
+    :return: document IDs and their lines in the ID order
+    """
+    prefix = collection + '/'
+    for path, line in merge_chunks(list(snapshot_chunks(snapshot))):
+        if path.startswith(prefix) and '/' not in path[len(prefix):]:
+            yield path[len(prefix):], line
+
+
+def live_documents(client: 'Client', collection: str) -> typing.Iterator[typing.Tuple[str, str]]:
+    """Iterates over documents of the live collection
+
+    :return: document IDs and their lines in the ID order
+    """
+    progress = Progress()
+    for doc in client.collection(collection).order_by('__name__').stream():
+        yield doc.id, dumps_document(doc.reference.path, doc.to_dict())
+        progress.add(1)
+    progress.report('read live collection, ')
+
+
+def diff_documents(
+        actual: typing.Iterator[typing.Tuple[str, str]],
+        expected: typing.Iterator[typing.Tuple[str, str]]
+) -> typing.Iterator[typing.Tuple[str, str, typing.Optional[str]]]:
+    """Joins two document streams sorted by ID
+
+    :param actual: live documents
+    :param expected: snapshot documents
+    :return: kind of the difference (`changed`, `missing` or `extra`), document ID and the snapshot line
+    """
+    actual = iter(actual)
+    expected = iter(expected)
+    live = next(actual, None)
+    backup = next(expected, None)
+    while live is not None or backup is not None:
+        if backup is None or (live is not None and live[0] < backup[0]):
+            yield 'extra', live[0], None
+            live = next(actual, None)
+        elif live is None or backup[0] < live[0]:
+            yield 'missing', backup[0], backup[1]
+            backup = next(expected, None)
+        else:
+            if live[1] != backup[1]:
+                yield 'changed', backup[0], backup[1]
+            live = next(actual, None)
+            backup = next(expected, None)
+
+
+def compare(client: 'Client', args) -> typing.Iterator[typing.Tuple[str, str, typing.Optional[str]]]:
+    """Yields differences of the collection and the snapshot and reports them once the collection is compared"""
+    counts = {'changed': 0, 'missing': 0, 'extra': 0}
+    shown = {kind: [] for kind in counts}
+    for kind, document_id, line in diff_documents(
+            live_documents(client, args.collection),
+            snapshot_documents(args.snapshot, args.collection)
+    ):
+        counts[kind] += 1
+        if len(shown[kind]) < args.show:
+            shown[kind].append(document_id)
+        yield kind, document_id, line
+    for kind, count in counts.items():
+        print('{} {} documents'.format(count, kind))
+        for document_id in shown[kind]:
+            print('  {}'.format(document_id))
+
+
+def diff(args):
+    for _ in compare(get_client(), args):
+        pass
+
+
+def restore(args):
+    client = get_client()
+    differences = compare(client, args)
+    if args.dry_run:
+        for _ in differences:
+            pass
+        return
+
+    collection = client.collection(args.collection)
+    progress = Progress()
+    writer = BatchWriter(client, workers=args.workers, on_commit=lambda token, count: progress.add(count))
+    try:
+        writes = []
+        for kind, document_id, line in differences:
+            if kind == 'extra':
+                if not args.delete_extra:
+                    continue
+                writes.append(('delete', collection.document(document_id), None))
+            else:
+                _, data = loads_document(line)
+                writes.append(('set', collection.document(document_id), decode_value(data, client)))
+            if len(writes) == MAX_BATCH_SIZE:
+                writer.submit(writes)
+                writes = []
+        if writes:
+            writer.submit(writes)
+    finally:
+        writer.close()
+    progress.report('restored ')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    for name, handler, help_text in (
+            ('diff', diff, 'report documents which differ from the snapshot'),
+            ('restore', restore, 'restore documents which differ from the snapshot'),
+    ):
+        subparser = subparsers.add_parser(name, help=help_text)
+        subparser.add_argument('collection', help='collection path')
+        subparser.add_argument('snapshot', help='snapshot folder, local or gs://bucket/folder')
+        subparser.add_argument('--show', type=int, default=10, help='number of listed documents of each kind')
+        subparser.set_defaults(handler=handler)
+        if name == 'restore':
+            subparser.add_argument('--workers', type=int, default=8, help='number of concurrently committed batches')
+            subparser.add_argument('--delete-extra', action='store_true',
+                                   help='delete documents missing in the snapshot')
+            subparser.add_argument('--dry-run', action='store_true', help='only report the differences')
+
+    args = parser.parse_args()
+    if getattr(args, 'delete_extra', False) and (load_manifest(args.snapshot) or {}).get('partial'):
+        parser.error('snapshot {} is partial, documents missing in it may exist, --delete-extra would delete '
+                     'them'.format(args.snapshot))
+    args.handler(args)
+
+
+if __name__ == '__main__':
+    main()
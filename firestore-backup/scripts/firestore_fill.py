@@ -1,316 +1,211 @@
+"""Loads documents into a firestore collection
+
+    python firestore_fill.py [SOURCE] [--collection breweries] [--workers 8] [--batch-size 500]
+                             [--checkpoint fill.checkpoint] [--id-field id]
+
+SOURCE is an NDJSON (`.ndjson`, `.jsonl`, optionally gzipped) or CSV file, or `synthetic:COUNT`
+for COUNT generated breweries (`--seed` makes them reproducible). Sample breweries in
+`data/breweries.ndjson` are loaded by default.
+
+Records are streamed from the source and written in batches by parallel workers. Only a limited
+number of batches is in flight, so reading the source is paced by the writes. With `--checkpoint`
+the position of the last record whose batch and all preceding batches are committed is saved,
+and a later run with the same checkpoint continues after it.
+
+Document IDs are read from `--id-field`. Records without it get an ID derived from the source and
+record position, so repeated or resumed runs overwrite documents instead of duplicating them.
+"""
+import argparse
+import csv
+import gzip
+import io
+import itertools
+import json
+import os
+import random
+import threading
+import time
+import typing
 import uuid
-from firebase_admin import (
-    firestore,
-    initialize_app,
+
+from bulk import (
+    MAX_BATCH_SIZE,
+    BatchWriter,
+    Progress,
+    get_client,
 )
 
-app = initialize_app()
-fs_client = firestore.client(app=app)
-
-data = [
-    {
-        "id": str(uuid.uuid4()),
-        "name": "Avondale Brewing Co",
-        "brewery_type": "micro",
-        "street": "201 41st St S",
-        "city": "Birmingham",
-        "state": "Alabama",
-        "postal_code": "35222-1932",
-        "country": "United States",
-        "longitude": "-86.774322",
-        "latitude": "33.524521",
-        "phone": "2057775456",
-        "website_url": "http://www.avondalebrewing.com",
-        "updated_at": "2018-08-23T23:19:57.825Z",
-        "tag_list": []
-    }, {
-        "id": str(uuid.uuid4()),
-        "name": "Trim Tab Brewing",
-        "brewery_type": "micro",
-        "street": "2721 5th Ave S",
-        "city": "Birmingham",
-        "state": "Alabama",
-        "postal_code": "35233-3401",
-        "country": "United States",
-        "longitude": "-86.7914000624146",
-        "latitude": "33.5128492349817",
-        "phone": "2057030536",
-        "website_url": "http://www.trimtabbrewing.com",
-        "updated_at": "2018-08-23T23:20:31.423Z",
-        "tag_list": []
-    }, {
-        "id": str(uuid.uuid4()),
-        "name": "Yellowhammer Brewery",
-        "brewery_type": "micro",
-        "street": "2600 Clinton Ave W",
-        "city": "Huntsville",
-        "state": "Alabama",
-        "postal_code": "35805-3046",
-        "country": "United States",
-        "longitude": "-86.5932014",
-        "latitude": "34.7277523",
-        "phone": "2569755950",
-        "website_url": "http://www.yellowhammerbrewery.com",
-        "updated_at": "2018-08-23T23:20:33.102Z",
-        "tag_list": []
-    }, {
-        "id": str(uuid.uuid4()),
-        "name": "Bearpaw River Brewing Co",
-        "brewery_type": "micro",
-        "street": "4605 E Palmer Wasilla Hwy",
-        "city": "Wasilla",
-        "state": "Alaska",
-        "postal_code": "99654-7679",
-        "country": "United States",
-        "longitude": "-149.4127103",
-        "latitude": "61.5752695",
-        "phone": "",
-        "website_url": "http://bearpawriverbrewing.com",
-        "updated_at": "2018-08-23T23:20:40.743Z",
-        "tag_list": []
-    }, {
-        "id": str(uuid.uuid4()),
-        "name": "King Street Brewing Co",
-        "brewery_type": "micro",
-        "street": "9050 King Street",
-        "city": "Anchorage",
-        "state": "Alaska",
-        "postal_code": "99515",
-        "country": "United States",
-        "longitude": "-149.879076042937",
-        "latitude": "61.1384893547315",
-        "phone": "9073365464",
-        "website_url": "http://www.kingstreetbrewing.com",
-        "updated_at": "2018-08-23T23:20:57.179Z",
-        "tag_list": []
-    }, {
-        "id": str(uuid.uuid4()),
-        "name": "1912 Brewing",
-        "brewery_type": "micro",
-        "street": "2045 N Forbes Blvd Ste 105",
-        "city": "Tucson",
-        "state": "Arizona",
-        "postal_code": "85745-1444",
-        "country": "United States",
-        "longitude": "-110.992750525872",
-        "latitude": "32.2467372722906",
-        "phone": "5202564851",
-        "website_url": "http://www.1912brewing.com",
-        "updated_at": "2018-08-23T23:21:11.302Z",
-        "tag_list": []
-    }, {
-        "id": str(uuid.uuid4()),
-        "name": "Bad Water Brewing",
-        "brewery_type": "contract",
-        "street": "4216 N Brown Ave",
-        "city": "Scottsdale",
-        "state": "Arizona",
-        "postal_code": "85251-3914",
-        "country": "United States",
-        "longitude": "-111.924474347826",
-        "latitude": "33.4972615652174",
-        "phone": "5207459175",
-        "website_url": "http://www.badwaterbrewing.com",
-        "updated_at": "2018-08-23T23:21:15.169Z",
-        "tag_list": []
-    }, {
-        "id": str(uuid.uuid4()),
-        "name": "BJs Restaurant \u0026 Brewery - Chandler",
-        "brewery_type": "brewpub",
-        "street": "3155 W Chandler Blvd",
-        "city": "Chandler",
-        "state": "Arizona",
-        "postal_code": "85226-5175",
-        "country": "United States",
-        "longitude": "-111.911126",
-        "latitude": "33.3053455",
-        "phone": "4809170631",
-        "website_url": "http://www.bjsrestaurants.com",
-        "updated_at": "2018-08-23T23:21:21.165Z",
-        "tag_list": []
-    }, {
-        "id": str(uuid.uuid4()),
-        "name": "BlackRock Brewers",
-        "brewery_type": "micro",
-        "street": "1664 S Research Loop Ste 200",
-        "city": "Tucson",
-        "state": "Arizona",
-        "postal_code": "85710-6767",
-        "country": "United States",
-        "longitude": "-110.821778571134",
-        "latitude": "32.201608314954",
-        "phone": "5202073203",
-        "website_url": "http://www.brb.beer",
-        "updated_at": "2018-08-23T23:21:23.794Z",
-        "tag_list": []
-    }, {
-        "id": str(uuid.uuid4()),
-        "name": "Dragoon Brewing Co",
-        "brewery_type": "micro",
-        "street": "1859 W Grant Rd Ste 111",
-        "city": "Tucson",
-        "state": "Arizona",
-        "postal_code": "85745-1214",
-        "country": "United States",
-        "longitude": "-111.005452051979",
-        "latitude": "32.2504946147872",
-        "phone": "5203293606",
-        "website_url": "http://www.dragoonbrewing.com",
-        "updated_at": "2018-08-23T23:21:40.563Z",
-        "tag_list": []
-    }, {
-        "id": str(uuid.uuid4()),
-        "name": "Grand Canyon Brewing Company",
-        "brewery_type": "micro",
-        "street": "233 W Route 66",
-        "city": "Williams",
-        "state": "Arizona",
-        "postal_code": "86046-2530",
-        "country": "United States",
-        "longitude": "-112.1892168",
-        "latitude": "35.2500282",
-        "phone": "8005132072",
-        "website_url": "http://www.grandcanyonbrewingco.com",
-        "updated_at": "2018-08-23T23:21:53.397Z",
-        "tag_list": []
-    }, {
-        "id": str(uuid.uuid4()),
-        "name": "Mudshark Brewing Co",
-        "brewery_type": "micro",
-        "street": "210 Swanson Ave",
-        "city": "Lake Havasu City",
-        "state": "Arizona",
-        "postal_code": "86403-0966",
-        "country": "United States",
-        "longitude": "-114.342433477881",
-        "latitude": "34.4689736300844",
-        "phone": "9284532981",
-        "website_url": "http://www.mudsharkbrewingco.com",
-        "updated_at": "2018-08-23T23:22:12.542Z",
-        "tag_list": []
-    }, {
-        "id": str(uuid.uuid4()),
-        "name": "Richter Aleworks",
-        "brewery_type": "micro",
-        "street": "8279 W Lake Pleasant Pkwy Ste 110",
-        "city": "Peoria",
-        "state": "Arizona",
-        "postal_code": "85382-7434",
-        "country": "United States",
-        "longitude": "-112.238054093359",
-        "latitude": "33.6687744976834",
-        "phone": "6029086553",
-        "website_url": "http://www.richteraleworks.com",
-        "updated_at": "2018-08-23T23:22:29.385Z",
-        "tag_list": []
-    }, {
-        "id": str(uuid.uuid4()),
-        "name": "SanTan Brewing Co",
-        "brewery_type": "regional",
-        "street": "8 S San Marcos Pl",
-        "city": "Chandler",
-        "state": "Arizona",
-        "postal_code": "85225-7862",
-        "country": "United States",
-        "longitude": "-111.8423459",
-        "latitude": "33.3032436",
-        "phone": "4809178700",
-        "website_url": "http://www.santanbrewing.com",
-        "updated_at": "2018-08-23T23:22:33.482Z",
-        "tag_list": []
-    }, {
-        "id": str(uuid.uuid4()),
-        "name": "State 48 Brewery",
-        "brewery_type": "brewpub",
-        "street": "13823 W Bell Rd",
-        "city": "Surprise",
-        "state": "Arizona",
-        "postal_code": "85374-3873",
-        "country": "United States",
-        "longitude": "-112.357813820157",
-        "latitude": "33.63822125",
-        "phone": "6235841095",
-        "website_url": "",
-        "updated_at": "2018-08-23T23:22:41.468Z",
-        "tag_list": []
-    }, {
-        "id": str(uuid.uuid4()),
-        "name": "Wren House Brewing Company",
-        "brewery_type": "micro",
-        "street": "2125 N 24th St",
-        "city": "Phoenix",
-        "state": "Arizona",
-        "postal_code": "85008-2713",
-        "country": "United States",
-        "longitude": "-112.0301125",
-        "latitude": "33.516633",
-        "phone": "6022449184",
-        "website_url": "http://www.wrenhousebrewing.com",
-        "updated_at": "2018-08-23T23:22:59.255Z",
-        "tag_list": []
-    }, {
-        "id": str(uuid.uuid4()),
-        "name": "Brick Oven Pizza Co / Brick \u0026 Forge Brewing",
-        "brewery_type": "brewpub",
-        "street": "2410 Linwood Dr",
-        "city": "Paragould",
-        "state": "Arkansas",
-        "postal_code": "72450-6122",
-        "country": "United States",
-        "longitude": "-90.5204797204622",
-        "latitude": "36.0316358142169",
-        "phone": "8702364200",
-        "website_url": "http://www.brickovenpizzacompany.com",
-        "updated_at": "2018-08-23T23:23:05.438Z",
-        "tag_list": []
-    }, {
-        "id": str(uuid.uuid4()),
-        "name": "Diamond Bear Brewing Co",
-        "brewery_type": "micro",
-        "street": "600 N Broadway St",
-        "city": "North Little Rock",
-        "state": "Arkansas",
-        "postal_code": "72114-5381",
-        "country": "United States",
-        "longitude": "-92.2726892120821",
-        "latitude": "34.7594277548278",
-        "phone": "5017082739",
-        "website_url": "http://www.diamondbear.com",
-        "updated_at": "2018-08-23T23:23:14.931Z",
-        "tag_list": []
-    }, {
-        "id": str(uuid.uuid4()),
-        "name": "Lost Forty Brewing",
-        "brewery_type": "micro",
-        "street": "501 Byrd St",
-        "city": "Little Rock",
-        "state": "Arkansas",
-        "postal_code": "72202",
-        "country": "United States",
-        "longitude": "-92.260019",
-        "latitude": "34.742845",
-        "phone": "5013197275",
-        "website_url": "http://www.lost40brewing.com/",
-        "updated_at": "2018-08-23T23:23:24.018Z",
-        "tag_list": []
-    }, {
-        "id": str(uuid.uuid4()),
-        "name": "Rapp's Barren Brewing Company",
-        "brewery_type": "micro",
-        "street": "1343 E 9th St",
-        "city": "Mountain Home",
-        "state": "Arkansas",
-        "postal_code": "72653-5050",
-        "country": "United States",
-        "longitude": "-92.3599724",
-        "latitude": "36.3326432",
-        "phone": "8704247288",
-        "website_url": "http://www.rappsbarrenbrewing.com",
-        "updated_at": "2018-08-23T23:23:29.428Z",
-        "tag_list": []
-    }
-]
-
-for brewerie in data:
-    print("adding {} - {}".format(brewerie['id'], brewerie['name']))
-    fs_client.collection('breweries').document(brewerie['id']).set(brewerie)
+DEFAULT_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'breweries.ndjson')
+SYNTHETIC_PREFIX = 'synthetic:'
+
+
+def open_text(path: str) -> typing.TextIO:
+    if path.endswith('.gz'):
+        return io.TextIOWrapper(gzip.open(path), encoding='utf-8')
+    return open(path, encoding='utf-8', newline='')
+
+
+def read_ndjson(path: str, start: int) -> typing.Iterator[dict]:
+    """Reads records of the NDJSON file, blank lines are not records (nor positions of the checkpoint)"""
+    with open_text(path) as source:
+        lines = (line for line in source if line.strip())
+        for line in itertools.islice(lines, start, None):
+            yield json.loads(line)
+
+
+def read_csv(path: str, start: int) -> typing.Iterator[dict]:
+    with open_text(path) as source:
+        yield from itertools.islice(csv.DictReader(source), start, None)
+
+
+def generate_breweries(count: int, seed: int, start: int) -> typing.Iterator[dict]:
+    """Generates brewery records, each record depends only on the seed and its position"""
+    brewery_types = ['micro', 'brewpub', 'regional', 'contract', 'nano', 'large']
+    cities = [
+        ('Birmingham', 'Alabama'), ('Anchorage', 'Alaska'), ('Tucson', 'Arizona'), ('Little Rock', 'Arkansas'),
+        ('Denver', 'Colorado'), ('Portland', 'Oregon'), ('Austin', 'Texas'), ('Asheville', 'North Carolina'),
+    ]
+    for index in range(start, count):
+        rng = random.Random('{}:{}'.format(seed, index))
+        city, state = rng.choice(cities)
+        name = '{} {} Brewing'.format(rng.choice(['Red', 'Old', 'Lost', 'Iron', 'River', 'Wild']),
+                                      rng.choice(['Bear', 'Creek', 'Forty', 'Anvil', 'Oak', 'Hammer']))
+        yield {
+            'id': str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+            'name': name,
+            'brewery_type': rng.choice(brewery_types),
+            'street': '{} {} St'.format(rng.randint(1, 9999), rng.choice(['Main', 'Oak', 'Pine', '5th', 'Byrd'])),
+            'city': city,
+            'state': state,
+            'postal_code': '{:05d}'.format(rng.randint(10000, 99999)),
+            'country': 'United States',
+            'longitude': '{:.6f}'.format(rng.uniform(-150, -70)),
+            'latitude': '{:.6f}'.format(rng.uniform(25, 62)),
+            'phone': '{:010d}'.format(rng.randint(2000000000, 9999999999)),
+            'website_url': 'http://www.{}.com'.format(name.lower().replace(' ', '')),
+            'updated_at': '2018-08-23T{:02d}:{:02d}:{:02d}.000Z'.format(
+                rng.randint(0, 23), rng.randint(0, 59), rng.randint(0, 59)
+            ),
+            'tag_list': [],
+        }
+
+
+def read_records(source: str, start: int, seed: int) -> typing.Iterator[dict]:
+    """Streams records of the source starting at the given position
+
+    :param source: file path or `synthetic:COUNT`
+    :param start: number of records to skip
+    :param seed: seed of synthetic records
+    :return: iterator of records
+    """
+    if source.startswith(SYNTHETIC_PREFIX):
+        return generate_breweries(int(source[len(SYNTHETIC_PREFIX):]), seed, start)
+    if source.endswith(('.csv', '.csv.gz')):
+        return read_csv(source, start)
+    if source.endswith(('.ndjson', '.ndjson.gz', '.jsonl', '.jsonl.gz')):
+        return read_ndjson(source, start)
+    raise ValueError('Unknown source format: {}'.format(source))
+
+
+class Checkpoint:
+    """Position in the source up to which all records are committed
+
+    Batches are committed out of order, the position advances only over a contiguous run of
+    committed batches.
+    """
+
+    def __init__(self, path: typing.Optional[str], source: str, save_interval: float = 1.0):
+        self.path = path
+        self.source = source
+        self.save_interval = save_interval
+        self.position = 0
+        self._committed: typing.Dict[int, int] = {}
+        self._next_sequence = 0
+        self._saved = 0.0
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as checkpoint_file:
+                state = json.load(checkpoint_file)
+            if state['source'] != source:
+                raise ValueError('Checkpoint belongs to source {}'.format(state['source']))
+            self.position = state['position']
+
+    def commit(self, token: typing.Tuple[int, int], count: int):
+        """Marks batch as committed
+
+        :param token: sequence number of the batch and source position after its last record
+        :param count: number of writes of the batch
+        """
+        sequence, end = token
+        with self._lock:
+            self._committed[sequence] = end
+            while self._next_sequence in self._committed:
+                self.position = self._committed.pop(self._next_sequence)
+                self._next_sequence += 1
+            if time.monotonic() - self._saved >= self.save_interval:
+                self.save()
+
+    def save(self):
+        if not self.path:
+            return
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, 'w') as checkpoint_file:
+            json.dump({'source': self.source, 'position': self.position}, checkpoint_file)
+        os.replace(temporary_path, self.path)
+        self._saved = time.monotonic()
+
+
+def fill(args):
+    source = args.source if args.source.startswith(SYNTHETIC_PREFIX) else os.path.abspath(args.source)
+    checkpoint = Checkpoint(args.checkpoint, source)
+    if checkpoint.position:
+        print('resuming after {} records'.format(checkpoint.position))
+
+    client = get_client()
+    collection = client.collection(args.collection)
+    total = int(source[len(SYNTHETIC_PREFIX):]) - checkpoint.position if source.startswith(SYNTHETIC_PREFIX) else None
+    progress = Progress(total=total)
+
+    def on_commit(token: typing.Tuple[int, int], count: int):
+        checkpoint.commit(token, count)
+        progress.add(count)
+
+    writer = BatchWriter(client, workers=args.workers, on_commit=on_commit)
+    records = read_records(source, checkpoint.position, args.seed)
+    position = checkpoint.position
+    try:
+        for sequence in itertools.count():
+            writes = []
+            for record in itertools.islice(records, args.batch_size):
+                document_id = record.get(args.id_field) or str(uuid.uuid5(uuid.NAMESPACE_URL, '{}#{}'.format(
+                    source, position + len(writes)
+                )))
+                record[args.id_field] = document_id
+                writes.append(('set', collection.document(document_id), record))
+            if not writes:
+                break
+            position += len(writes)
+            writer.submit(writes, (sequence, position))
+    finally:
+        writer.close()
+        checkpoint.save()
+    progress.report('loaded ')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('source', nargs='?', default=DEFAULT_SOURCE, help='NDJSON or CSV file or synthetic:COUNT')
+    parser.add_argument('--collection', default='breweries', help='target collection')
+    parser.add_argument('--id-field', default='id', help='record field with the document ID')
+    parser.add_argument('--workers', type=int, default=8, help='number of concurrently committed batches')
+    parser.add_argument('--batch-size', type=int, default=MAX_BATCH_SIZE, help='number of documents in one batch')
+    parser.add_argument('--checkpoint', help='path of the checkpoint file')
+    parser.add_argument('--seed', type=int, default=0, help='seed of synthetic records')
+    args = parser.parse_args()
+    if not 0 < args.batch_size <= MAX_BATCH_SIZE:
+        parser.error('batch size must be between 1 and {}'.format(MAX_BATCH_SIZE))
+    fill(args)
+
+
+if __name__ == '__main__':
+    main()
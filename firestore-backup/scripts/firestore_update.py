@@ -0,0 +1,264 @@
+"""Updates documents of a firestore collection with a transform function
+
+    python firestore_update.py COLLECTION --transform module:function [--where 'field == "value"']
+                               [--partitions 16] [--workers 8] [--rate 500] [--dry-run]
+
+The transform function is called with the document data and returns dict of fields to update
+(dotted field paths are allowed) or None to leave the document unchanged, e.g.
+
+    def rename(data: dict) -> typing.Optional[dict]:
+        return {'name': data['name'].title()} if data.get('name') else None
+
+The collection is split into key ranges of document IDs (`--id-alphabet` should contain the characters
+the IDs start with, so the ranges are balanced), each range is scanned page by page by
+one of the worker threads and updates are committed in batches. `--rate` limits the number of
+written documents per second so the migration leaves capacity to the production traffic.
+`--dry-run` scans the collection and reports the updates without writing them.
+Inequality filters (e.g. `--where 'rating >= 3'`) are allowed on a single field, the collection is then
+scanned in one partition ordered by the filtered field. `test_firestore_update.py` tests the queries
+(`python -m unittest test_firestore_update` in this folder).
+"""
+import argparse
+import importlib
+import json
+import os
+import sys
+import threading
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+from bulk import (
+    MAX_BATCH_SIZE,
+    BatchWriter,
+    Progress,
+    RateLimiter,
+    get_client,
+)
+
+if typing.TYPE_CHECKING:
+    from google.cloud.firestore import (
+        Client,
+        CollectionReference,
+        DocumentSnapshot,
+        Query,
+    )
+
+Transform = typing.Callable[[dict], typing.Optional[dict]]
+Filter = typing.Tuple[str, str, typing.Any]
+
+# characters of generated document IDs in their sort order
+ID_ALPHABET = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+UUID_ALPHABET = '0123456789abcdef'
+# filters which can be combined with a document ID range without a composite index
+RANGE_COMPATIBLE_OPERATORS = ('==', 'array_contains')
+# filters which require the first ordering of the query to be on their field
+INEQUALITY_OPERATORS = ('<', '<=', '>', '>=', '!=', 'not-in')
+DRY_RUN_SAMPLES = 5
+
+
+def split_key_ranges(
+        partitions: int,
+        alphabet: str = ID_ALPHABET
+) -> typing.List[typing.Tuple[typing.Optional[str], typing.Optional[str]]]:
+    """Splits document ID space to ranges of roughly the same number of generated IDs
+
+    The first range has no lower bound and the last one no upper bound, so IDs with any other
+    characters are covered as well.
+
+    :param partitions: number of ranges
+    :param alphabet: sorted characters of the document IDs
+    :return: (inclusive lower bound, exclusive upper bound) pairs, None for unbounded ends
+    """
+    size = len(alphabet) ** 2
+    bounds = []
+    for index in range(1, partitions):
+        position = index * size // partitions
+        bounds.append(alphabet[position // len(alphabet)] + alphabet[position % len(alphabet)])
+    bounds = sorted(set(bounds))
+    return list(zip([None] + bounds, bounds + [None]))
+
+
+def parse_filter(value: str) -> Filter:
+    """Parses `field op value` filter, value is a JSON value (e.g. `type == "micro"`)"""
+    try:
+        field_path, operator, raw_value = value.split(maxsplit=2)
+        return field_path, operator, json.loads(raw_value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('filter must be `field op json_value`: {}'.format(value))
+
+
+def load_transform(path: str) -> Transform:
+    """Imports transform function given as `module:function`"""
+    module_name, _, function_name = path.partition(':')
+    if not function_name:
+        raise argparse.ArgumentTypeError('transform must be `module:function`: {}'.format(path))
+    sys.path.insert(0, os.getcwd())
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def partition_query(
+        collection: 'CollectionReference',
+        filters: typing.List[Filter],
+        lower: typing.Optional[str],
+        upper: typing.Optional[str]
+) -> typing.Tuple['Query', typing.List[str]]:
+    """Builds query of the documents of the key range
+
+    Query with an inequality filter is ordered by the filtered field first (firestore rejects it
+    otherwise), it can not be combined with a document ID range.
+
+    :param collection: updated collection
+    :param filters: (field path, operator, value) filters of updated documents
+    :param lower: inclusive lower bound of the document IDs (None for unbounded)
+    :param upper: exclusive upper bound of the document IDs (None for unbounded)
+    :return: query and its ordering field paths (values of the page cursors)
+    """
+    query = collection
+    for field_path, operator, value in filters:
+        query = query.where(field_path, operator, value)
+
+    inequality_fields = sorted({field_path for field_path, operator, _ in filters if operator in INEQUALITY_OPERATORS})
+    if len(inequality_fields) > 1:
+        raise ValueError('inequality filters on multiple fields: {}'.format(', '.join(inequality_fields)))
+    if inequality_fields and (lower is not None or upper is not None):
+        raise ValueError('document ID range can not be combined with an inequality filter')
+
+    order_fields = inequality_fields + ['__name__']
+    for field_path in order_fields:
+        query = query.order_by(field_path)
+    if lower is not None:
+        query = query.where('__name__', '>=', collection.document(lower))
+    if upper is not None:
+        query = query.where('__name__', '<', collection.document(upper))
+    return query, order_fields
+
+
+def page_cursor(doc: 'DocumentSnapshot', order_fields: typing.List[str]) -> dict:
+    """Creates cursor of the page following the document
+
+    :param doc: last document of the page
+    :param order_fields: ordering field paths of the query
+    :return: cursor values of all ordering fields
+    """
+    return {
+        field_path: doc.reference if field_path == '__name__' else doc.get(field_path)
+        for field_path in order_fields
+    }
+
+
+def update_collection(
+        client: 'Client',
+        collection_path: str,
+        transform: Transform,
+        filters: typing.List[Filter] = (),
+        partitions: int = 16,
+        alphabet: str = ID_ALPHABET,
+        workers: int = 8,
+        page_size: int = MAX_BATCH_SIZE,
+        rate: float = None,
+        dry_run: bool = False
+) -> dict:
+    """Applies transform to documents of the collection
+
+    :param client: firestore client
+    :param collection_path: collection path
+    :param transform: function returning fields to update of the document data (None for no update)
+    :param filters: (field path, operator, value) filters of updated documents
+    :param partitions: number of document ID ranges scanned in parallel
+    :param alphabet: sorted characters of the document IDs (`UUID_ALPHABET` for uuid IDs)
+    :param workers: number of concurrently scanned ranges and committed batches
+    :param page_size: number of documents read and written at once
+    :param rate: maximal number of updated documents per second
+    :param dry_run: do not write the updates
+    :return: number of scanned and updated documents
+    """
+    if any(operator not in RANGE_COMPATIBLE_OPERATORS for _, operator, _ in filters):
+        # firestore allows range filters on a single field only
+        print('inequality filter used, collection is scanned in a single partition')
+        partitions = 1
+
+    collection = client.collection(collection_path)
+    progress = Progress()
+    limiter = RateLimiter(rate)
+    updated = [0]
+    samples = []
+    lock = threading.Lock()
+
+    def on_commit(token, count: int):
+        with lock:
+            updated[0] += count
+
+    writer = BatchWriter(client, workers=workers, on_commit=on_commit)
+
+    def process(lower: typing.Optional[str], upper: typing.Optional[str]):
+        query, order_fields = partition_query(collection, filters, lower, upper)
+        query = query.limit(page_size)
+        cursor = None
+        while True:
+            page = list((query.start_after(cursor) if cursor else query).stream())
+            if not page:
+                return
+            cursor = page_cursor(page[-1], order_fields)
+            writes = []
+            for doc in page:
+                update = transform(doc.to_dict())
+                if update:
+                    writes.append(('update', doc.reference, update))
+            progress.add(len(page))
+            if not writes:
+                continue
+            if dry_run:
+                with lock:
+                    updated[0] += len(writes)
+                    samples.extend((reference.id, update) for _, reference, update in writes[:DRY_RUN_SAMPLES])
+                continue
+            limiter.acquire(len(writes))
+            writer.submit(writes)
+
+    try:
+        key_ranges = split_key_ranges(partitions, alphabet)
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='partition') as executor:
+            for future in [executor.submit(process, lower, upper) for lower, upper in key_ranges]:
+                future.result()
+    finally:
+        writer.close()
+
+    progress.report('scanned ')
+    print('{} {} documents'.format('would update' if dry_run else 'updated', updated[0]))
+    for document_id, update in samples[:DRY_RUN_SAMPLES]:
+        print('  {}: {}'.format(document_id, update))
+    return {'scanned': progress.count, 'updated': updated[0]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('collection', help='collection path')
+    parser.add_argument('--transform', type=load_transform, required=True, help='transform function module:function')
+    parser.add_argument('--where', type=parse_filter, action='append', default=[], help='filter `field op value`')
+    parser.add_argument('--partitions', type=int, default=16, help='number of document ID ranges')
+    parser.add_argument('--id-alphabet', default=ID_ALPHABET,
+                        help='sorted characters of document IDs, use 0123456789abcdef for uuids')
+    parser.add_argument('--workers', type=int, default=8, help='number of concurrently scanned ranges')
+    parser.add_argument('--page-size', type=int, default=MAX_BATCH_SIZE, help='number of documents read at once')
+    parser.add_argument('--rate', type=float, help='maximal number of updated documents per second')
+    parser.add_argument('--dry-run', action='store_true', help='report updates without writing them')
+    args = parser.parse_args()
+    if not 0 < args.page_size <= MAX_BATCH_SIZE:
+        parser.error('page size must be between 1 and {}'.format(MAX_BATCH_SIZE))
+
+    update_collection(
+        get_client(),
+        args.collection,
+        args.transform,
+        filters=args.where,
+        partitions=args.partitions,
+        alphabet=args.id_alphabet,
+        workers=args.workers,
+        page_size=args.page_size,
+        rate=args.rate,
+        dry_run=args.dry_run
+    )
+
+
+if __name__ == '__main__':
+    main()
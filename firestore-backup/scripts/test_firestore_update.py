@@ -0,0 +1,73 @@
+import unittest
+
+from firestore_update import (
+    page_cursor,
+    partition_query,
+)
+
+
+class RecordingQuery:
+    """Query recording the filters and orderings it is built with"""
+
+    def __init__(self, filters=(), orders=()):
+        self.filters = list(filters)
+        self.orders = list(orders)
+
+    def where(self, field_path, operator, value):
+        return RecordingQuery(self.filters + [(field_path, operator, value)], self.orders)
+
+    def order_by(self, field_path):
+        return RecordingQuery(self.filters, self.orders + [field_path])
+
+    def document(self, document_id):
+        return 'documents/{}'.format(document_id)
+
+
+class Snapshot:
+
+    def __init__(self, reference, data):
+        self.reference = reference
+        self._data = data
+
+    def get(self, field_path):
+        return self._data[field_path]
+
+
+class PartitionQueryTest(unittest.TestCase):
+
+    def test_key_range(self):
+        query, order_fields = partition_query(RecordingQuery(), [('type', '==', 'micro')], 'A', 'B')
+        self.assertEqual(order_fields, ['__name__'])
+        self.assertEqual(query.orders, ['__name__'])
+        self.assertEqual(query.filters, [
+            ('type', '==', 'micro'),
+            ('__name__', '>=', 'documents/A'),
+            ('__name__', '<', 'documents/B'),
+        ])
+
+    def test_inequality_filter_is_ordered_first(self):
+        query, order_fields = partition_query(
+            RecordingQuery(),
+            [('type', '==', 'micro'), ('rating', '>=', 3)],
+            None,
+            None
+        )
+        self.assertEqual(order_fields, ['rating', '__name__'])
+        self.assertEqual(query.orders, ['rating', '__name__'])
+        self.assertEqual(query.filters, [('type', '==', 'micro'), ('rating', '>=', 3)])
+
+    def test_inequality_filter_with_key_range(self):
+        with self.assertRaises(ValueError):
+            partition_query(RecordingQuery(), [('rating', '>=', 3)], 'A', None)
+
+    def test_inequality_filters_on_multiple_fields(self):
+        with self.assertRaises(ValueError):
+            partition_query(RecordingQuery(), [('rating', '>=', 3), ('size', '<', 10)], None, None)
+
+    def test_page_cursor(self):
+        doc = Snapshot('documents/x', {'rating': 4})
+        self.assertEqual(page_cursor(doc, ['rating', '__name__']), {'rating': 4, '__name__': 'documents/x'})
+
+
+if __name__ == '__main__':
+    unittest.main()
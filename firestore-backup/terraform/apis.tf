@@ -38,4 +38,9 @@ resource "google_project_service" "source_repositories" {
   project = var.project_id
   service = "sourcerepo.googleapis.com"
   disable_dependent_services = true
-}
\ No newline at end of file
+}
+resource "google_project_service" "cloudtasks" {
+  project = var.project_id
+  service = "cloudtasks.googleapis.com"
+  disable_dependent_services = true
+}
@@ -8,16 +8,23 @@ resource "google_cloudbuild_trigger" "deploy_firestore_backup_cf" {
   }
   included_files = [
     "firestore-backup/build/**",
-    "firestore-backup/main.py",
+    "firestore-backup/*.py",
     "firestore-backup/requirements.txt",
+    "serverless-calendar/calendar_common/**",
   ]
   substitutions = {
     _SLACK_API_TOKEN = var.slack_api_token
     _SLACK_CHANNEL = var.slack_notification_channel
     _BUCKET_NAME = google_storage_bucket.backup_bucket.name
     _REGION = var.region
+    _CHECK_QUEUE_NAME = google_cloud_tasks_queue.backup_checks.name
+    _SERVICE_ACCOUNT_EMAIL = google_service_account.service_account_scheduler.email
+    _BACKUP_MODE = var.backup_mode
+    _EXPORT_GROUPS = var.export_groups
+    _BACKUP_COLLECTIONS = var.backup_collections
   }
   depends_on = [
-    google_storage_bucket.backup_bucket
+    google_storage_bucket.backup_bucket,
+    google_cloud_tasks_queue.backup_checks,
   ]
 }
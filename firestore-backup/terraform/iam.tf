@@ -23,6 +23,18 @@ resource "google_project_iam_member" "scheduler_sa_cloud_scheduler_admin_role" {
   ]
 }
 
+// Backup function roles, checks of exports are scheduled as cloud tasks calling the function as the scheduler account
+resource "google_project_iam_member" "function_cloud_tasks_enqueuer_role" {
+  role = "roles/cloudtasks.enqueuer"
+  member = "serviceAccount:${var.project_id}@appspot.gserviceaccount.com"
+}
+
+resource "google_service_account_iam_member" "function_scheduler_sa_user_role" {
+  service_account_id = google_service_account.service_account_scheduler.name
+  role = "roles/iam.serviceAccountUser"
+  member = "serviceAccount:${var.project_id}@appspot.gserviceaccount.com"
+}
+
 // Cloud build roles
 resource "google_project_iam_member" "cloudbuild_cloud_functions_admin_role" {
   role = "roles/cloudfunctions.admin"
@@ -20,3 +20,55 @@ resource "google_cloud_scheduler_job" "firebase_backup_job" {
     }
   }
 }
+
+resource "google_cloud_scheduler_job" "firebase_incremental_backup_job" {
+  name = "backup-firestore-incremental"
+  description = "Backs up firestore documents changed since the last incremental backup"
+  schedule = var.incremental_backup_schedule
+  time_zone = "Europe/Prague"
+  attempt_deadline = "320s"
+
+  http_target {
+    http_method = "GET"
+    uri = "https://${var.region}-${var.project_id}.cloudfunctions.net/backup_firestore?mode=incremental"
+
+    oidc_token {
+      service_account_email = google_service_account.service_account_scheduler.email
+    }
+  }
+}
+
+// deleted documents are found by listing all document IDs, which is billed as reads of the whole database
+resource "google_cloud_scheduler_job" "firebase_delete_tracking_job" {
+  name = "backup-firestore-deletes"
+  description = "Backs up changed firestore documents and tombstones of deleted ones"
+  schedule = var.delete_tracking_schedule
+  time_zone = "Europe/Prague"
+  attempt_deadline = "540s"
+
+  http_target {
+    http_method = "GET"
+    uri = "https://${var.region}-${var.project_id}.cloudfunctions.net/backup_firestore?mode=incremental&deletes=1"
+
+    oidc_token {
+      service_account_email = google_service_account.service_account_scheduler.email
+    }
+  }
+}
+
+resource "google_cloud_scheduler_job" "firebase_compaction_job" {
+  name = "compact-firestore-backups"
+  description = "Folds incremental firestore backups into a snapshot"
+  schedule = var.compaction_schedule
+  time_zone = "Europe/Prague"
+  attempt_deadline = "540s"
+
+  http_target {
+    http_method = "GET"
+    uri = "https://${var.region}-${var.project_id}.cloudfunctions.net/compact_backups"
+
+    oidc_token {
+      service_account_email = google_service_account.service_account_scheduler.email
+    }
+  }
+}
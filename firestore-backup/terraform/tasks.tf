@@ -0,0 +1,8 @@
+// Follow-up checks of running exports
+resource "google_cloud_tasks_queue" "backup_checks" {
+  name = "backup-checks-queue"
+  location = var.region
+  depends_on = [
+    google_project_service.cloudtasks
+  ]
+}
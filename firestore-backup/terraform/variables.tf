@@ -25,3 +25,36 @@ variable "slack_api_token" {
 variable "slack_notification_channel" {
   type = string
 }
+
+variable "incremental_backup_schedule" {
+  type = string
+  default = "0 */4 * * *"
+}
+
+// runs before the compaction, so the snapshot drops documents deleted since the previous day
+variable "delete_tracking_schedule" {
+  type = string
+  default = "0 3 * * *"
+}
+
+variable "compaction_schedule" {
+  type = string
+  default = "30 3 * * *"
+}
+
+// `full` for a single export of the database or `sharded` for parallel exports of collection groups
+variable "backup_mode" {
+  type = string
+  default = "full"
+}
+
+// comma separated collection group IDs (including subcollections), required by the `sharded` mode
+variable "backup_collections" {
+  type = string
+  default = ""
+}
+
+variable "export_groups" {
+  type = number
+  default = 4
+}
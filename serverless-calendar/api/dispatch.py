@@ -0,0 +1,30 @@
+from flask import (
+    Flask,
+    Request,
+    Response,
+)
+from flask.ctx import RequestContext
+
+
+def dispatch_request(app: Flask, api_request: Request) -> Response:
+    """Dispatches cloud function request to the flask application
+
+    Request context is created directly from the incoming WSGI environ and reuses the
+    incoming request object, so neither headers nor body are copied or parsed again.
+
+    :param app: flask application handling the request
+    :param api_request: cloud function http request
+    :return: application response
+    """
+    ctx = RequestContext(app, api_request.environ, request=api_request)
+    error = None
+    try:
+        try:
+            ctx.push()
+            response = app.full_dispatch_request()
+        except Exception as e:
+            error = e
+            response = app.handle_exception(e)
+        return response
+    finally:
+        ctx.pop(error)
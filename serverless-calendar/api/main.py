@@ -1,137 +1,116 @@
+import base64
+import binascii
 import datetime
+import hmac
 import json
 import logging
 import os
+import re
 import typing
-import uuid
-from dataclasses import (
-    dataclass,
-    field,
+import zlib
+from concurrent.futures import (
+    Future,
+    ThreadPoolExecutor,
 )
+from functools import lru_cache
 
-from dateutil.parser import parse
-from firebase_admin import (
-    firestore,
-    initialize_app,
-)
 from flask import (
     Flask,
     Request,
+    Response,
     request,
 )
 from flask_cors import CORS
-from google.cloud import (
-    logging as cloud_logging,
-    tasks,
+
+from calendar_common.backends import get_task_backend
+from calendar_common.clients import (
+    get_db,
+    setup_logging,
+)
+from calendar_common.instrumentation import (
+    prometheus_text,
+    span,
+    trace,
+    traced_stream,
+    with_trace,
+)
+from calendar_common.stats import (
+    increment_stats,
+    read_stats,
+    today,
+)
+from calendar_common.tasks import (
+    CalendarTask,
+    get_task_settings,
+)
+from dispatch import dispatch_request
+from mirror import CollectionMirror
+from validation import (
+    Field,
+    Schema,
+    ValidationError,
+    integer,
+    parse_rfc3339,
+    string,
+    timestamp,
 )
-from google.cloud.firestore import Client
-from google.protobuf.timestamp_pb2 import Timestamp
-from werkzeug.datastructures import Headers
 
-log_client = cloud_logging.Client()
-log_handler = log_client.get_default_handler()
-cloud_logger = logging.getLogger("cloudLogger")
-cloud_logger.setLevel(logging.INFO)
-cloud_logger.addHandler(log_handler)
+if typing.TYPE_CHECKING:
+    from google.cloud.firestore import (
+        DocumentSnapshot,
+        Query,
+        WriteBatch,
+    )
 
 # Flask setup
 app = Flask(__name__)
 CORS(app)
 
-# Cloud tasks setup
-project_name = os.getenv("GCP_PROJECT")
-location = os.getenv("FUNCTION_REGION")
-queue = os.getenv("QUEUE_NAME")
-
-client = tasks.CloudTasksClient()
-task_queue = client.queue_path(project_name, location, queue)
-
-# Firebase and Firestore setup
-firebase_app = initialize_app()
-db: Client = firestore.client(firebase_app)
-
-
-@dataclass
-class CalendarTask:
-    id: str = field(default_factory=lambda: str(uuid.uuid4()))
-    message: str = 'Empty message'
-    timestamp: datetime.datetime = None
-    timedelta: int = None
-    repeat: int = 0
-
-    @property
-    def name(self) -> str:
-        return 'projects/{project_name}/locations/{location}/queues/{queue}/tasks/{id}'.format(
-            project_name=project_name,
-            location=location,
-            queue=queue,
-            id=self.id
-        )
 
-    @property
-    def callback_url(self) -> str:
-        return os.getenv("EVENT_CALLBACK_URL")
-
-    @property
-    def service_account_email(self) -> str:
-        return os.getenv('SERVICE_ACCOUNT_EMAIL')
-
-    @property
-    def schedule_time(self) -> datetime:
-        return (self.timestamp or datetime.datetime.now()) + datetime.timedelta(seconds=self.timedelta or 0)
-
-    @property
-    def schedule_time_proto(self) -> Timestamp:
-        proto_timestamp = Timestamp()
-        proto_timestamp.FromDatetime(self.schedule_time)
-        return proto_timestamp
-
-    @property
-    def payload_dict(self) -> dict:
-        return {
-            'message': self.message,
-            'timedelta': self.timedelta,
-            'id': self.id,
-            'repeat': self.repeat
-        }
-
-    @property
-    def payload_blob(self) -> bytes:
-        return json.dumps(self.payload_dict).encode('utf-8')
-
-    @property
-    def _dict_base(self) -> dict:
-        return {
-            'name': self.name,
-            'http_request': {
-                'http_method': 'POST',
-                'url': self.callback_url,
-                'headers': {
-                    "Content-Type": "application/json"
-                },
-                'oidc_token': {
-                    'service_account_email': self.service_account_email
-                }
-            }
-        }
-
-    def to_dict(self) -> dict:
-        doc: dict = {
-            **self._dict_base,
-            'processed': False,
-            'execution_counter': 0,
-            'schedule_time': self.schedule_time.isoformat(),
-        }
-        doc['http_request']['body'] = self.payload_dict
-        return doc
-
-    def to_task_request(self) -> dict:
-        doc: dict = {
-            **self._dict_base,
-            'schedule_time': self.schedule_time_proto
-        }
-        doc['http_request']['body'] = self.payload_blob
-        return doc
+@lru_cache(maxsize=None)
+def get_events_mirror() -> typing.Optional[CollectionMirror]:
+    """Starts in-memory mirror of events on the first use if it is enabled
+
+    :return: events mirror or None if the mirror is disabled
+    """
+    if os.getenv('EVENTS_MIRROR', '').lower() not in ('1', 'true'):
+        return None
+    # execution counters of sharded events are summed from their shards, which are not mirrored
+    mirror = CollectionMirror(
+        get_db().collection('events'),
+        default=json_default,
+        bypass=lambda event: bool(event.get('counter_shards'))
+    )
+    mirror.start()
+    return mirror
+
+
+# Listing setup
+MAX_PAGE_SIZE = 1000
+FIELD_PATH_PATTERN = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)*$')
+NDJSON_MIMETYPE = 'application/x-ndjson'
+STREAM_CHUNK_SIZE = 16 * 1024
+
+# Event creation setup
+MAX_BATCH_SIZE = 1000
+MAX_COUNTER_SHARDS = 100
+FIRESTORE_BATCH_SIZE = 500
+MAX_STATS_DAYS = 366
+# free-form timestamps are parsed by dateutil only if they are not RFC 3339 timestamps
+lenient_timestamps = os.getenv('LENIENT_TIMESTAMPS', '').lower() in ('1', 'true')
+EVENT_SCHEMA = Schema(
+    Field('message', default="Empty Message"),
+    Field('timestamp', timestamp(lenient=lenient_timestamps)),
+    Field('timedelta', integer()),
+    Field('repeat', integer()),
+    Field('counter_shards', integer(0, MAX_COUNTER_SHARDS), default=0),
+    Field('rrule', string),
+    Field('cron', string),
+)
+executor = ThreadPoolExecutor(max_workers=int(os.getenv('ENQUEUE_CONCURRENCY', 16)))
+
+# Metrics setup, the API is public, so the metrics are served only to requests with the bearer token
+metrics_token = os.getenv('METRICS_TOKEN')
 
 
 def calendar_api(api_request: Request):
@@ -139,65 +118,398 @@ def calendar_api(api_request: Request):
 
     :param api_request: http request
     """
-    with app.app_context():
-
-        # construct headers
-        headers = Headers()
-        for key, value in api_request.headers.items():
-            headers.add(key, value)
+    setup_logging()
+    with trace('calendar_api', method=api_request.method, path=api_request.path) as request_trace:
+        response = dispatch_request(app, api_request)
+        request_trace.annotate(status=response.status_code)
+        if response.is_streamed:
+            # events are read from firestore while the response is sent
+            response.response = traced_stream(request_trace, response.response)
+    return response
 
-        # prepare content
-        content = {}
-        if headers.get('content-type') == 'application/json':
-            content['json'] = api_request.get_json(silent=True)
-        else:
-            content['data'] = api_request.form
-
-        with app.test_request_context(
-                method=api_request.method,
-                base_url=api_request.base_url,
-                path=api_request.path,
-                query_string=api_request.query_string,
-                headers=headers,
-                **content
-        ):
-            try:
-                rv = app.preprocess_request()
-                if rv is None:
-                    rv = app.dispatch_request()
-            except Exception as e:
-                rv = app.handle_user_exception(e)
-            response = app.make_response(rv)
-            return app.process_response(response)
 
-
-def bad_request(err: str) -> typing.Tuple[dict, int]:
+def bad_request(err: str, errors: typing.Dict[str, str] = None) -> typing.Tuple[dict, int]:
     """Processes bad request on API
 
     :param err: string message
+    :param errors: error messages of invalid request attributes
     :return: error response and status code
     """
     logging.warning({
         "message": "Failed to process API request",
         "error": err
     })
+    if errors:
+        return dict(error=err, errors=errors), 503
     return dict(error=err), 503
 
 
+def encode_page_token(document_id: str, schedule_at: datetime.datetime = None) -> str:
+    """Encodes listing cursor into an opaque page token
+
+    :param document_id: ID of the last document of the page
+    :param schedule_at: schedule time of the last document of a listing ordered by the schedule time
+    :return: url-safe page token
+    """
+    cursor = {'id': document_id}
+    if schedule_at is not None:
+        cursor['schedule_at'] = schedule_at.isoformat()
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode('utf-8')).decode('ascii')
+
+
+def decode_page_token(page_token: str) -> typing.Tuple[str, typing.Optional[datetime.datetime]]:
+    """Decodes page token created by `encode_page_token`
+
+    :param page_token: url-safe page token
+    :return: ID and schedule time (if set) of the document after which the next page starts
+    """
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(page_token.encode('ascii')))
+        schedule_at = cursor.get('schedule_at')
+        return cursor['id'], datetime.datetime.fromisoformat(schedule_at) if schedule_at else None
+    except (binascii.Error, UnicodeError, ValueError, TypeError, KeyError, AttributeError):
+        raise ValueError('Invalid page_token')
+
+
+def parse_window_bound(args: dict, name: str) -> typing.Optional[datetime.datetime]:
+    """Parses time window bound from query parameters
+
+    :param args: request query parameters
+    :param name: parameter name
+    :return: UTC datetime or None if the bound is not set
+    :raises ValueError: if the bound is not an RFC 3339 timestamp
+    """
+    value = args.get(name)
+    if not value:
+        return None
+    try:
+        return parse_rfc3339(value).astimezone(datetime.timezone.utc)
+    except ValueError as ex:
+        raise ValueError('Invalid {} ({})'.format(name, str(ex)))
+
+
+def build_events_query(args: dict) -> typing.Tuple['Query', typing.Optional[int], bool, typing.FrozenSet[str]]:
+    """Builds events listing query from request query parameters
+
+    Time window queries are ordered by the schedule time and served by the `processed`,
+    `schedule_at` composite index (see `terraform/firestore.tf`).
+
+    :param args: request query parameters
+    :return: firestore query, page size (None if the listing is not paginated), flag whether
+        the events are ordered by the schedule time and fields selected only for the listing itself
+        (they are removed from the returned events)
+    :raises ValueError: if any of the parameters is invalid
+    """
+    collection = get_db().collection('events')
+    query = collection
+
+    processed = args.get('processed')
+    if processed is not None:
+        if processed not in ('true', 'false'):
+            raise ValueError('Invalid processed (must be true or false)')
+        query = query.where('processed', '==', processed == 'true')
+
+    window_start = parse_window_bound(args, 'from')
+    window_end = parse_window_bound(args, 'to')
+    if window_start and window_end and window_start >= window_end:
+        raise ValueError('Invalid time window (from must be before to)')
+    if window_start:
+        query = query.where('schedule_at', '>=', window_start)
+    if window_end:
+        query = query.where('schedule_at', '<', window_end)
+    by_schedule = bool(window_start or window_end)
+    if by_schedule:
+        query = query.order_by('schedule_at')
+    query = query.order_by('__name__')
+
+    limit = args.get('limit')
+    if limit is not None:
+        if not limit.isdigit() or not 0 < int(limit) <= MAX_PAGE_SIZE:
+            raise ValueError('Invalid limit (must be an integer between 1 and {})'.format(MAX_PAGE_SIZE))
+        limit = int(limit)
+        query = query.limit(limit)
+
+    page_token = args.get('page_token')
+    if page_token:
+        document_id, schedule_at = decode_page_token(page_token)
+        cursor = {'__name__': collection.document(document_id)}
+        if by_schedule:
+            if schedule_at is None:
+                raise ValueError('Invalid page_token (token of a listing without time window)')
+            cursor['schedule_at'] = schedule_at
+        query = query.start_after(cursor)
+
+    hidden_fields = set()
+    fields = args.get('fields')
+    if fields:
+        field_paths = [field_path.strip() for field_path in fields.split(',') if field_path.strip()]
+        for field_path in field_paths:
+            if not FIELD_PATH_PATTERN.match(field_path):
+                raise ValueError('Invalid field {}'.format(field_path))
+        if by_schedule and 'schedule_at' not in field_paths:
+            # page token of the listing contains the schedule time
+            hidden_fields.add('schedule_at')
+        if 'execution_counter' in field_paths and 'counter_shards' not in field_paths:
+            # sharded execution counters are summed from their shards
+            hidden_fields.add('counter_shards')
+        query = query.select(field_paths + sorted(hidden_fields))
+
+    return query, limit, by_schedule, frozenset(hidden_fields)
+
+
+def event_to_dict(doc: 'DocumentSnapshot', hidden_fields: typing.AbstractSet[str] = frozenset()) -> dict:
+    """Converts event snapshot to dict, sharded execution counter is summed from its shards
+
+    :param doc: event snapshot
+    :param hidden_fields: fields which are removed from the event
+    :return: event
+    """
+    event = doc.to_dict()
+    if event.get('counter_shards') and 'execution_counter' in event:
+        with span('firestore.query', collection='counter_shards'):
+            event['execution_counter'] += sum(
+                shard.get('execution_counter') or 0
+                for shard in doc.reference.collection('counter_shards').stream()
+            )
+    for field in hidden_fields:
+        event.pop(field, None)
+    return event
+
+
+def commit_batch(batch: 'WriteBatch'):
+    """Commits firestore write batch as a timed span
+
+    :param batch: write batch
+    """
+    with span('firestore.commit'):
+        batch.commit()
+
+
+def json_default(value):
+    """Serializes firestore values unknown to the json module
+
+    :param value: value to serialize
+    :return: json serializable representation of the value
+    """
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(value).__name__))
+
+
+def next_page_token(doc: 'DocumentSnapshot', by_schedule: bool) -> str:
+    """Creates page token of the page following the document
+
+    :param doc: last document of the page
+    :param by_schedule: flags whether the listing is ordered by the schedule time
+    :return: url-safe page token
+    """
+    return encode_page_token(doc.id, doc.get('schedule_at') if by_schedule else None)
+
+
+def json_response(body: dict, status: int) -> Response:
+    """Creates json response, timestamps are serialized in ISO format like in the streamed listing
+
+    :param body: response body
+    :param status: response status code
+    :return: json response
+    """
+    return Response(json.dumps(body, default=json_default), status=status, mimetype='application/json')
+
+
+def stream_calendar_events(
+        query: 'Query',
+        limit: typing.Optional[int],
+        compress: bool,
+        by_schedule: bool = False,
+        hidden_fields: typing.AbstractSet[str] = frozenset()
+) -> typing.Iterator[bytes]:
+    """Streams events as newline delimited json while firestore yields them
+
+    Every line contains one event. If there is another page of events, the last line
+    contains only `next_page_token` attribute.
+
+    :param query: events query
+    :param limit: page size (None if the listing is not paginated)
+    :param compress: flags whether the stream should be gzip compressed
+    :param by_schedule: flags whether the events are ordered by the schedule time
+    :param hidden_fields: fields which are removed from the events
+    :return: response body chunks
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16) if compress else None
+    buffer = bytearray()
+    count = 0
+    last_doc = None
+
+    def flush() -> bytes:
+        chunk = bytes(buffer)
+        buffer.clear()
+        if compressor:
+            chunk = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        return chunk
+
+    for doc in query.stream():
+        buffer += json.dumps(event_to_dict(doc, hidden_fields), default=json_default).encode('utf-8')
+        buffer += b'\n'
+        count += 1
+        last_doc = doc
+        # send the first event right away to keep time to first byte low
+        if count == 1 or len(buffer) >= STREAM_CHUNK_SIZE:
+            yield flush()
+
+    if limit and count == limit:
+        buffer += json.dumps({'next_page_token': next_page_token(last_doc, by_schedule)}).encode('utf-8')
+        buffer += b'\n'
+
+    chunk = flush()
+    if compressor:
+        chunk += compressor.flush()
+    if chunk:
+        yield chunk
+
+
 @app.route('/', methods=['GET'])
 def get_calendar_events():
-    """Returns all calendar events from firestore
+    """Returns calendar events from firestore
+
+    Accepts following query parameters:
+    - limit: maximal number of events in the response, all events are returned if not set
+    - page_token: token of the page to return (`next_page_token` of the previous page)
+    - fields: comma separated list of event fields to return (e.g. `message,schedule_time`)
+    - from, to: RFC 3339 bounds of the schedule time window (`from` inclusive, `to` exclusive),
+      events in a time window are ordered by their schedule time
+    - processed: `true` or `false` to return only processed or pending events
+
+    Events are streamed as newline delimited json if the client accepts `application/x-ndjson`,
+    the stream is gzip compressed if the client accepts gzip encoding.
 
-    :returns: list of all calendar events
+    If the events mirror is enabled, listing without query parameters is served from memory
+    with an ETag and `If-None-Match` requests of an unchanged listing receive 304 response.
+
+    :returns: list of calendar events and token of the next page
     """
     logging.info({
         "method": request.method,
         "endpoint": request.endpoint,
+        "args": request.args.to_dict(),
     })
+
+    mirror = get_events_mirror()
+    listing = mirror.listing() if mirror and not request.args else None
+    if listing and request.accept_mimetypes.best_match(['application/json', NDJSON_MIMETYPE]) != NDJSON_MIMETYPE:
+        body, etag = listing
+        response = Response(body, mimetype='application/json')
+        response.set_etag(etag)
+        return response.make_conditional(request)
+
+    try:
+        query, limit, by_schedule, hidden_fields = build_events_query(request.args)
+    except ValueError as ex:
+        return bad_request(str(ex))
+
+    if request.accept_mimetypes.best_match(['application/json', NDJSON_MIMETYPE]) == NDJSON_MIMETYPE:
+        compress = request.accept_encodings['gzip'] > 0
+        response = Response(
+            stream_calendar_events(query, limit, compress, by_schedule, hidden_fields),
+            mimetype=NDJSON_MIMETYPE,
+            headers={'Vary': 'Accept, Accept-Encoding'}
+        )
+        if compress:
+            response.headers['Content-Encoding'] = 'gzip'
+        return response
+
+    with span('firestore.query', collection='events'):
+        docs = list(query.stream())
+    objects = [event_to_dict(doc, hidden_fields) for doc in docs]
+    last_doc = docs[-1] if docs else None
+
     response = {
-        'objects': [doc.to_dict() for doc in db.collection('events').stream()]
+        'objects': objects,
+        'next_page_token': next_page_token(last_doc, by_schedule) if limit and len(objects) == limit else None
     }
-    return response, 200
+    return json_response(response, 200)
+
+
+def parse_calendar_task(request_json: dict) -> CalendarTask:
+    """Validates calendar event attributes and creates task out of them
+
+    :param request_json: calendar event attributes
+    :return: calendar task
+    :raises ValidationError: with errors of all invalid event attributes
+    """
+    if not isinstance(request_json, dict):
+        raise ValidationError({'event': "Invalid event (must be a JSON object)"})
+
+    values, errors = EVENT_SCHEMA.validate(request_json)
+    timestamp = values['timestamp']
+    timedelta = values['timedelta']
+    repeat = values['repeat']
+    rrule = values['rrule']
+    cron = values['cron']
+    if timestamp and timestamp <= datetime.datetime.now():
+        errors['timestamp'] = "Invalid timestamp (must be a future timestamp)"
+
+    if rrule is not None or cron is not None or 'rrule' in errors or 'cron' in errors:
+        if rrule is not None and cron is not None:
+            errors['cron'] = "rrule and cron are mutually exclusive"
+        elif rrule is not None or cron is not None:
+            try:
+                check_recurrence(rrule, cron, timestamp or datetime.datetime.now())
+            except Exception as ex:
+                name = 'rrule' if rrule is not None else 'cron'
+                errors[name] = "Invalid {} ({})".format(name, str(ex))
+        if timedelta or repeat:
+            errors['timedelta' if timedelta else 'repeat'] = "timedelta and repeat can not be used with recurring events"
+    elif not timedelta and not timestamp and 'timedelta' not in errors and 'timestamp' not in errors:
+        errors['timestamp'] = "at least one of timestamp and timedelta must be set"
+
+    if errors:
+        raise ValidationError(errors)
+
+    return CalendarTask(
+        timestamp=timestamp,
+        timedelta=timedelta,
+        repeat=repeat,
+        message=values['message'],
+        rrule=rrule,
+        cron=cron,
+        counter_shards=values['counter_shards'],
+        initial=True,
+        stats=True
+    )
+
+
+def check_recurrence(rrule: typing.Optional[str], cron: typing.Optional[str], dtstart: datetime.datetime):
+    """Checks that recurrence of the event can be expanded
+
+    :param rrule: RFC 5545 recurrence rule
+    :param cron: cron expression
+    :param dtstart: first possible occurrence of the event
+    :raises ValueError: if the recurrence is invalid
+    """
+    if rrule is not None:
+        if not isinstance(rrule, str):
+            raise ValueError('Must be a string')
+        from dateutil.rrule import rrulestr
+        rrulestr(rrule, dtstart=dtstart)
+    else:
+        if not isinstance(cron, str):
+            raise ValueError('Must be a string')
+        from croniter import croniter
+        if not croniter.is_valid(cron):
+            raise ValueError('Unsupported cron expression')
+
+
+def enqueue_calendar_task(task: CalendarTask) -> Future:
+    """Schedules creation of task for the calendar event
+
+    :param task: calendar task
+    :return: future of the created cloud task
+    """
+    return executor.submit(
+        with_trace(get_task_backend().create_task),
+        get_task_settings().queue_path,
+        task.to_task_request()
+    )
 
 
 @app.route('/', methods=['POST'])
@@ -206,23 +518,20 @@ def create_calendar_event():
 
     Accepts following json request attributes:
     - message: string message of the calendar event
-    - timestamp: RFC 3339 timestamp (ISO format) of when the event is happening
+    - timestamp: RFC 3339 timestamp of when the event is happening (local time if the offset is not set)
     - timedelta: number of seconds that must pass until the event is triggered
     - repeat: number of times the event will repeat after the set timedelta
+    - rrule: RFC 5545 recurrence rule of a recurring event (e.g. `FREQ=DAILY;BYHOUR=9;COUNT=10`)
+    - cron: cron expression of a recurring event (e.g. `0 9 * * MON-FRI`)
+    - counter_shards: number of execution counter shards for frequently executed events
 
     timestamp and timedelta are mutually exclusive
     periodic is used only for timedelta events
+    rrule and cron are mutually exclusive, timestamp is the start of the recurrence
+    all invalid attributes are reported at once in the `errors` response attribute
 
     :return: newly created calendar event
     """
-
-    def check_timestamp(value):
-        if value is None:
-            return None
-        if not isinstance(value, str):
-            raise ValueError('Must be a string')
-        return parse(value)
-
     request_json = request.get_json(silent=True)
     logging.info({
         "method": request.method,
@@ -230,37 +539,174 @@ def create_calendar_event():
         "request": request_json
     })
 
-    message = request_json.get('message', "Empty Message")
-
     try:
-        timestamp = check_timestamp(request_json.get('timestamp'))
-        if timestamp and timestamp <= datetime.datetime.now():
-            return bad_request("Invalid timestamp (must be a future timestamp)")
-    except Exception as ex:
-        return bad_request("Invalid timestamp ({})".format(str(ex)))
+        task = parse_calendar_task(request_json)
+    except ValidationError as ex:
+        return bad_request(str(ex), ex.errors)
+
+    # write the event and enqueue its task at the same time
+    # the event and the statistics are written atomically
+    db = get_db()
+    day = today()
+    task_dict = task.to_dict()
+    event_reference = db.collection('events').document(task.id)
+    batch = db.batch()
+    batch.set(event_reference, task_dict)
+    increment_stats(batch, db, day, created=1)
+    write = executor.submit(with_trace(commit_batch), batch)
+    enqueue = enqueue_calendar_task(task)
+
+    # roll back the half that succeeded so no orphan remains
+    write_error = write.exception()
+    enqueue_error = enqueue.exception()
+    if enqueue_error:
+        if not write_error:
+            rollback = db.batch()
+            rollback.delete(event_reference)
+            increment_stats(rollback, db, day, created=-1)
+            commit_batch(rollback)
+        raise enqueue_error
+    if write_error:
+        get_task_backend().delete_task(task.name)
+        raise write_error
+
+    mirror = get_events_mirror()
+    if mirror:
+        mirror.upsert(task.id, task_dict)
+    return json_response(task_dict, 201)
+
+
+@app.route('/stats', methods=['GET'])
+def get_calendar_stats():
+    """Returns statistics of calendar events
+
+    Statistics are read from sharded aggregate counters maintained by event creation and
+    execution, so the number of reads does not depend on the number of events.
+
+    Accepts following query parameters:
+    - days: number of days of the daily breakdown including today (defaults to 7)
+
+    :returns: numbers of created, processed and pending events, executions and their daily breakdown
+    """
+    logging.info({
+        "method": request.method,
+        "endpoint": request.endpoint,
+        "args": request.args.to_dict(),
+    })
 
-    timedelta = request_json.get('timedelta')
-    if timedelta is not None and not isinstance(timedelta, int):
-        return bad_request("Invalid timedelta (Must be an integer)")
+    days = request.args.get('days', '7')
+    if not days.isdigit() or not 0 <= int(days) <= MAX_STATS_DAYS:
+        return bad_request('Invalid days (must be an integer between 0 and {})'.format(MAX_STATS_DAYS))
+    return json_response(read_stats(get_db(), int(days)), 200)
 
-    repeat = request_json.get('repeat')
-    if repeat is not None and not isinstance(repeat, int):
-        return bad_request("Invalid repeat (Must be an integer)")
 
-    if not timedelta and not timestamp:
-        return bad_request("at least one of timestamp and timedelta must be set")
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Returns latency histograms of the function instance in the prometheus text format
 
-    # create new task
-    task = CalendarTask(
-        timestamp=timestamp,
-        timedelta=timedelta,
-        repeat=repeat,
-        message=message
-    )
-    task_dict = task.to_dict()
-    db.collection('events').document(task.id).set(task_dict)
-    client.create_task(
-        parent=task_queue,
-        task=task.to_task_request()
-    )
-    return task_dict, 201
+    Histograms hold durations of the requests (`calendar_api`) and of their outbound calls
+    (e.g. `firestore.commit` or `tasks.create_task`) processed by the instance which serves
+    the metrics request, latency of all instances is exported by log-based metrics.
+
+    The endpoint is disabled unless `METRICS_TOKEN` is set, requests must send the token
+    in the `Authorization: Bearer <token>` header.
+
+    :returns: metrics exposition
+    """
+    if not metrics_token:
+        return Response('Not Found', status=404, mimetype='text/plain')
+    authorization = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(authorization.encode('utf-8'), 'Bearer {}'.format(metrics_token).encode('utf-8')):
+        return Response('Unauthorized', status=401, mimetype='text/plain', headers={'WWW-Authenticate': 'Bearer'})
+    return Response(prometheus_text(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/batch', methods=['POST'])
+def create_calendar_events():
+    """Creates multiple calendar events at once
+
+    Accepts json request with `events` attribute containing list of calendar events
+    in the same format as accepted by `create_calendar_event`. Events are written in
+    batched commits and their tasks are enqueued concurrently.
+
+    :return: per-event results in the order of the request events
+    """
+    request_json = request.get_json(silent=True)
+    events = request_json.get('events') if isinstance(request_json, dict) else None
+    logging.info({
+        "method": request.method,
+        "endpoint": request.endpoint,
+        "events": len(events) if isinstance(events, list) else None
+    })
+
+    if not isinstance(events, list) or not events:
+        return bad_request("Invalid events (must be a non-empty list)")
+    if len(events) > MAX_BATCH_SIZE:
+        return bad_request("Invalid events (at most {} events are allowed)".format(MAX_BATCH_SIZE))
+
+    results: typing.List[dict] = [{}] * len(events)
+    tasks_to_create: typing.List[typing.Tuple[int, CalendarTask]] = []
+    for index, event in enumerate(events):
+        try:
+            tasks_to_create.append((index, parse_calendar_task(event)))
+        except ValidationError as ex:
+            results[index] = {'status': 400, 'error': str(ex), 'errors': ex.errors}
+
+    # commit events in batches, enqueue tasks of committed batches while the next one is written
+    db = get_db()
+    day = today()
+    collection = db.collection('events')
+    enqueued: typing.List[typing.Tuple[int, CalendarTask, dict, Future]] = []
+    # one write of each batch is left for the statistics increment
+    for start in range(0, len(tasks_to_create), FIRESTORE_BATCH_SIZE - 1):
+        chunk = tasks_to_create[start:start + FIRESTORE_BATCH_SIZE - 1]
+        batch = db.batch()
+        task_dicts = []
+        for _, task in chunk:
+            task_dict = task.to_dict()
+            batch.set(collection.document(task.id), task_dict)
+            task_dicts.append(task_dict)
+        increment_stats(batch, db, day, created=len(chunk))
+        try:
+            commit_batch(batch)
+        except Exception as ex:
+            for index, _ in chunk:
+                results[index] = {'status': 500, 'error': "Failed to store event ({})".format(str(ex))}
+            continue
+        for (index, task), task_dict in zip(chunk, task_dicts):
+            enqueued.append((index, task, task_dict, enqueue_calendar_task(task)))
+
+    # collect enqueue results and roll back events without a task
+    rollback = db.batch()
+    rollback_size = 0
+    for index, task, task_dict, future in enqueued:
+        error = future.exception()
+        if error:
+            results[index] = {'status': 500, 'error': "Failed to enqueue event ({})".format(str(error))}
+            rollback.delete(collection.document(task.id))
+            rollback_size += 1
+            if rollback_size == FIRESTORE_BATCH_SIZE - 1:
+                increment_stats(rollback, db, day, created=-rollback_size)
+                commit_batch(rollback)
+                rollback = db.batch()
+                rollback_size = 0
+        else:
+            results[index] = {'status': 201, 'object': task_dict}
+    if rollback_size:
+        increment_stats(rollback, db, day, created=-rollback_size)
+        commit_batch(rollback)
+
+    mirror = get_events_mirror()
+    if mirror:
+        for index, task, task_dict, _ in enqueued:
+            if results[index]['status'] == 201:
+                mirror.upsert(task.id, task_dict)
+
+    failed = sum(1 for result in results if result['status'] != 201)
+    if failed:
+        logging.warning({
+            "message": "Failed to create some of the batch events",
+            "failed": failed,
+            "total": len(results)
+        })
+    return json_response({'results': results}, 207 if failed else 201)
@@ -0,0 +1,119 @@
+import hashlib
+import json
+import threading
+import typing
+
+if typing.TYPE_CHECKING:
+    from google.cloud.firestore import (
+        CollectionReference,
+        DocumentSnapshot,
+    )
+    from google.cloud.firestore_v1.watch import DocumentChange
+
+
+class CollectionMirror:
+    """In-memory copy of a firestore collection kept current by a snapshot listener
+
+    Listing of the whole collection is serialized once per change of the collection
+    and served together with its strong ETag until the collection changes again.
+    Listing is not served while the collection contains a document which is bypassed
+    (e.g. it depends on other documents, which are not mirrored).
+    """
+
+    def __init__(
+            self,
+            collection: 'CollectionReference',
+            default: typing.Callable = None,
+            bypass: typing.Callable[[dict], bool] = None
+    ):
+        """
+        :param collection: mirrored collection
+        :param default: json serializer of values unknown to the json module
+        :param bypass: flags documents which can not be listed from the mirror
+        """
+        self._collection = collection
+        self._default = default
+        self._bypass = bypass
+        self._bypassed: typing.Set[str] = set()
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._documents: typing.Dict[str, dict] = {}
+        self._version = 0
+        self._listing: typing.Tuple[int, bytes, str] = (-1, b'', '')
+        self._watch = None
+
+    def start(self):
+        """Starts listening to collection changes"""
+        with self._lock:
+            if self._watch is None:
+                self._watch = self._collection.on_snapshot(self._on_snapshot)
+
+    def stop(self):
+        """Stops listening to collection changes, the mirror is not used until it is started again"""
+        with self._lock:
+            if self._watch is not None:
+                self._watch.unsubscribe()
+                self._watch = None
+            self._ready.clear()
+
+    @property
+    def ready(self) -> bool:
+        """Flags whether the mirror received the initial collection snapshot"""
+        return self._ready.is_set()
+
+    def _on_snapshot(
+            self,
+            snapshots: typing.List['DocumentSnapshot'],
+            changes: typing.List['DocumentChange'],
+            read_time
+    ):
+        """Applies collection changes delivered by the snapshot listener"""
+        with self._lock:
+            for change in changes:
+                if change.type.name == 'REMOVED':
+                    self._documents.pop(change.document.id, None)
+                    self._bypassed.discard(change.document.id)
+                else:
+                    self._store(change.document.id, change.document.to_dict())
+            self._version += 1
+        self._ready.set()
+
+    def _store(self, document_id: str, document: dict):
+        self._documents[document_id] = document
+        if self._bypass and self._bypass(document):
+            self._bypassed.add(document_id)
+        else:
+            self._bypassed.discard(document_id)
+
+    def upsert(self, document_id: str, document: dict):
+        """Stores document written by this instance without waiting for the listener
+
+        :param document_id: document ID
+        :param document: document data
+        """
+        with self._lock:
+            self._store(document_id, document)
+            self._version += 1
+
+    def listing(self) -> typing.Optional[typing.Tuple[bytes, str]]:
+        """Returns serialized listing of all mirrored documents ordered by their ID
+
+        :return: json listing and its ETag or None if the mirror is not ready yet or it contains bypassed documents
+        """
+        if not self.ready:
+            return None
+        with self._lock:
+            if self._bypassed:
+                return None
+            version, body, etag = self._listing
+            if version == self._version:
+                return body, etag
+            version = self._version
+            documents = [self._documents[document_id] for document_id in sorted(self._documents)]
+
+        body = json.dumps({'objects': documents, 'next_page_token': None}, default=self._default).encode('utf-8')
+        etag = hashlib.sha1(body).hexdigest()
+        with self._lock:
+            if version > self._listing[0]:
+                self._listing = (version, body, etag)
+        return body, etag
@@ -0,0 +1,142 @@
+import datetime
+import re
+import typing
+
+RFC3339_PATTERN = re.compile(
+    r'^(\d{4})-(\d{2})-(\d{2})[Tt ](\d{2}):(\d{2}):(\d{2})(?:\.(\d{1,9}))?(?:([Zz])|([+-])(\d{2}):(\d{2}))?$'
+)
+
+
+class ValidationError(ValueError):
+    """Request attributes are invalid, `errors` contains error messages of all invalid attributes"""
+
+    def __init__(self, errors: typing.Dict[str, str]):
+        super().__init__('; '.join(errors.values()))
+        self.errors = errors
+
+
+class Field(typing.NamedTuple):
+    """Request attribute
+
+    `check` converts the attribute value and raises ValueError if it is invalid,
+    it is not called for missing (or null) attributes which get the default value.
+    """
+    name: str
+    check: typing.Optional[typing.Callable[[typing.Any], typing.Any]] = None
+    default: typing.Any = None
+
+
+class Schema:
+    """Validator of request objects built once from the attribute fields"""
+
+    def __init__(self, *fields: Field):
+        self._fields = tuple(fields)
+
+    def validate(self, value: dict) -> typing.Tuple[typing.Dict[str, typing.Any], typing.Dict[str, str]]:
+        """Converts values of all fields
+
+        :param value: request object
+        :return: converted values of all fields (defaults of invalid fields) and error messages of invalid fields
+        """
+        values = {}
+        errors = {}
+        for name, check, default in self._fields:
+            raw = value.get(name)
+            if raw is None:
+                values[name] = default
+            elif check is None:
+                values[name] = raw
+            else:
+                try:
+                    values[name] = check(raw)
+                except ValueError as ex:
+                    values[name] = default
+                    errors[name] = 'Invalid {} ({})'.format(name, str(ex))
+        return values, errors
+
+
+def string(value) -> str:
+    if not isinstance(value, str):
+        raise ValueError('Must be a string')
+    return value
+
+
+def integer(minimum: int = None, maximum: int = None) -> typing.Callable[[typing.Any], int]:
+    """Creates check of integer values (booleans are rejected)
+
+    :param minimum: minimal allowed value
+    :param maximum: maximal allowed value
+    :return: integer check
+    """
+    if minimum is not None and maximum is not None:
+        message = 'Must be an integer between {} and {}'.format(minimum, maximum)
+    else:
+        message = 'Must be an integer'
+
+    def check(value) -> int:
+        if not isinstance(value, int) or isinstance(value, bool):
+            raise ValueError(message)
+        if (minimum is not None and value < minimum) or (maximum is not None and value > maximum):
+            raise ValueError(message)
+        return value
+
+    return check
+
+
+def parse_rfc3339(value: str) -> datetime.datetime:
+    """Parses RFC 3339 timestamp to naive local datetime
+
+    Timestamps without the UTC offset are taken as local time, fractional seconds are
+    truncated to microseconds.
+
+    :param value: timestamp string, e.g. `2020-05-01T09:00:00.5+02:00`
+    :return: naive local datetime
+    :raises ValueError: if the value is not a valid RFC 3339 timestamp
+    """
+    match = RFC3339_PATTERN.match(value)
+    if not match:
+        raise ValueError('Must be an RFC 3339 timestamp')
+    year, month, day, hour, minute, second, fraction, utc, sign, offset_hours, offset_minutes = match.groups()
+    timestamp = datetime.datetime(
+        int(year),
+        int(month),
+        int(day),
+        int(hour),
+        int(minute),
+        int(second),
+        int(fraction[:6].ljust(6, '0')) if fraction else 0
+    )
+    if utc:
+        offset = datetime.timedelta(0)
+    elif sign:
+        offset = datetime.timedelta(hours=int(offset_hours), minutes=int(offset_minutes))
+        if sign == '-':
+            offset = -offset
+    else:
+        return timestamp
+    return timestamp.replace(tzinfo=datetime.timezone(offset)).astimezone().replace(tzinfo=None)
+
+
+def timestamp(lenient: bool = False) -> typing.Callable[[typing.Any], datetime.datetime]:
+    """Creates check of timestamp strings
+
+    :param lenient: fall back to the free-form dateutil parser for non RFC 3339 timestamps
+    :return: timestamp check returning naive local datetime
+    """
+
+    def check(value) -> datetime.datetime:
+        value = string(value)
+        try:
+            return parse_rfc3339(value)
+        except ValueError:
+            if not lenient:
+                raise
+        from dateutil.parser import parse
+
+        try:
+            parsed = parse(value)
+        except OverflowError as ex:
+            raise ValueError(str(ex))
+        return parsed.astimezone().replace(tzinfo=None) if parsed.tzinfo else parsed
+
+    return check
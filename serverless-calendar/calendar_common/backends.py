@@ -0,0 +1,255 @@
+import abc
+import datetime
+import heapq
+import itertools
+import logging
+import threading
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+from calendar_common.instrumentation import span
+
+if typing.TYPE_CHECKING:
+    from google.cloud.tasks import CloudTasksClient
+
+
+class TaskAlreadyExists(Exception):
+    """Task with the same name has already been created"""
+
+
+class TaskBackend(abc.ABC):
+    """Scheduler of calendar task requests (see `CalendarTask.to_task_request`)"""
+
+    @abc.abstractmethod
+    def create_task(self, parent: str, task: dict):
+        """Schedules task
+
+        :param parent: queue path
+        :param task: task request
+        :raises TaskAlreadyExists: if task with the same name has already been created
+        """
+
+    @abc.abstractmethod
+    def delete_task(self, name: str):
+        """Deletes scheduled task
+
+        :param name: task name
+        """
+
+
+class CloudTasksBackend(TaskBackend):
+    """GCP Cloud Tasks backend"""
+
+    def __init__(self):
+        self._client: typing.Optional['CloudTasksClient'] = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self) -> 'CloudTasksClient':
+        """Cloud tasks client created on the first use"""
+        with self._lock:
+            if self._client is None:
+                from google.cloud import tasks
+
+                self._client = tasks.CloudTasksClient()
+        return self._client
+
+    def create_task(self, parent: str, task: dict):
+        from google.api_core.exceptions import AlreadyExists
+
+        try:
+            with span('tasks.create_task'):
+                self.client.create_task(parent=parent, task=task)
+        except AlreadyExists:
+            raise TaskAlreadyExists(task.get('name'))
+
+    def delete_task(self, name: str):
+        with span('tasks.delete_task'):
+            self.client.delete_task(name=name)
+
+
+class LocalTaskBackend(TaskBackend):
+    """In-process scheduler for running and load-testing the calendar without GCP
+
+    Pending tasks are kept in a priority queue ordered by their schedule time. A scheduler
+    thread pops due tasks and hands them to a pool of worker threads which call `dispatch`
+    with the task request. Failed dispatches are retried with exponential backoff, similar
+    to cloud tasks. Deleted tasks are dropped lazily when they become due.
+    """
+
+    def __init__(
+            self,
+            dispatch: typing.Callable[[dict], typing.Any],
+            workers: int = 8,
+            max_attempts: int = 5,
+            min_backoff: float = 0.1
+    ):
+        """
+        :param dispatch: function processing task request
+        :param workers: number of concurrently dispatched tasks
+        :param max_attempts: maximal number of dispatch attempts of one task
+        :param min_backoff: seconds before the first retry of a failed task
+        """
+        self.dispatch = dispatch
+        self.max_attempts = max_attempts
+        self.min_backoff = min_backoff
+        self._heap: typing.List[typing.Tuple[float, int, int, dict]] = []
+        self._sequence = itertools.count()
+        self._names: typing.Set[str] = set()
+        self._deleted: typing.Set[str] = set()
+        self._condition = threading.Condition()
+        self._running = True
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='local-task')
+        self._latencies: typing.List[float] = []
+        self._dispatched = 0
+        self._failed = 0
+        self._scheduler = threading.Thread(target=self._run, name='local-scheduler', daemon=True)
+        self._scheduler.start()
+
+    @staticmethod
+    def due_time(task: dict) -> float:
+        """Returns task schedule time as a local timestamp
+
+        Calendar tasks convert naive local datetime to the protobuf timestamp, so the same
+        conversion is reversed here.
+        """
+        schedule_time = task.get('schedule_time')
+        if schedule_time is None:
+            return time.time()
+        if not isinstance(schedule_time, datetime.datetime):
+            schedule_time = schedule_time.ToDatetime()
+        return schedule_time.timestamp()
+
+    def create_task(self, parent: str, task: dict):
+        with self._condition:
+            name = task.get('name')
+            if name:
+                if name in self._names:
+                    raise TaskAlreadyExists(name)
+                self._names.add(name)
+            self._push(self.due_time(task), 1, task)
+
+    def delete_task(self, name: str):
+        with self._condition:
+            if name in self._names:
+                self._deleted.add(name)
+
+    @property
+    def pending(self) -> int:
+        """Number of tasks waiting for dispatch"""
+        return len(self._heap)
+
+    def _push(self, due: float, attempt: int, task: dict):
+        heapq.heappush(self._heap, (due, next(self._sequence), attempt, task))
+        if self._heap[0][3] is task:
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._running and (not self._heap or self._heap[0][0] > time.time()):
+                    self._condition.wait(self._heap[0][0] - time.time() if self._heap else None)
+                if not self._running:
+                    return
+                due, _, attempt, task = heapq.heappop(self._heap)
+                name = task.get('name')
+                if name in self._deleted:
+                    self._deleted.discard(name)
+                    continue
+            self._executor.submit(self._dispatch, due, attempt, task)
+
+    def _dispatch(self, due: float, attempt: int, task: dict):
+        started = time.time()
+        try:
+            self.dispatch(task)
+        except Exception as ex:
+            with self._condition:
+                if attempt < self.max_attempts:
+                    self._push(time.time() + self.min_backoff * 2 ** (attempt - 1), attempt + 1, task)
+                    return
+                self._failed += 1
+            logging.error({
+                "message": "Local task failed",
+                "task": task.get('name'),
+                "error": str(ex)
+            })
+        finally:
+            if attempt == 1:
+                self._latencies.append(started - due)
+        with self._condition:
+            self._dispatched += 1
+
+    def stats(self) -> dict:
+        """Returns dispatch statistics
+
+        :return: number of pending, dispatched and failed tasks and scheduling latency percentiles (seconds)
+        """
+        latencies = sorted(self._latencies)
+
+        def percentile(value: float) -> typing.Optional[float]:
+            return latencies[min(len(latencies) - 1, int(len(latencies) * value))] if latencies else None
+
+        return {
+            'pending': self.pending,
+            'dispatched': self._dispatched,
+            'failed': self._failed,
+            'latency_p50': percentile(0.5),
+            'latency_p99': percentile(0.99),
+            'latency_max': latencies[-1] if latencies else None,
+        }
+
+    def shutdown(self, wait: bool = True):
+        """Stops the scheduler, pending tasks are not dispatched"""
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._scheduler.join()
+        self._executor.shutdown(wait=wait)
+
+
+def http_dispatcher(callback: typing.Callable) -> typing.Callable[[dict], typing.Any]:
+    """Creates dispatch function calling http cloud function with the task request
+
+    :param callback: cloud function (e.g. `calendar_event_callback`)
+    :return: dispatch function for `LocalTaskBackend`
+    """
+    from flask import Request
+    from werkzeug.test import EnvironBuilder
+
+    def dispatch(task: dict):
+        http_request = task['http_request']
+        environ = EnvironBuilder(
+            method=http_request.get('http_method', 'POST'),
+            headers={
+                **http_request.get('headers', {}),
+                'X-CloudTasks-TaskName': task.get('name', '').rsplit('/', 1)[-1],
+            },
+            data=http_request.get('body')
+        ).get_environ()
+        response = callback(Request(environ))
+        status = response[1] if isinstance(response, tuple) else getattr(response, 'status_code', 200)
+        if status >= 300:
+            raise RuntimeError('Task callback responded with status {}'.format(status))
+
+    return dispatch
+
+
+_task_backend: typing.Optional[TaskBackend] = None
+
+
+def get_task_backend() -> TaskBackend:
+    """Returns task backend of the process (cloud tasks unless set otherwise)"""
+    global _task_backend
+    if _task_backend is None:
+        _task_backend = CloudTasksBackend()
+    return _task_backend
+
+
+def set_task_backend(backend: TaskBackend):
+    """Sets task backend of the process
+
+    :param backend: task backend used by all calendar functions in the process
+    """
+    global _task_backend
+    _task_backend = backend
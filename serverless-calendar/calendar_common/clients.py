@@ -0,0 +1,32 @@
+import logging
+import typing
+from functools import lru_cache
+
+if typing.TYPE_CHECKING:
+    from google.cloud.firestore import Client
+
+
+@lru_cache(maxsize=None)
+def setup_logging() -> logging.Logger:
+    """Attaches cloud logging handler to the cloud logger on the first use
+
+    :return: cloud logger
+    """
+    from google.cloud import logging as cloud_logging
+
+    log_client = cloud_logging.Client()
+    cloud_logger = logging.getLogger("cloudLogger")
+    cloud_logger.setLevel(logging.INFO)
+    cloud_logger.addHandler(log_client.get_default_handler())
+    return cloud_logger
+
+
+@lru_cache(maxsize=None)
+def get_db() -> 'Client':
+    """Creates firestore client with the default credentials on the first use
+
+    :return: firestore client
+    """
+    from google.cloud import firestore
+
+    return firestore.Client()
@@ -0,0 +1,97 @@
+import random
+import typing
+
+from calendar_common.instrumentation import span
+
+if typing.TYPE_CHECKING:
+    from google.cloud.firestore import (
+        DocumentReference,
+        WriteBatch,
+    )
+
+SHARDS_COLLECTION = 'counter_shards'
+
+
+def to_increments(counters: typing.Dict[str, typing.Any]) -> dict:
+    from google.cloud.firestore import Increment
+
+    return {
+        counter: to_increments(amount) if isinstance(amount, dict) else Increment(amount)
+        for counter, amount in counters.items()
+    }
+
+
+def to_field_paths(values: dict, prefix: str = '') -> dict:
+    """Flattens nested maps to field paths, so an update does not replace the whole maps
+
+    Field names are joined with dots unquoted, so they must be simple names (letters, digits, underscores).
+    """
+    paths = {}
+    for field, value in values.items():
+        if isinstance(value, dict):
+            paths.update(to_field_paths(value, prefix + field + '.'))
+        else:
+            paths[prefix + field] = value
+    return paths
+
+
+def add_counters(target: dict, counters: dict) -> dict:
+    """Adds counter values (nested in maps) to the target"""
+    for counter, value in counters.items():
+        if isinstance(value, dict):
+            add_counters(target.setdefault(counter, {}), value)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            target[counter] = target.get(counter, 0) + value
+    return target
+
+
+def increment_counters(
+        batch: 'WriteBatch',
+        reference: 'DocumentReference',
+        counters: typing.Dict[str, typing.Any],
+        shards: int = 0,
+        fields: dict = None,
+        must_exist: bool = False
+):
+    """Adds server-side increment of counters to the write batch
+
+    Counters are incremented without reading the document. If shards are set, the increment
+    lands in a random shard document of the `counter_shards` subcollection, so concurrent
+    increments do not contend on a single document. Sharded counter value is the sum of
+    the counter in the document and in all of its shards (see `read_counters`).
+
+    :param batch: write batch
+    :param reference: counter document reference
+    :param counters: counter fields and amounts to add, nested dicts increment counters in maps
+    :param shards: number of counter shards (0 for unsharded counters)
+    :param fields: other fields to set in the counter document
+    :param must_exist: update the counter document instead of creating it, the batch then fails with
+        `NotFound` if the document does not exist (shards are still created, they are not listed)
+    """
+    increments = to_increments(counters)
+    if not shards:
+        update = {**increments, **(fields or {})}
+    else:
+        shard_reference = reference.collection(SHARDS_COLLECTION).document(str(random.randrange(shards)))
+        batch.set(shard_reference, increments, merge=True)
+        update = fields
+    if not update:
+        return
+    if must_exist:
+        batch.update(reference, to_field_paths(update))
+    else:
+        batch.set(reference, update, merge=True)
+
+
+def read_counters(reference: 'DocumentReference') -> dict:
+    """Reads sharded counters, counters of the document and all of its shards are summed
+
+    :param reference: counter document reference
+    :return: counter values, other fields of the counter document are omitted
+    """
+    with span('firestore.get'):
+        totals = add_counters({}, reference.get().to_dict() or {})
+    with span('firestore.query', collection=SHARDS_COLLECTION):
+        for shard in reference.collection(SHARDS_COLLECTION).stream():
+            add_counters(totals, shard.to_dict())
+    return totals
@@ -0,0 +1,324 @@
+import bisect
+import contextvars
+import functools
+import logging
+import os
+import threading
+import time
+import typing
+from contextlib import contextmanager
+
+# upper bounds of latency histogram buckets in milliseconds
+LATENCY_BUCKETS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+# histograms are logged at most once per interval (0 disables the histogram log entries)
+METRICS_LOG_INTERVAL = float(os.getenv('METRICS_LOG_INTERVAL', 60))
+# spans over the limit are only counted in the request log entry
+MAX_TRACE_SPANS = 200
+METRIC_NAME = 'latency_milliseconds'
+
+
+class Histogram:
+    """Latency histogram with fixed buckets, safe to observe from multiple threads"""
+    __slots__ = ('counts', 'count', 'sum', '_lock')
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        """Adds latency to the histogram
+
+        :param value: latency in milliseconds
+        """
+        index = bisect.bisect_left(LATENCY_BUCKETS, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def snapshot(self) -> dict:
+        """Returns count, sum and cumulative bucket counts of the histogram
+
+        :return: histogram values, buckets are keyed by their upper bounds
+        """
+        with self._lock:
+            counts = list(self.counts)
+            snapshot = {'count': self.count, 'sum': round(self.sum, 3)}
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        snapshot['buckets'] = buckets
+        return snapshot
+
+
+class Trace:
+    """Timings of one request
+
+    Spans of outbound calls made while the trace is current are collected in the trace and
+    logged with the request log entry when the trace finishes. `service_ms` of the entry sums
+    span durations by the service (the span name prefix), it can be extracted by log-based
+    distribution metrics which do not read lists.
+    """
+
+    def __init__(self, name: str, **fields):
+        """
+        :param name: traced function name
+        :param fields: other fields of the request log entry
+        """
+        self.name = name
+        self.fields = fields
+        self.spans: typing.List[dict] = []
+        self.service_ms: typing.Dict[str, float] = {}
+        self.dropped_spans = 0
+        # the trace is finished by `traced_stream` once the streamed response ends
+        self.streamed = False
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def annotate(self, **fields):
+        """Adds fields to the request log entry"""
+        self.fields.update(fields)
+
+    def add_span(self, name: str, started: float, duration: float, error: str = None, **attributes):
+        """Records span of an outbound call
+
+        :param name: span name (`service.operation`)
+        :param started: perf counter value of the span start
+        :param duration: span duration in milliseconds
+        :param error: exception type name if the call failed
+        :param attributes: other attributes of the span
+        """
+        entry = {
+            'name': name,
+            'start_ms': round((started - self.started) * 1000, 3),
+            'duration_ms': round(duration, 3),
+            **attributes
+        }
+        if error:
+            entry['error'] = error
+        service = name.split('.', 1)[0]
+        with self._lock:
+            self.service_ms[service] = self.service_ms.get(service, 0) + duration
+            if len(self.spans) < MAX_TRACE_SPANS:
+                self.spans.append(entry)
+            else:
+                self.dropped_spans += 1
+
+    def finish(self):
+        """Observes the request duration and logs the request log entry"""
+        duration = (time.perf_counter() - self.started) * 1000
+        get_histogram(self.name).observe(duration)
+        logging.info(self.to_dict(duration))
+        log_histograms()
+
+    def to_dict(self, duration: float) -> dict:
+        """Creates request log entry
+
+        :param duration: request duration in milliseconds
+        :return: log entry
+        """
+        with self._lock:
+            entry = {
+                'message': 'Request finished',
+                'trace': self.name,
+                'duration_ms': round(duration, 3),
+                **self.fields,
+                'service_ms': {service: round(value, 3) for service, value in self.service_ms.items()},
+                'spans': sorted(self.spans, key=lambda span_entry: span_entry['start_ms']),
+            }
+            if self.dropped_spans:
+                entry['dropped_spans'] = self.dropped_spans
+        return entry
+
+
+_histograms: typing.Dict[str, Histogram] = {}
+_histograms_lock = threading.Lock()
+_current_trace: contextvars.ContextVar = contextvars.ContextVar('trace', default=None)
+_last_log = time.monotonic()
+
+
+def get_histogram(name: str) -> Histogram:
+    """Returns latency histogram of the span or trace, created on the first use
+
+    :param name: span or trace name
+    :return: latency histogram
+    """
+    histogram = _histograms.get(name)
+    if histogram is None:
+        with _histograms_lock:
+            histogram = _histograms.setdefault(name, Histogram())
+    return histogram
+
+
+@contextmanager
+def span(name: str, **attributes) -> typing.Iterator[None]:
+    """Times outbound call
+
+    The latency is observed in the histogram of the span and added to the current trace
+    (calls made outside of a traced request, e.g. by background threads, are only observed).
+
+    :param name: span name (`service.operation`, e.g. `firestore.commit`)
+    :param attributes: other attributes of the span
+    """
+    started = time.perf_counter()
+    error = None
+    try:
+        yield
+    except Exception as ex:
+        error = type(ex).__name__
+        raise
+    finally:
+        duration = (time.perf_counter() - started) * 1000
+        get_histogram(name).observe(duration)
+        current = _current_trace.get()
+        if current is not None:
+            current.add_span(name, started, duration, error, **attributes)
+
+
+def with_trace(function: typing.Callable) -> typing.Callable:
+    """Binds function to the current trace, so spans of its calls in executor threads are traced
+
+    :param function: function called by another thread
+    :return: function running with the trace of the calling thread
+    """
+    current = _current_trace.get()
+    if current is None:
+        return function
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        token = _current_trace.set(current)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _current_trace.reset(token)
+
+    return wrapper
+
+
+@contextmanager
+def trace(name: str, **fields) -> typing.Iterator[Trace]:
+    """Traces request processing
+
+    The request duration is observed in the histogram of the trace name and the request log
+    entry with spans of all outbound calls is logged once the request is processed.
+
+    :param name: traced function name
+    :param fields: other fields of the request log entry
+    :return: request trace
+    """
+    request_trace = Trace(name, **fields)
+    token = _current_trace.set(request_trace)
+    try:
+        yield request_trace
+    except Exception as ex:
+        request_trace.annotate(error=type(ex).__name__)
+        raise
+    finally:
+        _current_trace.reset(token)
+        if not request_trace.streamed:
+            request_trace.finish()
+
+
+def traced_stream(request_trace: Trace, chunks: typing.Iterable) -> typing.Iterator:
+    """Continues the trace while the streamed response body is generated
+
+    The body is generated after the request handler returns, so the trace is finished once the
+    stream ends (or fails) instead of at the end of the `trace` block, and calls made by the
+    generator are added to it.
+
+    :param request_trace: trace of the request, must be called within its `trace` block
+    :param chunks: response body chunks
+    :return: traced response body chunks
+    """
+    request_trace.streamed = True
+
+    def generate():
+        previous = _current_trace.get()
+        _current_trace.set(request_trace)
+        try:
+            yield from chunks
+        except Exception as ex:
+            request_trace.annotate(error=type(ex).__name__)
+            raise
+        finally:
+            _current_trace.set(previous)
+            request_trace.finish()
+
+    return generate()
+
+
+def traced(name: str) -> typing.Callable:
+    """Decorator tracing every call of the cloud function entry point
+
+    Status of `(body, status)` responses is added to the request log entry.
+
+    :param name: traced function name
+    :return: decorator
+    """
+
+    def decorator(function: typing.Callable) -> typing.Callable:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with trace(name) as request_trace:
+                response = function(*args, **kwargs)
+                if isinstance(response, tuple) and len(response) > 1 and isinstance(response[1], int):
+                    request_trace.annotate(status=response[1])
+                return response
+
+        return wrapper
+
+    return decorator
+
+
+def histograms() -> typing.Dict[str, dict]:
+    """Returns snapshots of all latency histograms of the instance
+
+    :return: histogram snapshots by the span or trace name
+    """
+    with _histograms_lock:
+        items = sorted(_histograms.items())
+    return {name: histogram.snapshot() for name, histogram in items}
+
+
+def log_histograms(force: bool = False):
+    """Logs latency histograms of the instance if `METRICS_LOG_INTERVAL` passed since the last entry
+
+    :param force: log the histograms regardless of the interval
+    """
+    global _last_log
+
+    now = time.monotonic()
+    if not force and (not METRICS_LOG_INTERVAL or now - _last_log < METRICS_LOG_INTERVAL):
+        return
+    _last_log = now
+    logging.info({
+        'message': 'Latency histograms',
+        'histograms': histograms()
+    })
+
+
+def prometheus_text() -> str:
+    """Renders latency histograms of the instance in the prometheus text format
+
+    :return: metrics exposition
+    """
+    lines = [
+        '# HELP {} Latency of requests and outbound calls'.format(METRIC_NAME),
+        '# TYPE {} histogram'.format(METRIC_NAME),
+    ]
+    for name, snapshot in histograms().items():
+        for bound, count in snapshot['buckets'].items():
+            lines.append('{metric}_bucket{{span="{name}",le="{bound}"}} {count}'.format(
+                metric=METRIC_NAME,
+                name=name,
+                bound=bound,
+                count=count
+            ))
+        lines.append('{}_sum{{span="{}"}} {}'.format(METRIC_NAME, name, snapshot['sum']))
+        lines.append('{}_count{{span="{}"}} {}'.format(METRIC_NAME, name, snapshot['count']))
+    return '\n'.join(lines) + '\n'
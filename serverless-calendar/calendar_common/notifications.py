@@ -0,0 +1,173 @@
+import logging
+import queue
+import threading
+import time
+import typing
+
+from calendar_common.instrumentation import span
+
+if typing.TYPE_CHECKING:
+    import requests
+
+SLACK_POST_MESSAGE_URL = 'https://slack.com/api/chat.postMessage'
+# queued by `flush` to end the coalescing window of the worker
+_FLUSH = object()
+
+
+class SlackNotifier:
+    """Posts slack messages from a background thread
+
+    Messages are queued and posted by a single worker thread over a pooled http session,
+    so slack latency is not part of the request processing. Messages queued within the
+    coalescing window are posted as one digest message. Posting is paced to at most one
+    message per `min_interval` seconds and `429 Too Many Requests` responses are retried
+    after the `Retry-After` delay.
+
+    Background thread gets CPU only while the function instance is processing a request
+    (unless CPU is always allocated), use `flush` where the messages must be delivered
+    before the request finishes. Flush posts the queued messages right away, without
+    waiting for the rest of the coalescing window.
+    """
+
+    def __init__(
+            self,
+            token: str,
+            channel: str,
+            coalesce_window: float = 2.0,
+            max_digest_size: int = 50,
+            min_interval: float = 1.0,
+            max_attempts: int = 5
+    ):
+        """
+        :param token: slack API token
+        :param channel: slack channel name or ID
+        :param coalesce_window: seconds to wait for other messages before posting
+        :param max_digest_size: maximal number of messages in one digest
+        :param min_interval: minimal number of seconds between two posts
+        :param max_attempts: maximal number of attempts to post one message
+        """
+        self.channel = channel
+        self.coalesce_window = coalesce_window
+        self.max_digest_size = max_digest_size
+        self.min_interval = min_interval
+        self.max_attempts = max_attempts
+        self._token = token
+        self._queue: queue.Queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker: typing.Optional[threading.Thread] = None
+        self._session: typing.Optional['requests.Session'] = None
+        self._last_post = 0.0
+        self._failures = 0
+
+    def notify(self, text: str):
+        """Queues message for posting
+
+        :param text: message text
+        """
+        self._queue.put(text)
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name='slack-notifier', daemon=True)
+                self._worker.start()
+
+    def flush(self, timeout: float = None) -> bool:
+        """Posts queued messages and waits until they are posted
+
+        :param timeout: maximal number of seconds to wait
+        :return: True if all messages were posted within the timeout (and none of the posts failed)
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        failures = self._failures
+        if self._queue.unfinished_tasks:
+            # wakes the worker waiting for other messages of the digest
+            self._queue.put(_FLUSH)
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return self._failures == failures
+
+    def _run(self):
+        while True:
+            message = self._queue.get()
+            if message is _FLUSH:
+                self._queue.task_done()
+                continue
+            messages = [message]
+            flushes = 0
+            deadline = time.monotonic() + self.coalesce_window
+            while len(messages) < self.max_digest_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    message = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if message is _FLUSH:
+                    flushes += 1
+                    break
+                messages.append(message)
+            try:
+                self._post(self._digest(messages))
+            except Exception as ex:
+                self._failures += 1
+                logging.error({
+                    "message": "Failed to post slack notification",
+                    "error": str(ex),
+                    "notifications": len(messages)
+                })
+            finally:
+                for _ in range(len(messages) + flushes):
+                    self._queue.task_done()
+
+    @staticmethod
+    def _digest(messages: typing.List[str]) -> str:
+        if len(messages) == 1:
+            return messages[0]
+        return '*{count} notifications*\n{messages}'.format(
+            count=len(messages),
+            messages='\n'.join('• {}'.format(message) for message in messages)
+        )
+
+    def _get_session(self) -> 'requests.Session':
+        if self._session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            session = requests.Session()
+            session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=2))
+            session.headers['Authorization'] = 'Bearer {}'.format(self._token)
+            self._session = session
+        return self._session
+
+    def _post(self, text: str):
+        for attempt in range(1, self.max_attempts + 1):
+            wait = self._last_post + self.min_interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            self._last_post = time.monotonic()
+
+            with span('slack.post'):
+                response = self._get_session().post(
+                    SLACK_POST_MESSAGE_URL,
+                    json={'channel': self.channel, 'text': text},
+                    timeout=10
+                )
+            if response.status_code == 429 or response.status_code >= 500:
+                retry_after = float(response.headers.get('Retry-After', 2 ** attempt))
+                logging.warning({
+                    "message": "Slack notification postponed",
+                    "status": response.status_code,
+                    "retry_after": retry_after
+                })
+                time.sleep(retry_after)
+                continue
+
+            result = response.json()
+            if not result.get('ok'):
+                raise RuntimeError(result.get('error', 'unknown slack error'))
+            return
+        raise RuntimeError('Too many failed attempts')
@@ -0,0 +1,84 @@
+import datetime
+import os
+import random
+import typing
+
+from calendar_common.counters import (
+    add_counters,
+    increment_counters,
+    read_counters,
+    to_increments,
+)
+from calendar_common.instrumentation import span
+
+if typing.TYPE_CHECKING:
+    from google.cloud.firestore import (
+        Client,
+        WriteBatch,
+    )
+
+STATS_COLLECTION = 'stats'
+EVENTS_STATS_DOCUMENT = 'events'
+# shards of daily counters, named `{YYYY-MM-DD}_{shard}`, every document holds one day
+DAILY_COLLECTION = 'daily'
+STATS_COUNTERS = ('created', 'processed', 'executions')
+# every event creation and execution increments the statistics, so they are always sharded
+STATS_SHARDS = int(os.getenv('STATS_SHARDS', 20))
+
+
+def today() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).date().isoformat()
+
+
+def increment_stats(batch: 'WriteBatch', db: 'Client', day: str = None, **counters: int):
+    """Adds increment of the event statistics to the write batch
+
+    Counters are incremented in total and in a random shard of the day in the `daily` subcollection,
+    so the total shards do not grow with the number of days and the daily breakdown reads only the
+    shards of the requested days.
+
+    :param batch: write batch of the change which is counted
+    :param db: firestore client
+    :param day: UTC day of the change (today if not set)
+    :param counters: amounts added to the `created`, `processed` and `executions` counters
+    """
+    counters = {counter: amount for counter, amount in counters.items() if amount}
+    if not counters:
+        return
+    day = day or today()
+    reference = db.collection(STATS_COLLECTION).document(EVENTS_STATS_DOCUMENT)
+    increment_counters(batch, reference, counters, shards=STATS_SHARDS)
+    daily_reference = reference.collection(DAILY_COLLECTION).document(
+        '{}_{}'.format(day, random.randrange(STATS_SHARDS))
+    )
+    batch.set(daily_reference, {'day': day, **to_increments(counters)}, merge=True)
+
+
+def read_stats(db: 'Client', days: int = 7) -> dict:
+    """Reads event statistics
+
+    :param db: firestore client
+    :param days: number of days of the daily breakdown (including today)
+    :return: total counters, pending events and counters of the days, the latest day first
+    """
+    reference = db.collection(STATS_COLLECTION).document(EVENTS_STATS_DOCUMENT)
+    totals = read_counters(reference)
+    # maps of the days counted before the daily shards, they no longer grow
+    daily = totals.pop('days', {})
+    stats = {counter: totals.get(counter, 0) for counter in STATS_COUNTERS}
+    stats['pending'] = stats['created'] - stats['processed']
+
+    last_day = datetime.datetime.now(datetime.timezone.utc).date()
+    if days:
+        first_day = (last_day - datetime.timedelta(days=days - 1)).isoformat()
+        query = reference.collection(DAILY_COLLECTION).where('day', '>=', first_day)
+        with span('firestore.query', collection=DAILY_COLLECTION):
+            for shard in query.stream():
+                counters = shard.to_dict()
+                add_counters(daily.setdefault(counters.pop('day'), {}), counters)
+    stats['days'] = []
+    for offset in range(days):
+        day = (last_day - datetime.timedelta(days=offset)).isoformat()
+        counters = daily.get(day, {})
+        stats['days'].append({'day': day, **{counter: counters.get(counter, 0) for counter in STATS_COUNTERS}})
+    return stats
@@ -0,0 +1,275 @@
+import datetime
+import json
+import os
+import typing
+import uuid
+from functools import lru_cache
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if typing.TYPE_CHECKING:
+    from google.protobuf.timestamp_pb2 import Timestamp
+
+# marks task requests of events counted in the statistics, the flag is kept out of the public event payload
+STATS_HEADER = 'X-Calendar-Stats'
+
+
+class TaskSettings(typing.NamedTuple):
+    """Task request values which are fixed for the whole process"""
+    queue_path: str
+    callback_url: typing.Optional[str]
+    headers: dict
+    stats_headers: dict
+    oidc_token: dict
+
+
+@lru_cache(maxsize=None)
+def get_task_settings() -> TaskSettings:
+    """Reads task settings from the environment on the first use
+
+    Shared `headers` (`stats_headers` for events counted in the statistics) and `oidc_token` dicts are put
+    to every task request, they must not be modified.
+
+    :return: task settings
+    """
+    headers = {"Content-Type": "application/json"}
+    return TaskSettings(
+        queue_path='projects/{project_name}/locations/{location}/queues/{queue}'.format(
+            project_name=os.getenv("GCP_PROJECT"),
+            location=os.getenv("FUNCTION_REGION"),
+            queue=os.getenv("QUEUE_NAME")
+        ),
+        callback_url=os.getenv("EVENT_CALLBACK_URL"),
+        headers=headers,
+        stats_headers={**headers, STATS_HEADER: '1'},
+        oidc_token={'service_account_email': os.getenv('SERVICE_ACCOUNT_EMAIL')}
+    )
+
+
+def dumps(value: dict) -> bytes:
+    """Serializes JSON payload, with orjson if it is installed"""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+
+class CalendarTask:
+    """Cloud task of a calendar event
+
+    - initial task is created with the event and it is named by the event ID
+    - repeated tasks of timedelta events are named by the event ID and the number of remaining repetitions
+    - occurrence tasks of recurring events are named by the event ID and the occurrence
+    - materialization tasks (`materialize`, or initial tasks of recurring events) enqueue the occurrences
+    - digest tasks (`digest`) post stored slack messages, they are named by their schedule time
+
+    Tasks are immutable once created, their name, schedule time and payload are computed on the first use.
+    """
+    __slots__ = (
+        'id',
+        'message',
+        'timestamp',
+        'timedelta',
+        'repeat',
+        'rrule',
+        'cron',
+        'counter_shards',
+        'occurrence',
+        'next_occurrence',
+        'schedule_at',
+        'last',
+        'materialize',
+        'initial',
+        'stats',
+        'digest',
+        '_name',
+        '_schedule_time',
+        '_payload_dict',
+        '_payload_blob',
+    )
+
+    def __init__(
+            self,
+            id: str = None,
+            message: str = None,
+            timestamp: datetime.datetime = None,
+            timedelta: int = None,
+            repeat: int = 0,
+            rrule: str = None,
+            cron: str = None,
+            counter_shards: int = 0,
+            occurrence: datetime.datetime = None,
+            next_occurrence: datetime.datetime = None,
+            schedule_at: datetime.datetime = None,
+            last: bool = False,
+            materialize: bool = False,
+            initial: bool = False,
+            stats: bool = False,
+            digest: bool = False
+    ):
+        """
+        :param id: event ID (random UUID if not set)
+        :param message: event message
+        :param timestamp: time of the event
+        :param timedelta: seconds from the timestamp (or now) until the task is executed
+        :param repeat: number of remaining executions of a timedelta event
+        :param rrule: RFC 5545 recurrence rule of a recurring event
+        :param cron: cron expression of a recurring event
+        :param counter_shards: number of execution counter shards of the event
+        :param occurrence: occurrence of a recurring event
+        :param next_occurrence: occurrence following the occurrence (None for the last one)
+        :param schedule_at: explicit schedule time of the task
+        :param last: flags the last occurrence of a recurring event
+        :param materialize: flags the task materializing occurrences of a recurring event
+        :param initial: flags the task created with the event
+        :param stats: flags the event counted as created in the statistics, only such events are counted as processed
+            (sent to the callback in the `STATS_HEADER` task header, not in the payload)
+        :param digest: flags the task posting slack messages stored by the callbacks
+        """
+        self.id = id or str(uuid.uuid4())
+        self.message = message
+        self.timestamp = timestamp
+        self.timedelta = timedelta
+        self.repeat = repeat
+        self.rrule = rrule
+        self.cron = cron
+        self.counter_shards = counter_shards
+        self.occurrence = occurrence
+        self.next_occurrence = next_occurrence
+        self.schedule_at = schedule_at
+        self.last = last
+        self.materialize = materialize
+        self.initial = initial
+        self.stats = stats
+        self.digest = digest
+        self._name = None
+        self._schedule_time = None
+        self._payload_dict = None
+        self._payload_blob = None
+
+    def __repr__(self) -> str:
+        return 'CalendarTask(id={!r}, name={!r})'.format(self.id, self.name)
+
+    @property
+    def name(self) -> str:
+        if self._name is None:
+            if self.initial:
+                task_id = self.id
+            elif self.digest:
+                task_id = '{id}_{schedule_at:%Y%m%d%H%M%S}'.format(id=self.id, schedule_at=self.schedule_at)
+            elif self.occurrence:
+                task_id = '{id}_{prefix}{occurrence:%Y%m%d%H%M%S}'.format(
+                    id=self.id,
+                    prefix='m' if self.materialize else '',
+                    occurrence=self.occurrence
+                )
+            else:
+                task_id = '{id}_{repeat}'.format(id=self.id, repeat=self.repeat)
+            self._name = '{queue_path}/tasks/{id}'.format(queue_path=get_task_settings().queue_path, id=task_id)
+        return self._name
+
+    @property
+    def schedule_time(self) -> datetime.datetime:
+        """Local time of the task execution, fixed on the first use"""
+        if self._schedule_time is None:
+            self._schedule_time = self.schedule_at or self.occurrence or (
+                (self.timestamp or datetime.datetime.now()) + datetime.timedelta(seconds=self.timedelta or 0)
+            )
+        return self._schedule_time
+
+    @property
+    def schedule_time_proto(self) -> 'Timestamp':
+        from google.protobuf.timestamp_pb2 import Timestamp
+
+        proto_timestamp = Timestamp()
+        proto_timestamp.FromDatetime(self.schedule_time)
+        return proto_timestamp
+
+    @property
+    def recurrence(self) -> typing.Optional[dict]:
+        if self.rrule:
+            return {'rrule': self.rrule}
+        if self.cron:
+            return {'cron': self.cron}
+        return None
+
+    @property
+    def payload_dict(self) -> dict:
+        """Task payload, the returned dict is shared and must not be modified"""
+        if self._payload_dict is None:
+            if self.digest:
+                payload = {'id': self.id, 'digest': True}
+            elif self.materialize or self.recurrence:
+                # occurrences of recurring events are enqueued ahead by the materialization task
+                payload = {'id': self.id, 'materialize': True}
+                if self.message is not None:
+                    payload['message'] = self.message
+            elif self.occurrence:
+                payload = {
+                    'message': self.message,
+                    'id': self.id,
+                    'occurrence': self.occurrence.isoformat(),
+                    'last': self.last
+                }
+                if self.next_occurrence:
+                    payload['next'] = self.next_occurrence.isoformat()
+            else:
+                payload = {
+                    'message': self.message,
+                    'timedelta': self.timedelta,
+                    'id': self.id,
+                    'repeat': self.repeat
+                }
+            if self.counter_shards and not (self.materialize or self.recurrence):
+                payload['counter_shards'] = self.counter_shards
+            self._payload_dict = payload
+        return self._payload_dict
+
+    @property
+    def payload_blob(self) -> bytes:
+        if self._payload_blob is None:
+            self._payload_blob = dumps(self.payload_dict)
+        return self._payload_blob
+
+    def _http_request(self, body, headers: dict = None) -> dict:
+        settings = get_task_settings()
+        return {
+            'http_method': 'POST',
+            'url': settings.callback_url,
+            'headers': headers or settings.headers,
+            'oidc_token': settings.oidc_token,
+            'body': body
+        }
+
+    def to_dict(self) -> dict:
+        """Returns event document of the initial task"""
+        doc: dict = {
+            'name': self.name,
+            'http_request': self._http_request(dict(self.payload_dict)),
+            'processed': False,
+            'execution_counter': 0,
+            'schedule_time': self.schedule_time.isoformat(),
+            # native timestamp for time window queries
+            'schedule_at': self.schedule_time.astimezone(datetime.timezone.utc),
+        }
+        if self.recurrence:
+            doc['recurrence'] = self.recurrence
+            doc['materialized_until'] = None
+        if self.counter_shards:
+            doc['counter_shards'] = self.counter_shards
+        if self.stats:
+            doc['stats'] = True
+        return doc
+
+    def to_task_request(self) -> dict:
+        """Returns cloud task request of the task"""
+        return {
+            'name': self.name,
+            'http_request': self._http_request(
+                self.payload_blob,
+                get_task_settings().stats_headers if self.stats else None
+            ),
+            'schedule_time': self.schedule_time_proto
+        }
@@ -0,0 +1,196 @@
+import datetime
+import logging
+import threading
+import typing
+from collections import OrderedDict
+
+from calendar_common.instrumentation import span
+
+if typing.TYPE_CHECKING:
+    from google.cloud.firestore import (
+        CollectionReference,
+        WriteBatch,
+    )
+    from google.protobuf.timestamp_pb2 import Timestamp
+
+DELIVERIES_COLLECTION = 'deliveries'
+
+
+class Claim(typing.NamedTuple):
+    """Delivery claimed for processing"""
+    key: str
+    # side effects completed by previous failed attempts
+    completed: typing.FrozenSet[str]
+    # update time of the marker written by the claim
+    update_time: 'Timestamp'
+
+
+class DeliveryStore:
+    """Deduplicates at-least-once task deliveries
+
+    Every delivery is claimed before it is processed. Claimed keys are remembered in a per-instance
+    LRU cache, so duplicates delivered to the same instance are rejected without any round trip.
+    Other duplicates are rejected by a firestore marker created with the delivery key as its ID.
+    Markers carry `expires_at` timestamp for the firestore TTL policy.
+
+    Marker of a delivery being processed holds a lease. A failed delivery releases its marker, so the
+    retry is processed again. Partially failed delivery keeps its marker with the side effects it has
+    completed, so the retry repeats only the failed ones. Side effects writing to firestore add
+    themselves to the completed ones in their own batch (see `add_completed`), so they are not
+    repeated even if their result was lost. Marker of a crashed delivery is taken over by
+    a retry once the lease expires (concurrent takeovers are not excluded, deliveries are deduplicated
+    on a best effort basis).
+    """
+
+    def __init__(
+            self,
+            collection: 'CollectionReference',
+            ttl: datetime.timedelta = datetime.timedelta(days=7),
+            lease: datetime.timedelta = datetime.timedelta(minutes=10),
+            cache_size: int = 10000
+    ):
+        """
+        :param collection: collection of delivery markers
+        :param ttl: time after which markers expire, longer than the retry period of the queue
+        :param lease: time after which marker of an unfinished delivery can be taken over
+        :param cache_size: number of delivery keys remembered by the instance
+        """
+        self._collection = collection
+        self.ttl = ttl
+        self.lease = lease
+        self.cache_size = cache_size
+        self._cache: typing.OrderedDict[str, bool] = OrderedDict()
+        self._lock = threading.Lock()
+        self.cached_duplicates = 0
+        self.stored_duplicates = 0
+
+    @property
+    def duplicates(self) -> int:
+        """Number of duplicate deliveries rejected by the instance"""
+        return self.cached_duplicates + self.stored_duplicates
+
+    def _remember(self, key: str):
+        with self._lock:
+            self._cache[key] = True
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _forget(self, key: str):
+        with self._lock:
+            self._cache.pop(key, None)
+
+    def claim(self, key: str) -> typing.Optional[Claim]:
+        """Claims delivery for processing
+
+        :param key: delivery key, valid firestore document ID
+        :return: claim with the side effects completed by previous failed attempts (empty set for new
+                 deliveries), None for duplicates which should not be processed
+        """
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.cached_duplicates += 1
+                return None
+
+        from google.api_core.exceptions import Conflict
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        marker = {
+            'state': 'processing',
+            'claimed_at': now,
+            'lease_until': now + self.lease,
+            'expires_at': now + self.ttl,
+        }
+        completed = frozenset()
+        reference = self._collection.document(key)
+        try:
+            with span('firestore.create', collection=DELIVERIES_COLLECTION):
+                result = reference.create(marker)
+        except Conflict:
+            with span('firestore.get', collection=DELIVERIES_COLLECTION):
+                existing = reference.get().to_dict() or {}
+            expired = existing.get('expires_at') and existing['expires_at'] < now
+            lease_expired = (
+                existing.get('state') == 'processing' and existing.get('lease_until') and existing['lease_until'] < now
+            )
+            if existing.get('state') == 'failed' and not expired:
+                # retry of a partially failed delivery
+                completed = frozenset(existing.get('completed', ()))
+                marker['completed'] = sorted(completed)
+            elif expired or lease_expired:
+                logging.warning({
+                    "message": "Taking over expired delivery marker",
+                    "key": key
+                })
+            else:
+                self._remember(key)
+                with self._lock:
+                    self.stored_duplicates += 1
+                return None
+            with span('firestore.set', collection=DELIVERIES_COLLECTION):
+                result = reference.set(marker)
+        self._remember(key)
+        return Claim(key, completed, result.update_time)
+
+    def add_completed(self, batch: 'WriteBatch', claim: Claim, side_effect: str):
+        """Adds the side effect to the completed ones in the batch of its writes
+
+        The marker update requires the marker written by the claim, so the batch fails once the
+        delivery is released (e.g. after the side effect missed its deadline) and its retry may
+        repeat the side effect. The update changes the marker, so only one side effect of the claim
+        can be added.
+
+        :param batch: write batch of the side effect
+        :param claim: claim of the delivery
+        :param side_effect: side effect name
+        """
+        from google.cloud.firestore import (
+            ArrayUnion,
+            Client,
+        )
+
+        batch.update(
+            self._collection.document(claim.key),
+            {'completed': ArrayUnion([side_effect])},
+            option=Client.write_option(last_update_time=claim.update_time)
+        )
+
+    def complete(self, key: str):
+        """Marks claimed delivery as processed"""
+        try:
+            with span('firestore.update', collection=DELIVERIES_COLLECTION):
+                self._collection.document(key).update({'state': 'done'})
+        except Exception as ex:
+            # retries are still rejected until the lease expires
+            logging.warning({
+                "message": "Failed to complete delivery marker",
+                "key": key,
+                "error": str(ex)
+            })
+
+    def release(self, key: str, completed: typing.Iterable[str] = ()):
+        """Releases claimed delivery which failed, so its retry is processed
+
+        :param key: delivery key
+        :param completed: side effects completed by the delivery (or its previous attempts), skipped by the retry
+        """
+        from google.cloud.firestore import ArrayUnion
+
+        self._forget(key)
+        completed = sorted(completed)
+        update = {'state': 'failed'}
+        if completed:
+            # side effects added by `add_completed` are kept, even if their result was lost
+            # (array union of no values is rejected)
+            update['completed'] = ArrayUnion(completed)
+        try:
+            with span('firestore.update', collection=DELIVERIES_COLLECTION):
+                self._collection.document(key).update(update)
+        except Exception as ex:
+            # the marker lease expires and the retry takes it over
+            logging.warning({
+                "message": "Failed to release delivery marker",
+                "key": key,
+                "error": str(ex)
+            })
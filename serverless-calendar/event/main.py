@@ -2,105 +2,144 @@ import datetime
 import json
 import logging
 import os
-from dataclasses import dataclass
-
-from firebase_admin import (
-    firestore,
-    initialize_app,
+import time
+import typing
+from concurrent.futures import (
+    ThreadPoolExecutor,
+    TimeoutError as FutureTimeoutError,
+)
+from functools import (
+    lru_cache,
+    partial,
 )
+
 from flask import Request
-from google.cloud import tasks
-from google.cloud.firestore import DocumentReference
-from google.cloud.firestore_v1.transaction import (
-    Transaction,
-    transactional,
+
+from calendar_common.backends import (
+    TaskAlreadyExists,
+    get_task_backend,
+)
+from calendar_common.clients import get_db
+from calendar_common.counters import increment_counters
+from calendar_common.instrumentation import (
+    span,
+    traced,
+    with_trace,
+)
+from calendar_common.notifications import SlackNotifier
+from calendar_common.stats import increment_stats
+from calendar_common.tasks import (
+    STATS_HEADER,
+    CalendarTask,
+    get_task_settings,
 )
-from google.protobuf.timestamp_pb2 import Timestamp
-from slack import WebClient
+from deliveries import (
+    DELIVERIES_COLLECTION,
+    DeliveryStore,
+)
+from outbox import (
+    NOTIFICATIONS_COLLECTION,
+    NotificationOutbox,
+)
+from recurrence import materialize_window
+
+if typing.TYPE_CHECKING:
+    from google.cloud.firestore import (
+        DocumentReference,
+        WriteBatch,
+    )
 
-# prepare slack client
+# Slack setup
 slack_api_token = os.getenv('SLACK_API_TOKEN')
 slack_channel = os.getenv("SLACK_CHANNEL")
-if not (slack_api_token and slack_channel):
-    slack_client = None
-else:
-    slack_client = WebClient(token=slack_api_token)
-
-# Firebase and Firestore setup
-firebase_app = initialize_app()
-db = firestore.client(firebase_app)
-
-# Cloud tasks setup
-project_name = os.getenv("GCP_PROJECT")
-location = os.getenv("FUNCTION_REGION")
-queue = os.getenv("QUEUE_NAME")
-
-client = tasks.CloudTasksClient()
-task_queue = client.queue_path(project_name, location, queue)
-
-
-@dataclass
-class CalendarTask:
-    id: str = None
-    message: str = None
-    timedelta: int = None
-    repeat: int = None
-
-    @property
-    def name(self) -> str:
-        return 'projects/{project_name}/locations/{location}/queues/{queue}/tasks/{id}_{count}'.format(
-            project_name=project_name,
-            location=location,
-            queue=queue,
-            id=self.id,
-            count=self.repeat
-        )
+# callbacks store their messages, digest tasks post the messages stored within the window
+NOTIFICATION_DIGEST_WINDOW = datetime.timedelta(seconds=int(os.getenv('NOTIFICATION_DIGEST_WINDOW', 60)))
+# the function instance gets no CPU after the response, so the digest is posted before it
+slack_flush_timeout = float(os.getenv('SLACK_FLUSH_TIMEOUT', 30))
+
+# Recurring events setup
+RECURRENCE_WINDOW = datetime.timedelta(seconds=int(os.getenv('RECURRENCE_WINDOW', 24 * 60 * 60)))
+MAX_OCCURRENCES_PER_WINDOW = int(os.getenv('MAX_OCCURRENCES_PER_WINDOW', 500))
+MAX_SCHEDULE_AHEAD = datetime.timedelta(days=29)  # cloud tasks can be scheduled at most 30 days ahead
+MATERIALIZE_CONCURRENCY = 16
 
-    @property
-    def callback_url(self) -> str:
-        return os.getenv("EVENT_CALLBACK_URL")
-
-    @property
-    def service_account_email(self) -> str:
-        return os.getenv('SERVICE_ACCOUNT_EMAIL')
-
-    @property
-    def schedule_time_proto(self) -> Timestamp:
-        proto_timestamp = Timestamp()
-        proto_timestamp.FromDatetime(datetime.datetime.now() + datetime.timedelta(seconds=self.timedelta))
-        return proto_timestamp
-
-    @property
-    def payload_dict(self) -> dict:
-        return {
-            'message': self.message,
-            'timedelta': self.timedelta,
-            'id': self.id,
-            'repeat': self.repeat
-        }
-
-    @property
-    def payload_blob(self) -> bytes:
-        return json.dumps(self.payload_dict).encode('utf-8')
-
-    def to_task_request(self) -> dict:
-        return {
-            'name': self.name,
-            'http_request': {
-                'http_method': 'POST',
-                'url': self.callback_url,
-                'headers': {
-                    "Content-Type": "application/json"
-                },
-                'oidc_token': {
-                    'service_account_email': self.service_account_email
-                },
-                'body': self.payload_blob
-            },
-            'schedule_time': self.schedule_time_proto
-        }
+# Delivery deduplication setup
+delivery_dedup = os.getenv('DELIVERY_DEDUP', '1').lower() in ('1', 'true')
+DELIVERY_TTL = datetime.timedelta(seconds=int(os.getenv('DELIVERY_TTL', 7 * 24 * 60 * 60)))
+DELIVERY_CACHE_SIZE = int(os.getenv('DELIVERY_CACHE_SIZE', 10000))
 
+# Side effects setup, deadlines are in seconds
+SIDE_EFFECT_CONCURRENCY = int(os.getenv('SIDE_EFFECT_CONCURRENCY', 8))
+SIDE_EFFECT_DEADLINES = {
+    'next_task': float(os.getenv('NEXT_TASK_DEADLINE', 10)),
+    'counter': float(os.getenv('COUNTER_DEADLINE', 10)),
+    'notification': float(os.getenv('NOTIFICATION_DEADLINE', 10)),
+}
+# stored notifications are idempotent (named by the delivery), so all side effects are retried
+RETRIED_SIDE_EFFECTS = frozenset(('next_task', 'counter', 'notification'))
+
+
+@lru_cache(maxsize=None)
+def get_notifier() -> typing.Optional[SlackNotifier]:
+    """Creates slack notifier on the first use
+
+    :return: slack notifier or None if slack is not configured
+    """
+    if not (slack_api_token and slack_channel):
+        return None
+    return SlackNotifier(slack_api_token, slack_channel)
+
+
+@lru_cache(maxsize=None)
+def get_outbox() -> typing.Optional[NotificationOutbox]:
+    """Creates outbox of slack messages on the first use
+
+    :return: notification outbox or None if slack is not configured
+    """
+    if get_notifier() is None:
+        return None
+    return NotificationOutbox(get_db().collection(NOTIFICATIONS_COLLECTION), window=NOTIFICATION_DIGEST_WINDOW)
+
+
+@lru_cache(maxsize=None)
+def get_side_effect_executor() -> ThreadPoolExecutor:
+    """Creates executor of task side effects on the first use, shared by all requests of the instance
+
+    :return: thread pool executor
+    """
+    return ThreadPoolExecutor(max_workers=SIDE_EFFECT_CONCURRENCY, thread_name_prefix='side-effect')
 
+
+@lru_cache(maxsize=None)
+def get_delivery_store() -> typing.Optional[DeliveryStore]:
+    """Creates store of processed task deliveries on the first use
+
+    :return: delivery store or None if deduplication is disabled
+    """
+    if not delivery_dedup:
+        return None
+    return DeliveryStore(
+        get_db().collection(DELIVERIES_COLLECTION),
+        ttl=DELIVERY_TTL,
+        cache_size=DELIVERY_CACHE_SIZE
+    )
+
+
+def delivery_key(request: Request, request_json: dict) -> str:
+    """Returns key of the task delivery made of the task name and its repeat index
+
+    :param request: API request
+    :param request_json: task payload
+    :return: delivery key
+    """
+    task_name = request.headers.get('X-CloudTasks-TaskName') or request_json['id']
+    return '{name}_{index}'.format(
+        name=task_name,
+        index=request_json.get('occurrence') or request_json.get('repeat') or 0
+    )
+
+
+@traced('calendar_event_callback')
 def calendar_event_callback(request: Request):
     """Processes given calendar event
 
@@ -115,70 +154,326 @@ def calendar_event_callback(request: Request):
 
     # load task payload data
     request_json = json.loads(request.data)
-    task_id = request_json.get('id')
-    task_message = request_json.get('message')
-    task_repeat = request_json.get('repeat', 0)
-    task_delta = request_json.get('timedelta', 0)
-
-    if not task_id:
+    if not request_json.get('id'):
         logging.error('Received cloud task without ID')
         return
 
+    # duplicate deliveries are rejected before any side effect
+    store = get_delivery_store()
+    key = delivery_key(request, request_json)
+    completed = frozenset()
+    mark_completed = None
+    if store:
+        claim = store.claim(key)
+        if claim is None:
+            logging.info({
+                "message": "Duplicate task delivery skipped",
+                "key": key,
+                "duplicates": store.duplicates,
+                "cached_duplicates": store.cached_duplicates
+            })
+            return
+        completed = claim.completed
+        mark_completed = partial(store.add_completed, claim=claim)
+
     logging.info({
         "message": "Task execution started",
-        "data": request_json
+        "data": request_json,
+        "completed": sorted(completed)
     })
 
-    # create next task if repeat is set
+    try:
+        errors = process_task(request_json, completed, mark_completed, request.headers.get(STATS_HEADER) == '1')
+    except Exception:
+        if store:
+            store.release(key, completed)
+        raise
+
+    retried = {name: error for name, error in errors.items() if error and name in RETRIED_SIDE_EFFECTS}
+    if retried:
+        # cloud tasks retries the delivery, side effects which succeeded are skipped by the retry
+        if store:
+            store.release(key, completed.union(name for name, error in errors.items() if error is None))
+        return json.dumps({'errors': retried}), 500
+    if store:
+        store.complete(key)
+
+
+def run_side_effects(
+        task_id: str,
+        side_effects: typing.Dict[str, typing.Callable[[], typing.Any]]
+) -> typing.Dict[str, typing.Optional[str]]:
+    """Runs independent side effects of a task concurrently, each within its own deadline
+
+    Side effects which miss their deadline are reported as failed (the executor cannot interrupt them,
+    so they may still finish later). Side effects which have not started yet are cancelled. The retried
+    side effects are idempotent (named cloud tasks) or commit only before the delivery is released (the
+    counter, see `DeliveryStore.add_completed`), so late ones are not repeated by the retry.
+
+    :param task_id: event ID
+    :param side_effects: side effect callables by their names (keys of `SIDE_EFFECT_DEADLINES`)
+    :return: error message of every failed side effect, None for the successful ones
+    """
+    started = time.monotonic()
+    executor = get_side_effect_executor()
+    futures = {name: executor.submit(with_trace(side_effect)) for name, side_effect in side_effects.items()}
+
+    errors: typing.Dict[str, typing.Optional[str]] = {}
+    for name, future in futures.items():
+        deadline = SIDE_EFFECT_DEADLINES[name]
+        errors[name] = None
+        try:
+            future.result(timeout=max(started + deadline - time.monotonic(), 0))
+        except FutureTimeoutError:
+            future.cancel()
+            errors[name] = 'Deadline of {} seconds exceeded'.format(deadline)
+        except Exception as ex:
+            errors[name] = str(ex) or type(ex).__name__
+        if errors[name] is None:
+            continue
+        logging.error({
+            "message": "Task side effect failed",
+            "id": task_id,
+            "side_effect": name,
+            "error": errors[name],
+            "retried": name in RETRIED_SIDE_EFFECTS
+        })
+    return errors
+
+
+def create_next_task(task: CalendarTask):
+    """Creates next repetition of a timedelta event
+
+    :param task: next task
+    """
+    try:
+        get_task_backend().create_task(get_task_settings().queue_path, task.to_task_request())
+    except TaskAlreadyExists:
+        # created by the failed delivery which is being retried
+        pass
+
+
+def process_task(
+        request_json: dict,
+        completed: typing.AbstractSet[str] = frozenset(),
+        mark_completed: typing.Callable[..., None] = None,
+        counted: bool = False
+) -> typing.Dict[str, typing.Optional[str]]:
+    """Executes calendar task
+
+    Creation of the next repetition, execution counter increment and storing of the slack message
+    are independent, they run concurrently (see `run_side_effects`). Stored messages are posted by
+    digest tasks (see `NotificationOutbox`).
+
+    :param request_json: task payload
+    :param completed: side effects completed by previous attempts of the delivery, which are skipped
+    :param mark_completed: adds side effect to the completed ones in a write batch (`DeliveryStore.add_completed`)
+    :param counted: flags the event counted as created in the statistics (`STATS_HEADER` of the task)
+    :return: error message of every executed side effect, None for the successful ones
+    """
+    task_id = request_json['id']
+    task_message = request_json.get('message')
+    task_repeat = request_json.get('repeat', 0)
+    task_delta = request_json.get('timedelta', 0)
+    task_counter_shards = request_json.get('counter_shards', 0)
+
+    if request_json.get('materialize'):
+        materialize_occurrences(task_id)
+        return {}
+
+    outbox = get_outbox()
+    if request_json.get('digest'):
+        if outbox:
+            outbox.post_digest(get_db(), get_notifier(), slack_flush_timeout)
+        return {}
+
+    side_effects = {}
+
+    # create next task if repeat is set, occurrences of recurring events are enqueued ahead
     finished_processing = False
-    if task_repeat and task_repeat > 1:
+    next_schedule_at = None
+    if 'occurrence' in request_json:
+        finished_processing = request_json.get('last', False)
+        if request_json.get('next'):
+            next_schedule_at = datetime.datetime.fromisoformat(request_json['next']).astimezone(datetime.timezone.utc)
+    elif task_repeat and task_repeat > 1:
         next_task = CalendarTask(
             id=task_id,
             timedelta=task_delta,
             repeat=task_repeat - 1,
-            message=task_message
-        )
-        client.create_task(
-            parent=task_queue,
-            task=next_task.to_task_request()
+            message=task_message,
+            counter_shards=task_counter_shards,
+            stats=counted
         )
+        side_effects['next_task'] = partial(create_next_task, next_task)
+        next_schedule_at = next_task.schedule_time.astimezone(datetime.timezone.utc)
     else:
         finished_processing = True
 
     # increment repeated counter
-    transaction = db.transaction()
-    increment_execution_counter(
-        transaction,
-        db.collection('events').document(task_id),
-        finished_processing
+    side_effects['counter'] = partial(
+        increment_execution_counter,
+        get_db().collection('events').document(task_id),
+        finished_processing,
+        task_counter_shards,
+        next_schedule_at,
+        counted,
+        partial(mark_completed, side_effect='counter') if mark_completed else None
     )
 
-    # send slack message
-    if slack_client and 'message' in request_json:
-        slack_client.chat_postMessage(
-            channel=slack_channel,
-            text=":exclamation: {message} :exclamation: (ID: {id}){repetition}".format(
+    # store slack message, posted by the digest task of the window
+    if outbox and 'message' in request_json:
+        side_effects['notification'] = partial(
+            outbox.add,
+            '{id}_{index}'.format(id=task_id, index=request_json.get('occurrence') or task_repeat or 0),
+            ":exclamation: {message} :exclamation: (ID: {id}){repetition}".format(
                 message=task_message,
                 id=task_id,
                 repetition=' [repetitions left: {}]'.format(task_repeat - 1) if task_repeat else ''
             )
         )
 
+    return run_side_effects(task_id, {
+        name: side_effect for name, side_effect in side_effects.items() if name not in completed
+    })
+
+
+def materialize_occurrences(task_id: str):
+    """Enqueues occurrences of a recurring event within the rolling window
+
+    Occurrence tasks have deterministic names, so repeated materialization of the same window
+    does not create duplicates. Next materialization is scheduled once the next unmaterialized
+    occurrence gets within half of the window. Every occurrence task carries the following
+    occurrence, which becomes `schedule_at` of the event once the occurrence is executed.
+
+    :param task_id: recurring event ID
+    """
+    event_reference = get_db().collection('events').document(task_id)
+    with span('firestore.get', collection='events'):
+        event = event_reference.get().to_dict()
+    if not event or not event.get('recurrence') or event.get('processed'):
+        logging.warning({
+            "message": "Skipping materialization of recurring event",
+            "id": task_id
+        })
+        return
+
+    now = datetime.datetime.now()
+    dtstart = datetime.datetime.fromisoformat(event['schedule_time'])
+    materialized_until = event.get('materialized_until')
+    after = datetime.datetime.fromisoformat(materialized_until) if materialized_until else (
+        dtstart - datetime.timedelta(seconds=1)
+    )
+    occurrences, next_occurrence = materialize_window(
+        event['recurrence'],
+        dtstart,
+        after,
+        now + RECURRENCE_WINDOW,
+        MAX_OCCURRENCES_PER_WINDOW
+    )
+
+    tasks_to_create = [
+        CalendarTask(
+            id=task_id,
+            message=event['http_request']['body'].get('message'),
+            occurrence=occurrence,
+            next_occurrence=occurrences[index + 1] if index + 1 < len(occurrences) else next_occurrence,
+            last=next_occurrence is None and index == len(occurrences) - 1,
+            counter_shards=event.get('counter_shards', 0),
+            stats=event.get('stats', False)
+        )
+        for index, occurrence in enumerate(occurrences)
+    ]
+    if next_occurrence is not None:
+        tasks_to_create.append(CalendarTask(
+            id=task_id,
+            occurrence=next_occurrence,
+            schedule_at=max(now, min(next_occurrence - RECURRENCE_WINDOW / 2, now + MAX_SCHEDULE_AHEAD)),
+            materialize=True,
+            stats=event.get('stats', False)
+        ))
+
+    def create_task(task: CalendarTask):
+        try:
+            get_task_backend().create_task(get_task_settings().queue_path, task.to_task_request())
+        except TaskAlreadyExists:
+            pass
+
+    # raises if any task failed, the whole window is materialized again on retry
+    with ThreadPoolExecutor(max_workers=MATERIALIZE_CONCURRENCY) as pool:
+        list(pool.map(with_trace(create_task), tasks_to_create))
+
+    update = {}
+    if occurrences:
+        update['materialized_until'] = occurrences[-1].isoformat()
+    elif next_occurrence is None:
+        update['processed'] = True
+    if update:
+        batch = get_db().batch()
+        batch.update(event_reference, update)
+        if update.get('processed') and event.get('stats'):
+            increment_stats(batch, get_db(), processed=1)
+        with span('firestore.commit', collection='events'):
+            batch.commit()
+
+    logging.info({
+        "message": "Recurring event materialized",
+        "id": task_id,
+        "occurrences": len(occurrences),
+        "next_occurrence": next_occurrence.isoformat() if next_occurrence else None
+    })
+
 
-@transactional
 def increment_execution_counter(
-        transaction: Transaction,
-        event_reference: DocumentReference,
-        finished_processing: bool
+        event_reference: 'DocumentReference',
+        finished_processing: bool,
+        counter_shards: int = 0,
+        schedule_at: datetime.datetime = None,
+        counted: bool = False,
+        mark_completed: typing.Callable[['WriteBatch'], None] = None
 ):
-    """Increments execution counter in a task
+    """Increments execution counter in a task with a server-side increment (no read)
+
+    The event document is updated, not created, so executions of a deleted event are not counted
+    and do not recreate the event.
 
-    :param transaction: transaction
     :param event_reference: event document reference
     :param finished_processing: flags whether the repeated task processing has been finished
+    :param counter_shards: number of execution counter shards of the event (0 for unsharded counter)
+    :param schedule_at: schedule time of the next repetition or occurrence of the event
+    :param counted: flags the event counted as created in the statistics (events created before
+        the statistics are not counted as processed)
+    :param mark_completed: adds the increment to completed side effects of the delivery in the batch, so an
+        increment which missed its deadline either commits before the delivery is released or never
     """
-    event = event_reference.get().to_dict()
-    transaction.update(event_reference, {
-        'execution_counter': event.get('execution_counter', 0) + 1,
-        'processed': finished_processing,
-    })
+    fields = {}
+    # sharded events are written only once they are finished or to move the schedule time,
+    # repetitions of one event do not run concurrently
+    if finished_processing or not counter_shards:
+        fields['processed'] = finished_processing
+    if schedule_at:
+        fields['schedule_at'] = schedule_at
+    db = get_db()
+    batch = db.batch()
+    from google.api_core.exceptions import NotFound
+
+    increment_counters(
+        batch,
+        event_reference,
+        {'execution_counter': 1},
+        shards=counter_shards,
+        fields=fields or None,
+        must_exist=True
+    )
+    increment_stats(batch, db, executions=1, processed=1 if finished_processing and counted else 0)
+    if mark_completed:
+        mark_completed(batch)
+    try:
+        with span('firestore.commit', collection='events'):
+            batch.commit()
+    except NotFound:
+        # the event was deleted, the retry would fail the same way
+        logging.warning({
+            "message": "Execution of a deleted event not counted",
+            "id": event_reference.id
+        })
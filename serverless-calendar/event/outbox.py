@@ -0,0 +1,129 @@
+import datetime
+import logging
+import typing
+
+from calendar_common.backends import (
+    TaskAlreadyExists,
+    get_task_backend,
+)
+from calendar_common.instrumentation import span
+from calendar_common.tasks import (
+    CalendarTask,
+    get_task_settings,
+)
+
+if typing.TYPE_CHECKING:
+    from google.cloud.firestore import (
+        Client,
+        CollectionReference,
+    )
+
+    from calendar_common.notifications import SlackNotifier
+
+NOTIFICATIONS_COLLECTION = 'notifications'
+DIGEST_TASK_ID = 'notification-digest'
+# documents deleted in one batch
+MAX_DIGEST_MESSAGES = 500
+
+
+class NotificationOutbox:
+    """Collects slack messages of event callbacks and posts them as digests
+
+    Callbacks only store their message in the `notifications` collection, named by the delivery, so a
+    retried delivery stores it once, and make sure that a digest task is scheduled shortly after the
+    end of the current digest window. The digest task is delivered to the event callback like other
+    calendar tasks and posts all stored messages as digests, the messages are deleted once they are
+    posted. A message is stored before its window's digest task is created and the task runs only
+    after the window, so every stored message is posted by the digest of its window or a later one,
+    and failed posts are retried by cloud tasks. Slack latency is never part of the event callback.
+    """
+
+    def __init__(
+            self,
+            collection: 'CollectionReference',
+            window: datetime.timedelta = datetime.timedelta(seconds=60),
+            grace: datetime.timedelta = datetime.timedelta(seconds=5)
+    ):
+        """
+        :param collection: collection of stored messages
+        :param window: time in which messages are collected to one digest
+        :param grace: delay of the digest task after the end of its window
+        """
+        self._collection = collection
+        self.window = window
+        self.grace = grace
+        # the last window whose digest task the instance created, other messages of the window skip the request
+        self._scheduled_window: typing.Optional[datetime.datetime] = None
+
+    def window_end(self, now: datetime.datetime) -> datetime.datetime:
+        """Returns end of the digest window containing the time
+
+        :param now: naive local time
+        :return: naive local time of the window end
+        """
+        seconds = self.window.total_seconds()
+        start = now.timestamp() // seconds * seconds
+        return datetime.datetime.fromtimestamp(start + seconds)
+
+    def add(self, key: str, text: str):
+        """Stores message and schedules the digest of the current window
+
+        :param key: message ID, stored messages with the same ID are replaced
+        :param text: message text
+        """
+        with span('firestore.set', collection=NOTIFICATIONS_COLLECTION):
+            self._collection.document(key).set({
+                'text': text,
+                'created': datetime.datetime.now(datetime.timezone.utc),
+            })
+        window_end = self.window_end(datetime.datetime.now())
+        if window_end != self._scheduled_window:
+            self.schedule_digest(window_end)
+            self._scheduled_window = window_end
+
+    def schedule_digest(self, window_end: datetime.datetime):
+        """Creates digest task of the window unless it already exists
+
+        :param window_end: naive local time of the window end
+        """
+        task = CalendarTask(id=DIGEST_TASK_ID, schedule_at=window_end + self.grace, digest=True)
+        try:
+            get_task_backend().create_task(get_task_settings().queue_path, task.to_task_request())
+        except TaskAlreadyExists:
+            pass
+
+    def post_digest(self, db: 'Client', notifier: 'SlackNotifier', timeout: float) -> int:
+        """Posts stored messages, oldest first, and deletes them
+
+        Messages over `MAX_DIGEST_MESSAGES` are left for a digest scheduled right away.
+
+        :param db: firestore client
+        :param notifier: slack notifier
+        :param timeout: seconds to wait for the messages to be posted
+        :return: number of posted messages
+        :raises RuntimeError: if the messages were not posted, they are kept for the retry
+        """
+        query = self._collection.order_by('created').limit(MAX_DIGEST_MESSAGES)
+        with span('firestore.query', collection=NOTIFICATIONS_COLLECTION):
+            documents = list(query.stream())
+        if not documents:
+            return 0
+
+        for document in documents:
+            notifier.notify(document.to_dict()['text'])
+        with span('slack.flush'):
+            if not notifier.flush(timeout):
+                raise RuntimeError('Slack messages failed or not posted within {} seconds'.format(timeout))
+
+        batch = db.batch()
+        for document in documents:
+            batch.delete(document.reference)
+        with span('firestore.commit', collection=NOTIFICATIONS_COLLECTION):
+            batch.commit()
+        if len(documents) == MAX_DIGEST_MESSAGES:
+            self.schedule_digest(self.window_end(datetime.datetime.now()))
+        logging.info({
+            "message": "Slack digest posted",
+            "notifications": len(documents)
+        })
+        return len(documents)
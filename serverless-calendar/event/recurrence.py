@@ -0,0 +1,56 @@
+import datetime
+import typing
+
+
+def iter_occurrences(
+        recurrence: dict,
+        dtstart: datetime.datetime,
+        after: datetime.datetime
+) -> typing.Iterator[datetime.datetime]:
+    """Lazily yields occurrences of a recurring event
+
+    :param recurrence: event recurrence, either `{'rrule': <RFC 5545 RRULE>}` or `{'cron': <cron expression>}`
+    :param dtstart: first possible occurrence of the event
+    :param after: only occurrences strictly after this time are yielded
+    :return: ordered occurrences
+    """
+    if recurrence.get('rrule'):
+        from dateutil.rrule import rrulestr
+
+        yield from rrulestr(recurrence['rrule'], dtstart=dtstart).xafter(after)
+
+    elif recurrence.get('cron'):
+        from croniter import croniter
+
+        # cron expressions have no start, the first occurrence may fall on dtstart
+        iterator = croniter(recurrence['cron'], max(after, dtstart - datetime.timedelta(seconds=1)))
+        while True:
+            yield iterator.get_next(datetime.datetime)
+
+    else:
+        raise ValueError('Unsupported recurrence {}'.format(recurrence))
+
+
+def materialize_window(
+        recurrence: dict,
+        dtstart: datetime.datetime,
+        after: datetime.datetime,
+        window_end: datetime.datetime,
+        limit: int
+) -> typing.Tuple[typing.List[datetime.datetime], typing.Optional[datetime.datetime]]:
+    """Computes occurrences of a recurring event within the rolling window
+
+    :param recurrence: event recurrence
+    :param dtstart: first possible occurrence of the event
+    :param after: only occurrences strictly after this time are returned
+    :param window_end: end of the window (inclusive)
+    :param limit: maximal number of returned occurrences
+    :return: occurrences within the window and the next occurrence after them (None if the series ended)
+    """
+    iterator = iter_occurrences(recurrence, dtstart, after)
+    occurrences = []
+    next_occurrence = next(iterator, None)
+    while next_occurrence is not None and next_occurrence <= window_end and len(occurrences) < limit:
+        occurrences.append(next_occurrence)
+        next_occurrence = next(iterator, None)
+    return occurrences, next_occurrence
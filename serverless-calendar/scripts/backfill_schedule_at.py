@@ -0,0 +1,122 @@
+"""Sets `schedule_at` of events to their next execution
+
+    python backfill_schedule_at.py [--dry-run]
+
+Events created before the `schedule_at` field have none, so time window listings skip them.
+Recurring events and events with sharded counters created before their executions moved the
+field keep their first schedule time. Pending events get the schedule time of their next
+execution: the occurrence after the executed ones for recurring events and the schedule time
+of the pending cloud task for repeated events. Processed events without the field get their
+original schedule time. Run once after deploying the event function, with the default
+credentials of the project.
+"""
+import argparse
+import datetime
+import os
+import sys
+import typing
+
+CALENDAR_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path[:0] = [CALENDAR_DIR, os.path.join(CALENDAR_DIR, 'event')]
+
+from calendar_common.counters import read_counters  # noqa: E402
+from recurrence import iter_occurrences  # noqa: E402
+
+if typing.TYPE_CHECKING:
+    from google.cloud.firestore import DocumentSnapshot
+    from google.cloud.tasks import CloudTasksClient
+
+MAX_BATCH_SIZE = 500
+EVENT_FIELDS = ['name', 'schedule_time', 'schedule_at', 'processed', 'execution_counter', 'counter_shards',
+                'recurrence', 'http_request']
+
+
+def to_utc(value: datetime.datetime) -> datetime.datetime:
+    """Converts local time of the event (as written by the functions) to UTC"""
+    return value.astimezone(datetime.timezone.utc)
+
+
+def execution_count(doc: 'DocumentSnapshot', event: dict) -> int:
+    if not event.get('counter_shards'):
+        return event.get('execution_counter') or 0
+    return read_counters(doc.reference).get('execution_counter', 0)
+
+
+def next_occurrence(event: dict, executed: int) -> typing.Optional[datetime.datetime]:
+    """Returns occurrence of a recurring event following the executed ones (None if the series ended)"""
+    dtstart = datetime.datetime.fromisoformat(event['schedule_time'])
+    occurrences = iter_occurrences(event['recurrence'], dtstart, dtstart - datetime.timedelta(seconds=1))
+    for index, occurrence in enumerate(occurrences):
+        if index == executed:
+            return occurrence
+    return None
+
+
+def next_repetition(client: 'CloudTasksClient', event: dict, executed: int) -> typing.Optional[datetime.datetime]:
+    """Returns schedule time of the pending task of a repeated event (None if there is no such task)"""
+    from google.api_core.exceptions import NotFound
+
+    if not executed:
+        return datetime.datetime.fromisoformat(event['schedule_time'])
+    # the repetition after `executed` executions is named by the number of remaining repetitions
+    repeat = event['http_request']['body'].get('repeat', 0)
+    name = '{}_{}'.format(event['name'], repeat - executed)
+    try:
+        task = client.get_task(name)
+    except NotFound:
+        return None
+    return task.schedule_time.ToDatetime().replace(tzinfo=datetime.timezone.utc)
+
+
+def schedule_at(client: 'CloudTasksClient', doc: 'DocumentSnapshot', event: dict) -> typing.Optional[datetime.datetime]:
+    """Returns schedule time of the next execution of the event in UTC (None if it is unknown)"""
+    if event.get('processed'):
+        if event.get('schedule_at'):
+            return None
+        return to_utc(datetime.datetime.fromisoformat(event['schedule_time']))
+
+    executed = execution_count(doc, event)
+    if event.get('recurrence'):
+        scheduled = next_occurrence(event, executed)
+    else:
+        scheduled = next_repetition(client, event, executed)
+    return to_utc(scheduled) if scheduled else None
+
+
+def main():
+    from google.cloud import (
+        firestore,
+        tasks,
+    )
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dry-run', action='store_true', help='only report the events which would be updated')
+    args = parser.parse_args()
+
+    db = firestore.Client()
+    client = tasks.CloudTasksClient()
+    batch = db.batch()
+    pending = 0
+    updated = 0
+    for doc in db.collection('events').select(EVENT_FIELDS).stream():
+        event = doc.to_dict()
+        value = schedule_at(client, doc, event)
+        if value is None or value == event.get('schedule_at'):
+            continue
+        print('{} {} -> {}'.format(doc.id, event.get('schedule_at'), value.isoformat()))
+        updated += 1
+        if args.dry_run:
+            continue
+        batch.update(doc.reference, {'schedule_at': value})
+        pending += 1
+        if pending == MAX_BATCH_SIZE:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+    if pending:
+        batch.commit()
+    print('{} events {}'.format(updated, 'to update' if args.dry_run else 'updated'))
+
+
+if __name__ == '__main__':
+    main()
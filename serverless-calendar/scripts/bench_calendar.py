@@ -0,0 +1,270 @@
+"""Offline benchmark of the calendar API and event callback
+
+Runs `create_calendar_event`, `get_calendar_events` and `calendar_event_callback` against
+an in-memory firestore (`fake_firestore.py`) and a task backend which only counts created
+tasks, so the results measure the function code and not the network.
+
+Every scenario runs for the given duration at each collection size and concurrency level and
+reports requests per second, p50/p99 latency and memory allocated per request (peak of traced
+allocations of single-threaded requests).
+
+    python bench_calendar.py [--sizes 100,1000,10000] [--concurrency 1,4,16] [--duration 2]
+                             [--output after.json] [--compare before.json]
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import sys
+import threading
+import time
+import tracemalloc
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+from local_calendar import load_function
+
+import fake_firestore
+from calendar_common.backends import (
+    TaskBackend,
+    set_task_backend,
+)
+
+SCENARIOS = ('create', 'list', 'list_page', 'callback')
+
+
+class CountingTaskBackend(TaskBackend):
+    """Task backend which only counts task requests"""
+
+    def __init__(self):
+        self.created = 0
+        self.deleted = 0
+        self._lock = threading.Lock()
+
+    def create_task(self, parent: str, task: dict):
+        with self._lock:
+            self.created += 1
+
+    def delete_task(self, name: str):
+        with self._lock:
+            self.deleted += 1
+
+
+def setup_functions(db: fake_firestore.Client):
+    """Loads api and event functions using the in-memory firestore
+
+    :param db: in-memory firestore client
+    :return: api and event modules
+    """
+    os.environ.setdefault('GCP_PROJECT', 'bench')
+    os.environ.setdefault('FUNCTION_REGION', 'local')
+    os.environ.setdefault('QUEUE_NAME', 'bench')
+    os.environ.setdefault('EVENT_CALLBACK_URL', 'http://localhost/event')
+    for variable in ('SLACK_API_TOKEN', 'SLACK_CHANNEL', 'EVENTS_MIRROR'):
+        os.environ.pop(variable, None)
+
+    api = load_function('api', 'calendar_api_main')
+    event = load_function('event', 'calendar_event_main')
+    api.get_db = event.get_db = lambda: db
+    api.setup_logging = logging.getLogger
+    set_task_backend(CountingTaskBackend())
+    return api, event
+
+
+def fill_events(api, db: fake_firestore.Client, size: int):
+    """Replaces events collection with the given number of repeated events"""
+    events = {}
+    for index in range(size):
+        task = api.CalendarTask(
+            id='event-{:08d}'.format(index),
+            message='Benchmark event {}'.format(index),
+            timedelta=3600,
+            repeat=3,
+            initial=True
+        )
+        events[task.id] = task.to_dict()
+    db._collections.pop('events', None)
+    db.load('events', events)
+
+
+def make_requests(api, event, size: int) -> typing.Dict[str, typing.Callable[[int], typing.Any]]:
+    """Creates scenario request functions, each one takes request sequence number"""
+    from flask import Request
+    from werkzeug.test import EnvironBuilder
+
+    def call_api(**request):
+        response = api.calendar_api(Request(EnvironBuilder(**request).get_environ()))
+        if response.status_code >= 300:
+            raise RuntimeError('API responded with status {}'.format(response.status_code))
+        # consume streamed body like the http server would
+        for _ in response.response:
+            pass
+
+    def create(index: int):
+        call_api(method='POST', json={'message': 'Benchmark', 'timedelta': 3600, 'repeat': 3})
+
+    def list_all(index: int):
+        call_api(method='GET')
+
+    def list_page(index: int):
+        call_api(method='GET', query_string={'limit': 100})
+
+    def callback(index: int):
+        environ = EnvironBuilder(method='POST', data=json.dumps({
+            'id': 'event-{:08d}'.format(index % size),
+            'message': 'Benchmark',
+            'timedelta': 3600,
+            'repeat': 2,
+        }), headers={'X-CloudTasks-TaskName': 'bench-{}'.format(index)}).get_environ()
+        event.calendar_event_callback(Request(environ))
+
+    return {'create': create, 'list': list_all, 'list_page': list_page, 'callback': callback}
+
+
+def percentile(latencies: typing.List[float], value: float) -> float:
+    return latencies[min(len(latencies) - 1, int(len(latencies) * value))]
+
+
+def run(request: typing.Callable[[int], typing.Any], concurrency: int, duration: float, min_requests: int) -> dict:
+    """Calls request from concurrent workers until the duration elapses
+
+    :return: request rate and latency percentiles (milliseconds)
+    """
+    counter = iter(range(sys.maxsize))
+    lock = threading.Lock()
+    latencies = []
+
+    def worker(deadline: float):
+        worker_latencies = []
+        while True:
+            with lock:
+                index = next(counter)
+            if index >= min_requests and time.perf_counter() > deadline:
+                break
+            started = time.perf_counter()
+            request(index)
+            worker_latencies.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(worker_latencies)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(worker, started + duration) for _ in range(concurrency)]:
+            future.result()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'requests_per_second': len(latencies) / elapsed,
+        'latency_p50_ms': percentile(latencies, 0.5) * 1000,
+        'latency_p99_ms': percentile(latencies, 0.99) * 1000,
+    }
+
+
+def measure_allocations(request: typing.Callable[[int], typing.Any], samples: int) -> dict:
+    """Traces memory allocations of single-threaded requests
+
+    :return: mean peak of allocated memory per request (KiB)
+    """
+    peaks = []
+    for index in range(samples):
+        tracemalloc.start()
+        try:
+            request(index)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+        finally:
+            tracemalloc.stop()
+    return {'allocated_peak_kib': sum(peaks) / len(peaks) / 1024}
+
+
+def benchmark(args) -> dict:
+    db = fake_firestore.Client()
+    api, event = setup_functions(db)
+
+    results = []
+    for size in args.sizes:
+        requests = make_requests(api, event, size)
+        for scenario in args.scenarios:
+            for concurrency in args.concurrency:
+                # every run starts from the same collection
+                fill_events(api, db, size)
+                run(requests[scenario], 1, 0, args.warmup)
+                result = {
+                    'scenario': scenario,
+                    'size': size,
+                    'concurrency': concurrency,
+                    **run(requests[scenario], concurrency, args.duration, args.min_requests),
+                    **measure_allocations(requests[scenario], args.alloc_samples),
+                }
+                results.append(result)
+                print_result(result)
+
+    return {
+        'created': datetime.datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': {
+            'duration': args.duration,
+            'min_requests': args.min_requests,
+            'alloc_samples': args.alloc_samples,
+        },
+        'results': results,
+    }
+
+
+def print_result(result: dict, baseline: dict = None):
+    line = '{scenario:<10} size {size:>6} concurrency {concurrency:>3}: {requests_per_second:>9.1f} req/s, ' \
+           'p50 {latency_p50_ms:>8.2f} ms, p99 {latency_p99_ms:>8.2f} ms, {allocated_peak_kib:>9.1f} KiB'
+    print(line.format(**result))
+    if baseline:
+        print(' ' * 43 + '{:>+9.1%}        {:>+9.1%}          {:>+9.1%}     {:>+9.1%}'.format(*(
+            result[metric] / baseline[metric] - 1 if baseline[metric] else 0
+            for metric in ('requests_per_second', 'latency_p50_ms', 'latency_p99_ms', 'allocated_peak_kib')
+        )))
+
+
+def compare(report: dict, baseline_report: dict):
+    """Prints results with relative changes against the baseline results"""
+    key = ('scenario', 'size', 'concurrency')
+    baseline = {tuple(result[name] for name in key): result for result in baseline_report['results']}
+    print('\ncompared to {} (python {})'.format(baseline_report['created'], baseline_report['python']))
+    for result in report['results']:
+        print_result(result, baseline.get(tuple(result[name] for name in key)))
+
+
+def int_list(value: str) -> typing.List[int]:
+    return [int(item) for item in value.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', type=lambda value: value.split(','), default=list(SCENARIOS),
+                        help='comma separated scenarios ({})'.format(', '.join(SCENARIOS)))
+    parser.add_argument('--sizes', type=int_list, default=[100, 1000, 10000], help='events collection sizes')
+    parser.add_argument('--concurrency', type=int_list, default=[1, 4, 16], help='numbers of concurrent clients')
+    parser.add_argument('--duration', type=float, default=2.0, help='seconds of one benchmark run')
+    parser.add_argument('--min-requests', type=int, default=20, help='minimal number of requests of one run')
+    parser.add_argument('--warmup', type=int, default=3, help='number of requests before each run')
+    parser.add_argument('--alloc-samples', type=int, default=5, help='number of requests traced for allocations')
+    parser.add_argument('--output', help='path of the JSON results file')
+    parser.add_argument('--compare', help='path of the JSON results file to compare with')
+    args = parser.parse_args()
+
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error('unknown scenarios: {}'.format(', '.join(sorted(unknown))))
+
+    report = benchmark(args)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    if args.compare:
+        with open(args.compare) as baseline:
+            compare(report, json.load(baseline))
+
+
+if __name__ == '__main__':
+    main()
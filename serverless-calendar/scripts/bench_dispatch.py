@@ -0,0 +1,122 @@
+"""Micro-benchmark of the calendar API request dispatch
+
+Compares per-request overhead of the original `test_request_context` re-dispatch with
+the direct WSGI dispatch used by `calendar_api`. Only flask is required, the benchmark
+does not touch any GCP service.
+
+    python bench_dispatch.py [--requests 20000]
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import timeit
+
+from flask import (
+    Flask,
+    Request,
+    request,
+)
+from werkzeug.datastructures import Headers
+from werkzeug.test import EnvironBuilder
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+
+from dispatch import dispatch_request  # noqa: E402
+
+app = Flask(__name__)
+
+
+@app.route('/', methods=['GET'])
+def get_events():
+    return {'objects': []}, 200
+
+
+@app.route('/', methods=['POST'])
+def create_event():
+    return request.get_json(silent=True), 201
+
+
+def legacy_dispatch(api_request: Request):
+    """Original calendar_api implementation (query string decoded for newer werkzeug versions)"""
+    with app.app_context():
+        headers = Headers()
+        for key, value in api_request.headers.items():
+            headers.add(key, value)
+
+        content = {}
+        if headers.get('content-type') == 'application/json':
+            content['json'] = api_request.get_json(silent=True)
+        else:
+            content['data'] = api_request.form
+
+        with app.test_request_context(
+                method=api_request.method,
+                base_url=api_request.base_url,
+                path=api_request.path,
+                query_string=api_request.query_string.decode('latin-1'),
+                headers=headers,
+                **content
+        ):
+            try:
+                rv = app.preprocess_request()
+                if rv is None:
+                    rv = app.dispatch_request()
+            except Exception as e:
+                rv = app.handle_user_exception(e)
+            response = app.make_response(rv)
+            return app.process_response(response)
+
+
+def direct_dispatch(api_request: Request):
+    return dispatch_request(app, api_request)
+
+
+def request_factory(method: str):
+    """Creates function building fresh incoming requests (body stream can be read only once)"""
+    body = json.dumps({'message': 'Test message', 'timedelta': 10, 'repeat': 3}) if method == 'POST' else None
+    builder = EnvironBuilder(
+        method=method,
+        path='/',
+        query_string='limit=10',
+        headers={'User-Agent': 'bench', 'Accept': 'application/json'},
+        content_type='application/json' if body else None,
+        data=body
+    )
+    environ = builder.get_environ()
+    raw_body = environ['wsgi.input'].read()
+
+    def make_request() -> Request:
+        request_environ = dict(environ)
+        request_environ['wsgi.input'] = io.BytesIO(raw_body)
+        return Request(request_environ)
+
+    return make_request
+
+
+def measure(adapter, make_request, count: int) -> float:
+    """Returns mean time per request in microseconds"""
+    timer = timeit.Timer(lambda: adapter(make_request()))
+    timer.timeit(min(count // 10, 1000))  # warm-up
+    return min(timer.repeat(repeat=3, number=count)) / count * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=20000, help='number of requests per measurement')
+    args = parser.parse_args()
+
+    print('{:<6} {:>14} {:>14} {:>14} {:>9}'.format('method', 'baseline [us]', 'legacy [us]', 'direct [us]', 'speedup'))
+    for method in ('GET', 'POST'):
+        make_request = request_factory(method)
+        baseline = measure(lambda api_request: api_request.get_data(), make_request, args.requests)
+        legacy = measure(legacy_dispatch, make_request, args.requests) - baseline
+        direct = measure(direct_dispatch, make_request, args.requests) - baseline
+        print('{:<6} {:>14.1f} {:>14.1f} {:>14.1f} {:>8.1f}x'.format(
+            method, baseline, legacy, direct, legacy / direct
+        ))
+
+
+if __name__ == '__main__':
+    main()
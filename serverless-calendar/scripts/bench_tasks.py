@@ -0,0 +1,133 @@
+"""Micro-benchmark of calendar task construction
+
+Compares the original dataclass task of the calendar API, which reads the environment and
+re-encodes the payload on every access, with the shared slotted `CalendarTask`. Each iteration
+builds the task like `create_calendar_event` does: event document and cloud task request.
+Only protobuf is required (orjson is used if it is installed).
+
+    python bench_tasks.py [--tasks 20000]
+"""
+import argparse
+import datetime
+import json
+import os
+import sys
+import timeit
+import typing
+import uuid
+from dataclasses import (
+    dataclass,
+    field,
+)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from calendar_common import tasks  # noqa: E402
+from calendar_common.tasks import CalendarTask  # noqa: E402
+
+os.environ.setdefault('GCP_PROJECT', 'bench')
+os.environ.setdefault('FUNCTION_REGION', 'local')
+os.environ.setdefault('QUEUE_NAME', 'bench')
+os.environ.setdefault('EVENT_CALLBACK_URL', 'http://localhost/event')
+os.environ.setdefault('SERVICE_ACCOUNT_EMAIL', 'bench@localhost')
+
+
+@dataclass
+class LegacyCalendarTask:
+    """Original calendar API task"""
+    id: str = field(default_factory=lambda: str(uuid.uuid4()))
+    message: str = 'Empty message'
+    timestamp: datetime.datetime = None
+    timedelta: int = None
+    repeat: int = 0
+    counter_shards: int = 0
+
+    @property
+    def name(self) -> str:
+        return 'projects/{project_name}/locations/{location}/queues/{queue}/tasks/{id}'.format(
+            project_name=os.getenv("GCP_PROJECT"),
+            location=os.getenv("FUNCTION_REGION"),
+            queue=os.getenv("QUEUE_NAME"),
+            id=self.id
+        )
+
+    @property
+    def schedule_time(self) -> datetime.datetime:
+        return (self.timestamp or datetime.datetime.now()) + datetime.timedelta(seconds=self.timedelta or 0)
+
+    @property
+    def schedule_time_proto(self):
+        from google.protobuf.timestamp_pb2 import Timestamp
+
+        proto_timestamp = Timestamp()
+        proto_timestamp.FromDatetime(self.schedule_time)
+        return proto_timestamp
+
+    @property
+    def payload_dict(self) -> dict:
+        payload = {'message': self.message, 'timedelta': self.timedelta, 'id': self.id, 'repeat': self.repeat}
+        if self.counter_shards:
+            payload['counter_shards'] = self.counter_shards
+        return payload
+
+    @property
+    def payload_blob(self) -> bytes:
+        return json.dumps(self.payload_dict).encode('utf-8')
+
+    @property
+    def _dict_base(self) -> dict:
+        return {
+            'name': self.name,
+            'http_request': {
+                'http_method': 'POST',
+                'url': os.getenv("EVENT_CALLBACK_URL"),
+                'headers': {"Content-Type": "application/json"},
+                'oidc_token': {'service_account_email': os.getenv('SERVICE_ACCOUNT_EMAIL')}
+            }
+        }
+
+    def to_dict(self) -> dict:
+        doc = {**self._dict_base, 'processed': False, 'execution_counter': 0,
+               'schedule_time': self.schedule_time.isoformat()}
+        doc['http_request']['body'] = self.payload_dict
+        return doc
+
+    def to_task_request(self) -> dict:
+        doc = {**self._dict_base, 'schedule_time': self.schedule_time_proto}
+        doc['http_request']['body'] = self.payload_blob
+        return doc
+
+
+def build(task_class: typing.Type, **kwargs) -> typing.Callable[[], typing.Any]:
+    def create():
+        task = task_class(message='Benchmark event', timedelta=3600, repeat=3, **kwargs)
+        return task.to_dict(), task.to_task_request()
+
+    return create
+
+
+def measure(create: typing.Callable[[], typing.Any], count: int) -> float:
+    """Returns mean time per task in microseconds"""
+    timer = timeit.Timer(create)
+    timer.timeit(min(count // 10, 1000))  # warm-up
+    return min(timer.repeat(repeat=3, number=count)) / count * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tasks', type=int, default=20000, help='number of tasks per measurement')
+    args = parser.parse_args()
+
+    legacy = measure(build(LegacyCalendarTask), args.tasks)
+    shared = measure(build(CalendarTask, initial=True), args.tasks)
+    print('json encoder: {}'.format('orjson' if tasks.orjson else 'json'))
+    print('{:>12} {:>12} {:>9}'.format('legacy [us]', 'shared [us]', 'speedup'))
+    print('{:>12.1f} {:>12.1f} {:>8.1f}x'.format(legacy, shared, legacy / shared))
+    print('task size: {} B legacy, {} B shared'.format(
+        sys.getsizeof(LegacyCalendarTask()) + sys.getsizeof(LegacyCalendarTask().__dict__),
+        sys.getsizeof(CalendarTask())
+    ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,339 @@
+"""In-memory stand-in of the firestore client for offline benchmarks
+
+Implements only the subset of the client API used by the calendar functions. Documents
+are copied on every read and write, roughly like the real client (de)serializes them.
+"""
+import threading
+import typing
+
+OPERATORS = {
+    '==': lambda value, other: value == other,
+    '!=': lambda value, other: value != other,
+    '<': lambda value, other: value is not None and value < other,
+    '<=': lambda value, other: value is not None and value <= other,
+    '>': lambda value, other: value is not None and value > other,
+    '>=': lambda value, other: value is not None and value >= other,
+    'in': lambda value, other: value in other,
+    'array_contains': lambda value, other: isinstance(value, list) and other in value,
+}
+
+
+def clone(value):
+    """Copies maps and arrays of a document, other firestore values are immutable"""
+    if isinstance(value, dict):
+        return {key: clone(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [clone(item) for item in value]
+    return value
+
+
+def get_field(data: dict, field_path: str):
+    for key in field_path.split('.'):
+        if not isinstance(data, dict) or key not in data:
+            return None
+        data = data[key]
+    return data
+
+
+def set_field(data: dict, field_path: str, value):
+    keys = field_path.split('.')
+    for key in keys[:-1]:
+        data = data.setdefault(key, {})
+    data[keys[-1]] = value
+
+
+def is_increment(value) -> bool:
+    return type(value).__name__ == 'Increment'
+
+
+def is_array_union(value) -> bool:
+    return type(value).__name__ == 'ArrayUnion'
+
+
+def transform(current, value):
+    """Applies increment or array union transform to the current field value"""
+    if is_increment(value):
+        return (current or 0) + value.value
+    if is_array_union(value):
+        items = list(current) if isinstance(current, list) else []
+        return items + [item for item in value.values if item not in items]
+    return clone(value)
+
+
+def merge(target: dict, data: dict) -> dict:
+    """Merges data into the target document, applying increment transforms"""
+    for key, value in data.items():
+        if is_increment(value) or is_array_union(value):
+            target[key] = transform(target.get(key), value)
+        elif isinstance(value, dict):
+            if not isinstance(target.get(key), dict):
+                target[key] = {}
+            merge(target[key], value)
+        else:
+            target[key] = clone(value)
+    return target
+
+
+def resolve(data: dict) -> dict:
+    """Replaces increment transforms of a new document with their values"""
+    return merge({}, data)
+
+
+class WriteResult(typing.NamedTuple):
+    # write counter of the client instead of a timestamp
+    update_time: int
+
+
+class DocumentSnapshot:
+    def __init__(self, reference: 'DocumentReference', data: typing.Optional[dict]):
+        self.reference = reference
+        self._data = data
+
+    @property
+    def id(self) -> str:
+        return self.reference.id
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    def get(self, field_path: str):
+        return get_field(self._data, field_path)
+
+    def to_dict(self) -> typing.Optional[dict]:
+        return clone(self._data)
+
+
+class DocumentReference:
+    def __init__(self, client: 'Client', path: str):
+        self._client = client
+        self.path = path
+        self.parent_path, _, self.id = path.rpartition('/')
+
+    def collection(self, collection_id: str) -> 'CollectionReference':
+        return CollectionReference(self._client, '{}/{}'.format(self.path, collection_id))
+
+    def get(self, transaction=None) -> DocumentSnapshot:
+        return DocumentSnapshot(self, self._client._get(self))
+
+    def set(self, data: dict, merge: bool = False) -> WriteResult:
+        return self._client._write([('set', self, data, merge, None)])[0]
+
+    def create(self, data: dict) -> WriteResult:
+        return self._client._write([('create', self, data, False, None)])[0]
+
+    def update(self, data: dict, option=None) -> WriteResult:
+        return self._client._write([('update', self, data, False, option)])[0]
+
+    def delete(self):
+        self._client._write([('delete', self, None, False, None)])
+
+
+class Query:
+    def __init__(self, collection: 'CollectionReference', **options):
+        self._collection = collection
+        self._filters = options.get('filters', ())
+        self._orders = options.get('orders', ())
+        self._limit = options.get('limit')
+        self._fields = options.get('fields')
+        self._start = options.get('start')
+
+    def _copy(self, **options) -> 'Query':
+        return Query(self._collection, **{
+            'filters': self._filters,
+            'orders': self._orders,
+            'limit': self._limit,
+            'fields': self._fields,
+            'start': self._start,
+            **options
+        })
+
+    def where(self, field_path: str, op_string: str, value) -> 'Query':
+        return self._copy(filters=self._filters + ((field_path, OPERATORS[op_string], value),))
+
+    def order_by(self, field_path: str, direction: str = 'ASCENDING') -> 'Query':
+        return self._copy(orders=self._orders + ((field_path, direction == 'DESCENDING'),))
+
+    def limit(self, count: int) -> 'Query':
+        return self._copy(limit=count)
+
+    def select(self, field_paths: typing.List[str]) -> 'Query':
+        return self._copy(fields=list(field_paths))
+
+    def start_after(self, document_fields) -> 'Query':
+        return self._copy(start=(document_fields, False))
+
+    def start_at(self, document_fields) -> 'Query':
+        return self._copy(start=(document_fields, True))
+
+    def _cursor_values(self, cursor, orders) -> tuple:
+        if isinstance(cursor, DocumentSnapshot):
+            return tuple(sort_value(cursor.id, cursor._data, field_path) for field_path, _ in orders)
+        values = []
+        for field_path, _ in orders:
+            if field_path not in cursor:
+                break
+            value = cursor[field_path]
+            values.append((True, value.id if isinstance(value, DocumentReference) else value))
+        return tuple(values)
+
+    def stream(self, transaction=None) -> typing.Iterator[DocumentSnapshot]:
+        orders = self._orders
+        if not any(field_path == '__name__' for field_path, _ in orders):
+            # firestore orders documents with equal values by their name
+            orders += (('__name__', False),)
+
+        items = [
+            (document_id, data) for document_id, data in self._collection._client._documents(self._collection.path)
+            if all(op(get_field(data, field_path), value) for field_path, op, value in self._filters)
+        ]
+        for field_path, descending in reversed(orders):
+            items.sort(key=lambda item, path=field_path: sort_value(item[0], item[1], path), reverse=descending)
+
+        if self._start:
+            cursor, inclusive = self._start
+            cursor_values = self._cursor_values(cursor, orders)
+            cursor_orders = orders[:len(cursor_values)]
+
+            def after_cursor(item) -> bool:
+                for (field_path, descending), cursor_value in zip(cursor_orders, cursor_values):
+                    value = sort_value(item[0], item[1], field_path)
+                    if value != cursor_value:
+                        return (value > cursor_value) != descending
+                return inclusive
+
+            items = [item for item in items if after_cursor(item)]
+
+        if self._limit is not None:
+            items = items[:self._limit]
+        for document_id, data in items:
+            if self._fields is not None:
+                projected = {}
+                for field_path in self._fields:
+                    value = get_field(data, field_path)
+                    if value is not None:
+                        set_field(projected, field_path, value)
+                data = projected
+            yield DocumentSnapshot(self._collection.document(document_id), clone(data))
+
+    def get(self, transaction=None) -> typing.List[DocumentSnapshot]:
+        return list(self.stream())
+
+
+def sort_value(document_id: str, data: dict, field_path: str) -> tuple:
+    value = document_id if field_path == '__name__' else get_field(data, field_path)
+    # missing values are ordered first, like null values in firestore
+    return (value is not None, value if value is not None else 0)
+
+
+class CollectionReference(Query):
+    def __init__(self, client: 'Client', path: str):
+        self._client = client
+        self.path = path
+        self.id = path.rpartition('/')[2]
+        super().__init__(self)
+
+    def document(self, document_id: str = None) -> DocumentReference:
+        import uuid
+
+        return DocumentReference(self._client, '{}/{}'.format(self.path, document_id or uuid.uuid4().hex[:20]))
+
+    def on_snapshot(self, callback):
+        raise NotImplementedError('Snapshot listeners are not supported by the in-memory firestore')
+
+
+class WriteBatch:
+    def __init__(self, client: 'Client'):
+        self._client = client
+        self._writes = []
+
+    def set(self, reference: DocumentReference, data: dict, merge: bool = False):
+        self._writes.append(('set', reference, data, merge, None))
+
+    def create(self, reference: DocumentReference, data: dict):
+        self._writes.append(('create', reference, data, False, None))
+
+    def update(self, reference: DocumentReference, data: dict, option=None):
+        self._writes.append(('update', reference, data, False, option))
+
+    def delete(self, reference: DocumentReference):
+        self._writes.append(('delete', reference, None, False, None))
+
+    def commit(self) -> typing.List[WriteResult]:
+        results = self._client._write(self._writes)
+        self._writes = []
+        return results
+
+
+class Client:
+    """In-memory firestore client"""
+
+    def __init__(self):
+        self._collections: typing.Dict[str, typing.Dict[str, dict]] = {}
+        self._update_times: typing.Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.reads = 0
+        self.writes = 0
+
+    def collection(self, collection_id: str) -> CollectionReference:
+        return CollectionReference(self, collection_id)
+
+    def batch(self) -> WriteBatch:
+        return WriteBatch(self)
+
+    def _get(self, reference: DocumentReference) -> typing.Optional[dict]:
+        with self._lock:
+            self.reads += 1
+            data = self._collections.get(reference.parent_path, {}).get(reference.id)
+            return clone(data)
+
+    def _documents(self, collection_path: str) -> typing.List[typing.Tuple[str, dict]]:
+        with self._lock:
+            documents = list(self._collections.get(collection_path, {}).items())
+            self.reads += len(documents)
+            return documents
+
+    def _write(self, writes: list) -> typing.List[WriteResult]:
+        from google.api_core.exceptions import (
+            AlreadyExists,
+            FailedPrecondition,
+            NotFound,
+        )
+
+        with self._lock:
+            for kind, reference, _, _, option in writes:
+                exists = reference.id in self._collections.get(reference.parent_path, {})
+                if kind == 'create' and exists:
+                    raise AlreadyExists('Document already exists: {}'.format(reference.path))
+                if kind == 'update' and not exists:
+                    raise NotFound('No document to update: {}'.format(reference.path))
+                last_update_time = getattr(option, '_last_update_time', None)
+                if last_update_time is not None and self._update_times.get(reference.path) != last_update_time:
+                    raise FailedPrecondition('Document was updated: {}'.format(reference.path))
+            results = []
+            for kind, reference, data, merge_data, _ in writes:
+                self.writes += 1
+                collection = self._collections.setdefault(reference.parent_path, {})
+                if kind == 'delete':
+                    collection.pop(reference.id, None)
+                elif kind == 'update':
+                    document = collection[reference.id]
+                    for field_path, value in data.items():
+                        set_field(document, field_path, transform(get_field(document, field_path), value))
+                elif merge_data and reference.id in collection:
+                    merge(collection[reference.id], data)
+                else:
+                    collection[reference.id] = resolve(data)
+                self._update_times[reference.path] = self.writes
+                results.append(WriteResult(self.writes))
+            return results
+
+    def load(self, collection_path: str, documents: typing.Dict[str, dict]):
+        """Stores documents without counting writes
+
+        :param collection_path: collection path
+        :param documents: documents by their ID
+        """
+        with self._lock:
+            self._collections.setdefault(collection_path, {}).update(clone(documents))
+
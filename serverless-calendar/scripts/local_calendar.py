@@ -0,0 +1,112 @@
+"""Runs the serverless calendar in a single process without cloud tasks
+
+    python local_calendar.py serve [--port 8080] [--workers 8]
+        Serves the calendar API, tasks are scheduled by the in-process scheduler and dispatched
+        directly to the event callback. Firestore is still required, set `FIRESTORE_EMULATOR_HOST`
+        to use the local emulator.
+
+    python local_calendar.py bench [--tasks 1000000] [--spread 30] [--workers 8] [--work-ms 0]
+        Measures throughput and scheduling latency of the in-process scheduler with no-op tasks.
+"""
+import argparse
+import datetime
+import importlib.util
+import os
+import sys
+import time
+
+CALENDAR_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, CALENDAR_DIR)
+
+from calendar_common.backends import (  # noqa: E402
+    LocalTaskBackend,
+    http_dispatcher,
+    set_task_backend,
+)
+
+
+def load_function(name: str, module_name: str):
+    """Loads cloud function main module under unique module name"""
+    function_dir = os.path.join(CALENDAR_DIR, name)
+    sys.path.insert(0, function_dir)
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(function_dir, 'main.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def serve(args):
+    from werkzeug.serving import run_simple
+
+    api = load_function('api', 'calendar_api_main')
+    event = load_function('event', 'calendar_event_main')
+    backend = LocalTaskBackend(http_dispatcher(event.calendar_event_callback), workers=args.workers)
+    set_task_backend(backend)
+    try:
+        run_simple(args.host, args.port, api.app, threaded=True)
+    finally:
+        print(backend.stats())
+        backend.shutdown(wait=False)
+
+
+def bench(args):
+    work = args.work_ms / 1000
+
+    def dispatch(task: dict):
+        if work:
+            time.sleep(work)
+
+    backend = LocalTaskBackend(dispatch, workers=args.workers)
+    start = datetime.datetime.now() + datetime.timedelta(seconds=args.delay)
+    step = datetime.timedelta(seconds=args.spread / args.tasks)
+
+    enqueue_started = time.perf_counter()
+    for index in range(args.tasks):
+        backend.create_task('local', {
+            'name': 'task_{}'.format(index),
+            'schedule_time': start + step * index,
+            'http_request': {},
+        })
+    enqueue_time = time.perf_counter() - enqueue_started
+    print('enqueued {} tasks in {:.2f}s ({:.0f} tasks/s), {} pending'.format(
+        args.tasks, enqueue_time, args.tasks / enqueue_time, backend.pending
+    ))
+
+    while backend.stats()['dispatched'] < args.tasks:
+        time.sleep(0.1)
+    dispatch_time = time.time() - start.timestamp()
+    stats = backend.stats()
+    backend.shutdown()
+
+    print('dispatched {dispatched} tasks in {time:.2f}s since the first one was due ({rate:.0f} tasks/s), '
+          'failed {failed}'.format(time=dispatch_time, rate=stats['dispatched'] / dispatch_time, **stats))
+    print('scheduling latency p50 {:.1f} ms, p99 {:.1f} ms, max {:.1f} ms'.format(
+        stats['latency_p50'] * 1000, stats['latency_p99'] * 1000, stats['latency_max'] * 1000
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    serve_parser = subparsers.add_parser('serve', help='serve the calendar API')
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8080)
+    serve_parser.add_argument('--workers', type=int, default=8, help='number of concurrently dispatched tasks')
+    serve_parser.set_defaults(handler=serve)
+
+    bench_parser = subparsers.add_parser('bench', help='benchmark the in-process scheduler')
+    bench_parser.add_argument('--tasks', type=int, default=1000000, help='number of scheduled tasks')
+    bench_parser.add_argument('--delay', type=float, default=5.0, help='seconds before the first task is due')
+    bench_parser.add_argument('--spread', type=float, default=30.0, help='seconds over which tasks are due')
+    bench_parser.add_argument('--workers', type=int, default=8, help='number of concurrently dispatched tasks')
+    bench_parser.add_argument('--work-ms', type=float, default=0.0, help='duration of one task')
+    bench_parser.set_defaults(handler=bench)
+
+    args = parser.parse_args()
+    args.handler(args)
+
+
+if __name__ == '__main__':
+    main()
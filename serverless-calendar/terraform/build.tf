@@ -7,15 +7,15 @@ resource "google_cloudbuild_trigger" "deploy_calendar_api_cf" {
     repo_name = var.build_github_repository
   }
   included_files = [
-    "serverless-calendar/api/cloudbuild.yaml",
-    "serverless-calendar/api/main.py",
-    "serverless-calendar/api/requirements.txt",
+    "serverless-calendar/api/**",
+    "serverless-calendar/calendar_common/**",
   ]
   substitutions = {
     _SERVICE_ACCOUNT_EMAIL = google_service_account.task_api_service_account.email
     _EVENT_CALLBACK_URL = "https://${var.region}-${var.project_id}.cloudfunctions.net/calendar_event_callback"
     _QUEUE_NAME = google_cloud_tasks_queue.slack_notifications.name
     _REGION = var.region
+    _METRICS_TOKEN = var.metrics_token
   }
 }
 
@@ -28,9 +28,8 @@ resource "google_cloudbuild_trigger" "deploy_calendar_notification_cf" {
     repo_name = var.build_github_repository
   }
   included_files = [
-    "serverless-calendar/event/cloudbuild.yaml",
-    "serverless-calendar/event/main.py",
-    "serverless-calendar/event/requirements.txt",
+    "serverless-calendar/event/**",
+    "serverless-calendar/calendar_common/**",
   ]
   substitutions = {
     _SLACK_API_TOKEN = var.slack_api_token
@@ -0,0 +1,42 @@
+// delivery markers of the event callback are deleted by firestore once they expire
+resource "google_firestore_field" "deliveries_ttl" {
+  project = var.project_id
+  database = "(default)"
+  collection = "deliveries"
+  field = "expires_at"
+
+  ttl_config {}
+
+  // markers are only read by their ID, so the timestamp is not indexed
+  index_config {}
+
+  depends_on = [
+    google_project_service.firestore
+  ]
+}
+
+// time window listing of pending or processed events (`GET /?processed=false&from=...&to=...`)
+resource "google_firestore_index" "events_schedule" {
+  project = var.project_id
+  database = "(default)"
+  collection = "events"
+
+  fields {
+    field_path = "processed"
+    order = "ASCENDING"
+  }
+
+  fields {
+    field_path = "schedule_at"
+    order = "ASCENDING"
+  }
+
+  fields {
+    field_path = "__name__"
+    order = "ASCENDING"
+  }
+
+  depends_on = [
+    google_project_service.firestore
+  ]
+}
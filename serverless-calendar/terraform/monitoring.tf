@@ -0,0 +1,71 @@
+// latency metrics extracted from the request log entries of the functions
+// (`Request finished` entries written by `calendar_common.instrumentation`)
+locals {
+  latency_filter = "resource.type=\"cloud_function\" AND textPayload:\"'message': 'Request finished'\""
+  latency_bounds = [1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000]
+}
+
+resource "google_logging_metric" "request_latency" {
+  project = var.project_id
+  name = "calendar/request_latency"
+  filter = local.latency_filter
+  value_extractor = "REGEXP_EXTRACT(textPayload, \"'duration_ms': ([0-9.]+)\")"
+
+  label_extractors = {
+    "function" = "REGEXP_EXTRACT(textPayload, \"'trace': '([a-z_]+)'\")"
+    "status" = "REGEXP_EXTRACT(textPayload, \"'status': ([0-9]+)\")"
+  }
+
+  metric_descriptor {
+    metric_kind = "DELTA"
+    value_type = "DISTRIBUTION"
+    unit = "ms"
+
+    labels {
+      key = "function"
+      value_type = "STRING"
+    }
+
+    labels {
+      key = "status"
+      value_type = "STRING"
+    }
+  }
+
+  bucket_options {
+    explicit_buckets {
+      bounds = local.latency_bounds
+    }
+  }
+}
+
+// time spent by one request in the outbound calls of the service
+resource "google_logging_metric" "service_latency" {
+  for_each = toset(["firestore", "tasks", "slack"])
+
+  project = var.project_id
+  name = "calendar/${each.key}_latency"
+  filter = "${local.latency_filter} AND textPayload:\"'${each.key}': \""
+  value_extractor = "REGEXP_EXTRACT(textPayload, \"'service_ms': \\{[^}]*'${each.key}': ([0-9.]+)\")"
+
+  label_extractors = {
+    "function" = "REGEXP_EXTRACT(textPayload, \"'trace': '([a-z_]+)'\")"
+  }
+
+  metric_descriptor {
+    metric_kind = "DELTA"
+    value_type = "DISTRIBUTION"
+    unit = "ms"
+
+    labels {
+      key = "function"
+      value_type = "STRING"
+    }
+  }
+
+  bucket_options {
+    explicit_buckets {
+      bounds = local.latency_bounds
+    }
+  }
+}
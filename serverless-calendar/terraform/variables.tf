@@ -25,3 +25,9 @@ variable "slack_api_token" {
 variable "slack_notification_channel" {
   type = string
 }
+
+// bearer token of the API `/metrics` endpoint, the endpoint is disabled if empty
+variable "metrics_token" {
+  type = string
+  default = ""
+}